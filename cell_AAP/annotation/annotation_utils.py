@@ -4,7 +4,7 @@ import numpy.typing as npt
 import torch
 from PIL import Image
 import skimage
-from skimage.measure import regionprops, label
+from skimage.measure import regionprops, regionprops_table, label
 from skimage.morphology import white_tophat, square, disk, erosion
 from skimage.segmentation import clear_border
 from skimage.filters import (
@@ -14,7 +14,127 @@ from skimage.filters import (
 )  # pylint: disable=no-name-in-module
 from typing import Optional, Union
 import scipy
+import scipy.ndimage
+import scipy.special
 import itertools
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+try:
+    from cell_AAP.annotation.packed_masks import PackedMasks, overlapping_masks  # type:ignore
+except ImportError:  # annotator.py imports this module as a plain script, next to packed_masks.py
+    from packed_masks import PackedMasks, overlapping_masks  # type:ignore
+try:
+    from cell_AAP.annotation.resample import resample, fit_to_shape, ResampleTransform  # type:ignore
+except ImportError:
+    from resample import resample, fit_to_shape, ResampleTransform  # type:ignore
+
+
+FRAME_PROPERTIES = (
+    "label",
+    "centroid",
+    "axis_major_length",
+    "axis_minor_length",
+    "bbox",
+    "intensity_mean",
+)
+
+
+def separable_opening(image: npt.NDArray, size: tuple[int, int]) -> npt.NDArray:
+    """
+    Grey opening with an upright rectangle of ones, computed as four running min/max 1D passes (van Herk/Gil-Werman style)
+    -----------------------------------------------------------------------------------------------------------------------
+    INPUTS:
+        image: n-darray, 2D image
+        size: tuple, (rows, cols) of the rectangular structuring element, both must be odd
+    OUTPUTS:
+        opened: n-darray, same shape and dtype as image
+
+    Every pass runs along the contiguous axis (the image is transposed in between), with the same 'reflect' border as
+    skimage.morphology.opening, so the result is bit-for-bit identical to opening(image, np.ones(size)).
+    """
+
+    opened = scipy.ndimage.minimum_filter1d(image, size[1], axis=1, mode="reflect")
+    opened = np.ascontiguousarray(opened.T)
+    opened = scipy.ndimage.minimum_filter1d(opened, size[0], axis=1, mode="reflect")
+    opened = scipy.ndimage.maximum_filter1d(opened, size[0], axis=1, mode="reflect")
+    opened = np.ascontiguousarray(opened.T)
+    opened = scipy.ndimage.maximum_filter1d(opened, size[1], axis=1, mode="reflect")
+
+    return opened
+
+
+def downsampled_opening(
+    image: npt.NDArray, size: tuple[int, int], factor: int = 4
+) -> npt.NDArray:
+    """
+    Approximate grey opening with an upright rectangle, estimated on a min-binned copy of the image and upsampled back
+    -------------------------------------------------------------------------------------------------------------------
+    INPUTS:
+        image: n-darray, 2D image
+        size: tuple, (rows, cols) of the rectangular structuring element
+        factor: int, binning factor used for the background estimate
+    OUTPUTS:
+        opened: n-darray, float64 background estimate with the same shape as image, clipped to never exceed image
+    """
+
+    rows, cols = image.shape
+    padded = np.pad(image, ((0, -rows % factor), (0, -cols % factor)), mode="edge")
+    small = padded.reshape(
+        padded.shape[0] // factor, factor, padded.shape[1] // factor, factor
+    ).min(axis=(1, 3))
+    small_size = tuple(max(1, int(round(length / factor))) | 1 for length in size)
+    small = separable_opening(small.astype("float64"), small_size)
+    opened = cv2.resize(
+        small, (padded.shape[1], padded.shape[0]), interpolation=cv2.INTER_LINEAR
+    )[:rows, :cols]
+
+    return np.minimum(opened, image)
+
+
+def fast_tophat(
+    image: npt.NDArray, tophatstruct, method: str = "separable", factor: int = 4
+) -> npt.NDArray:
+    """
+    White top-hat background subtraction with a selectable backend
+    --------------------------------------------------------------
+    INPUTS:
+        image: n-darray, 2D image
+        tophatstruct: n-darray, structuring element for white_tophat
+        method: str, one of
+                'naive' - skimage.morphology.white_tophat
+                'separable' - exact, 1D running min/max passes when tophatstruct is an odd-sized rectangle of ones,
+                              falls back to 'naive' for any other structuring element
+                'downsample' - approximate, background estimated on an image binned by 'factor' and upsampled back,
+                               only the bounding rectangle of tophatstruct is used
+        factor: int, binning factor for method = 'downsample'
+    OUTPUTS:
+        tophat: n-darray, image minus its (estimated) opening
+    """
+
+    try:
+        assert method in ["naive", "separable", "downsample"]
+    except AssertionError as error:
+        raise AssertionError(
+            "tophat method must be one of 'naive', 'separable', 'downsample'"
+        ) from error
+
+    footprint = tophatstruct if isinstance(tophatstruct, np.ndarray) else None
+    rectangular = (
+        footprint is not None
+        and image.ndim == 2
+        and image.dtype != bool
+        and footprint.ndim == 2
+        and bool(footprint.all())
+        and footprint.shape[0] % 2 == 1
+        and footprint.shape[1] % 2 == 1
+    )
+
+    if method == "downsample" and footprint is not None and image.ndim == 2:
+        return image - downsampled_opening(image, footprint.shape, factor)
+    elif method in ["separable", "downsample"] and rectangular:
+        return image - separable_opening(image, footprint.shape)
+
+    return white_tophat(image, tophatstruct)
 
 
 def preprocess_2d(
@@ -23,6 +143,7 @@ def preprocess_2d(
     sigma: float,
     threshold_type: str = "single",
     tophatstruct=square(71),
+    tophat_method: str = "separable",
 ) -> tuple[npt.NDArray, npt.NDArray]:
     """
     Preprocesses a specified image
@@ -32,14 +153,15 @@ def preprocess_2d(
         strel_cell: n-darray, structuring element for white_tophat
         threshold_division: float or int
         sigma: float or int
+        tophat_method: str, backend passed to fast_tophat
     OUTPUTS:
         redseg: n-darray, segmented targetstack
         labels: n-darray, labeled redseg
     """
 
     im = gaussian(image, sigma)  # 2D gaussian smoothing filter to reduce noise
-    im = white_tophat(
-        im, tophatstruct
+    im = fast_tophat(
+        im, tophatstruct, tophat_method
     )  # Background subtraction + uneven illumination correction
     if threshold_type == "multi":
         thresholds = threshold_multiotsu(im)
@@ -60,7 +182,8 @@ def preprocess_3d(
     threshold_type: str,
     erosionstruct,
     tophatstruct,
-) -> tuple[npt.NDArray, skimage.measure.regionprops]:
+    tophat_method: str = "separable",
+) -> tuple[npt.NDArray, dict[str, dict[str, npt.NDArray]]]:
     """
     Preprocesses a stack of images
     ------------------------------
@@ -69,8 +192,11 @@ def preprocess_3d(
         strel_cell: n-darray, structuring element for white_tophat
         threshold_division: float or int
         sigma: float or int
+        tophat_method: str, backend passed to fast_tophat
     OUTPUTS:
-        region_props: skimage object, region properties for each cell in each stack of a given image, can be indexed as 'region_props['Frame_i']'
+        labels_whole: n-darray, labeled segmentation of each frame
+        region_props: dict, one columnar property table per frame as returned by skimage.measure.regionprops_table with FRAME_PROPERTIES,
+                      can be indexed as 'region_props['Frame_i']['centroid-0']'
     """
 
     region_props = {}
@@ -79,8 +205,8 @@ def preprocess_3d(
     for i in range(targetstack.shape[0]):
         im = targetstack[i, :, :].copy()
         im = gaussian(im, sigma)  # 2D gaussian smoothing filter to reduce noise
-        im = white_tophat(
-            im, tophatstruct
+        im = fast_tophat(
+            im, tophatstruct, tophat_method
         )  # Background subtraction + uneven illumination correction
 
         im = erosion(im, erosionstruct)
@@ -94,7 +220,9 @@ def preprocess_3d(
 
         lblred = label(redseg)
         labels = label(lblred)
-        region_props[f"Frame_{i}"] = regionprops(labels, intensity_image=labels * im)
+        region_props[f"Frame_{i}"] = regionprops_table(
+            labels, intensity_image=labels * im, properties=FRAME_PROPERTIES
+        )
         labels_whole.append(labels)
 
     labels_whole = np.asarray(labels_whole)
@@ -102,44 +230,139 @@ def preprocess_3d(
     return labels_whole, region_props
 
 
+def movie_intensity_range(
+    images: npt.NDArray,
+    percentiles: tuple[float, float] = (0.1, 99.9),
+    max_frames: int = 8,
+) -> tuple[float, float]:
+    """
+    Percentile-clipped intensity range of a movie, computed once and passed to bw_to_rgb() for every frame
+    -------------------------------------------------------------------------------------------------------
+    INPUTS:
+        images: n-darray, a frame of shape (x, y) or a movie of shape (n, x, y)
+        percentiles: tuple, (low, high) percentiles mapped to the minimum and maximum pixel value
+        max_frames: int, number of evenly spaced frames the percentiles are computed over
+    OUTPUTS:
+        intensity_range: tuple, (low, high) intensities
+    """
+    images = np.asarray(images)
+    frames = images.reshape((-1,) + images.shape[-2:])
+    sample = frames[np.linspace(0, frames.shape[0] - 1, min(frames.shape[0], max_frames)).astype(int)]
+    low, high = np.percentile(sample, percentiles)
+
+    return float(low), float(high)
+
+
+def scale_to_uint8(
+    image: npt.NDArray,
+    intensity_range: tuple[float, float],
+    max_pixel_value: int = 255,
+    min_pixel_value: int = 0,
+) -> npt.NDArray:
+    "Linearly maps intensity_range to [min_pixel_value, max_pixel_value] with clipping, 8 and 16 bit images go through a lookup table"
+
+    low_value, high_value = sorted((min_pixel_value, max_pixel_value))
+    scale = (high_value - low_value) / max(intensity_range[1] - intensity_range[0], 1e-12)
+    if image.dtype in (np.uint8, np.uint16):
+        levels = np.arange(np.iinfo(image.dtype).max + 1, dtype="float64")
+        lut = np.clip((levels - intensity_range[0]) * scale + low_value, low_value, high_value)
+        return lut.round().astype("uint8")[image]
+
+    scaled = (np.asarray(image, dtype="float64") - intensity_range[0]) * scale + low_value
+    return np.clip(scaled, low_value, high_value).round().astype("uint8")
+
+
 def bw_to_rgb(
     image: npt.NDArray,
     max_pixel_value: Optional[int] = 255,
     min_pixel_value: Optional[int] = 0,
+    intensity_range: Optional[tuple[float, float]] = None,
 ) -> npt.NDArray:
     """
-    Converts a tiffile of shape (x, y) to a file of shape (3, x, y) where each (x, y) frame of the first dimension corresponds to a color
-    --------------------------------------------------------------------------------------------------------------------------------------
+    Converts a grayscale image of shape (x, y), or a stack of shape (n, x, y), to 8 bit RGB of shape (x, y, 3) or (n, x, y, 3)
+    ----------------------------------------------------------------------------------------------------------------------------
     INPUTS:
-        image: n-darray, an image of shape (x, y)
+        image: n-darray, an image of shape (x, y) or a stack of shape (n, x, y)
         max_pixel_value: int, the maximum desired pixel value for the output asarray
         min_pixel_value: int, the minimum desired pixel value for the output asarray
+        intensity_range: tuple, (low, high) intensities mapped to min_pixel_value and max_pixel_value, values outside are clipped. Compute it
+                         once per movie with movie_intensity_range() to keep 16 bit dynamic range consistent across frames, if None each frame
+                         is min-max normalized
+    OUTPUTS:
+        rgb_image: n-darray, read-only view broadcasting one uint8 channel to three, np.array(rgb_image) gives a writable copy
     """
-    if len(np.asarray(image).shape) == 2:
-        image = cv2.normalize(
-            np.asarray(image),
+    image = np.asarray(image)
+    if image.ndim not in (2, 3):
+        raise ValueError("image must be of shape (x, y) or (n, x, y)")
+
+    if intensity_range != None:
+        gray = scale_to_uint8(image, intensity_range, max_pixel_value, min_pixel_value)
+    elif image.ndim == 2:
+        gray = cv2.normalize(
+            image,
             None,
             max_pixel_value,
             min_pixel_value,
             cv2.NORM_MINMAX,
             cv2.CV_8U,
         )
-        rgb_image = np.zeros((image.shape[0], image.shape[1], 3), "uint8")
-        rgb_image[:, :, 0] = image
-        rgb_image[:, :, 1] = image
-        rgb_image[:, :, 2] = image
+    else:
+        gray = np.stack(
+            [
+                cv2.normalize(
+                    frame,
+                    None,
+                    max_pixel_value,
+                    min_pixel_value,
+                    cv2.NORM_MINMAX,
+                    cv2.CV_8U,
+                )
+                for frame in image
+            ]
+        )
 
-    return rgb_image
+    return np.broadcast_to(gray[..., np.newaxis], gray.shape + (3,))
 
 
-def get_box_size(
-    region_props: skimage.measure.regionprops, scaling_factor: float
-) -> float:
+def rgb_tensor(image: npt.NDArray) -> torch.Tensor:
+    """
+    Converts an (x, y, 3) image to the (3, x, y) float32 tensor detectron2 models take, a broadcast grayscale view from bw_to_rgb()
+    is converted as one channel and expanded on the tensor without copying
+    """
+    if image.ndim == 3 and image.strides[2] == 0:
+        # astype copies, torch.from_numpy warns on the read-only channel of a broadcast view
+        channel = torch.from_numpy(image[:, :, 0].astype("float32"))
+        return channel.expand(image.shape[2], *image.shape[:2])
+
+    return torch.from_numpy(np.ascontiguousarray(np.moveaxis(image, -1, 0))).type(torch.float32)
+
+
+def prop_column(region_props, name: str) -> npt.NDArray:
+    """
+    Returns one property of every cell in a frame as an array
+    ---------------------------------------------------------
+    INPUTS:
+            region_props: dict of property columns as returned by skimage.measure.regionprops_table, or a skimage regionprops list
+            name: str, regionprops_table column name, i.e. 'axis_major_length' or 'centroid-0'
+    OUTPUTS:
+            column: n-darray, one entry per cell
+    """
+
+    if isinstance(region_props, dict):
+        return np.asarray(region_props[name])
+
+    attribute, _, index = name.partition("-")
+    if index:
+        return np.asarray([getattr(prop, attribute)[int(index)] for prop in region_props])
+    return np.asarray([getattr(prop, attribute) for prop in region_props])
+
+
+def get_box_size(region_props, scaling_factor: float) -> float:
     """
     Given a skimage region props object from a flouresence microscopy image, computes the bounding box size to be used in crop_regions or crop_regions_predict
     -----------------------------------------------------------------------------------------------------------------------------------------------------------
     INPUTS:
-            region_props: skimage object, each index represents a grouping of properties about a given cell
+            region_props: dict of property columns for one frame as returned by preprocess_3d, or a skimage regionprops list
             scaling factor: float,  the average area of a cell divided by the average area of a nuclei
                             If an ideal bb_side_length is known compute the scaling factor with the equation: scaling_factor = l^2 / A
                             Where l is your ideal bb_side_length and A is the mean or median area of a nuclei
@@ -147,47 +370,40 @@ def get_box_size(
             half the side length of a bounding box
     """
 
-    major_axis = [region_props[i].axis_major_length for i, _ in enumerate(region_props)]
-
-    dna_major_axis = np.median(np.asarray(major_axis))
+    dna_major_axis = np.median(prop_column(region_props, "axis_major_length"))
     bb_side_length = scaling_factor * dna_major_axis
 
     print("The bounding box side length was", bb_side_length, "pixels")
     return bb_side_length // 2
 
 
-def get_box_size_scaled(region_props, max_size: float) -> list[float]:
+def get_box_size_scaled(region_props, max_size: float) -> npt.NDArray:
     """
-    Given a skimage region props object from a flouresence microscopy image, computes the bounding box size to be used in crop_regions or crop_regions_predict
-    -----------------------------------------------------------------------------------------------------------------------------------------------------------
+    Given a skimage region props object from a flouresence microscopy image, computes one bounding box size per cell to be used in crop_regions_predict
+    --------------------------------------------------------------------------------------------------------------------------------------------------
     INPUTS:
-            region_props: skimage object, each index represents a grouping of properties about a given cell
-            min_size: float, the approximate minimum cell size
+            region_props: dict of property columns for one frame as returned by preprocess_3d, or a skimage regionprops list
+            max_size: float, the approximate maximum bounding box side length
     OUTPUTS:
-            half the side length of a bounding box
+            half the side length of a bounding box, one entry per cell
+
+    The side length of each box is max_size scaled by the normal percentile of the cell's averaged major axis and intensity z-scores.
     """
 
-    major_axis = [region_props[i].axis_major_length for i, _ in enumerate(region_props)]
-    intensity = [region_props[i].intensity for i, _ in enumerate(region_props)]
+    major_axis = prop_column(region_props, "axis_major_length").astype("float64")
+    intensity = prop_column(region_props, "intensity_mean").astype("float64")
 
-    std_intensity = np.std(intensity)
-    std_major_axis = np.std(major_axis)
-    mean_intensity = np.mean(intensity)
-    mean_major_axis = np.mean(major_axis)
+    if major_axis.size == 0:
+        return np.zeros(0)
 
-    bb_side_lengths = []
-    for i, _ in enumerate(region_props):
-        z_score = 0.5 * (
-            (major_axis[i] - mean_major_axis) / std_major_axis
-            + (intensity[i] - mean_intensity) / std_intensity
-        )
-        percentile = scipy.integrate.quad(
-            lambda x: (1 / 2 * np.pi) * np.e ** (-(x**2) / 2), -np.inf, z_score
-        )
-        bb_side_lengths.append(max_size * percentile)
+    z_score = 0.5 * (
+        (major_axis - major_axis.mean()) / (major_axis.std() + np.finfo(float).eps)
+        + (intensity - intensity.mean()) / (intensity.std() + np.finfo(float).eps)
+    )
+    bb_side_lengths = max_size * scipy.special.ndtr(z_score)
 
-    print(np.asarray(bb_side_lengths))
-    return np.asarray(bb_side_lengths) // 2
+    print("The median bounding box side length was", np.median(bb_side_lengths), "pixels")
+    return bb_side_lengths // 2
 
 
 def square_box(centroid: npt.NDArray, box_size: float) -> npt.NDArray:
@@ -332,6 +548,19 @@ def predict(
     return segmentations
 
 
+def ragged_array(nested: list[list]) -> npt.NDArray:
+    """
+    Packs a list of per-frame lists into a 1D object array indexed as array[mu][nu], np.asarray(nested, dtype=object) would instead
+    collapse equally sized frames of equally shaped arrays into one N-d object array of scalars
+    """
+
+    array = np.empty(len(nested), dtype=object)
+    for i, item in enumerate(nested):
+        array[i] = item
+
+    return array
+
+
 def crop_regions_predict(
     dna_image_stack,
     phase_image_stack,
@@ -346,6 +575,7 @@ def crop_regions_predict(
     to_segment: bool = True,
     threshold_type: str = "single",
     iou_thresh: Optional[bool] = 0.85,
+    tophat_method: str = "separable",
 ):
     """
     Given a stack of flouresence microscopy images, D, and corresponding phase images, P, returns regions cropped from D and masks from P, for each cell
@@ -353,21 +583,21 @@ def crop_regions_predict(
     INPUTS:
            dna_image_stack: n-darray, an array of shape (frame_count, x, y) where each (x, y) frame in the first dimension corresponds to one image
            phase_image_stack: n-darray, an array of shape (frame_count, x, y) where each (x, y) frame in the first dimension corresponds to one image
-           box_size: 1/2 the side length of boxes to be cropped from the input image
+           box_size: tuple, (func, args) where func(frame_props, *args) returns 1/2 the side length of boxes to be cropped from the input image,
+                     either one value for the whole frame or an array with one value per cell
            predictor: SAM, predicitive algorithm for segmenting cells
            threshold_division: float or int
             sigma: float or int
+           tophat_method: str, backend passed to fast_tophat
 
 
     OUTPUTS:
             dna_regions: list, rank 4 tensor of cropped roi's which can be indexed as dna_regions[mu][nu] where mu is the frame number and nu is the cell number
             discarded_box_counter: n-darray, vector of integers corresponding to the number of roi's that had to be discarded due to 'incomplete' bounding boxes
             i.e. spilling out of the image. can be indexed as discarded_box_counter[mu] where mu is the frame number
-            image_region_props: skimage object, region properties for each frame as computed by skimage
-            segmentations: rank 4 tensor containing one mask per cell per frame. It can be indexed as segmentations[mu][nu] where mu is the frame number and nu is the cell number
-                           Note: segmentations must converted back to masks in the following way
-                                1) mask = np.unpackbits(instance.segmentations[1][i], axis = 0, count = 2048)
-                                2) mask = np.array([mask])
+            image_region_props: dict, one columnar property table per frame as returned by preprocess_3d
+            segmentations: PackedMasks, one bit-packed mask per cell per frame. It can be indexed as segmentations[mu][nu] where mu is the frame number and nu is the cell number,
+                           segmentations.mask(mu, nu) returns the unpacked mask. Of every pair of masks with iou >= iou_thresh the smaller is dropped
     """
     try:
         assert dna_image_stack.shape[0] == phase_image_stack.shape[0]
@@ -398,12 +628,28 @@ def crop_regions_predict(
         threshold_type,
         erosionstruct,
         tophatstruct,
+        tophat_method,
     )
 
     for i, _ in enumerate(dna_image_region_props):  # for each image
 
         frame_props = dna_image_region_props[f"Frame_{i}"]
         box_sizes = box_size_wrapper(box_size_func, frame_props, box_size_args)
+        centroids_y = prop_column(frame_props, "centroid-0")
+        centroids_x = prop_column(frame_props, "centroid-1")
+        box_sizes = np.broadcast_to(box_sizes, centroids_x.shape)
+        frame_boxes = np.stack(
+            [
+                centroids_x - box_sizes,  # x1
+                centroids_y - box_sizes,  # y2
+                centroids_x + box_sizes,  # x2
+                centroids_y + box_sizes,  # y1
+            ],
+            axis=1,
+        )
+        num_cells = frame_boxes.shape[0]
+        dna_image = Image.fromarray(dna_image_stack[i, :, :])
+        phs_image = Image.fromarray(phase_image_stack[i, :, :])
         dna_regions_temp = []
         phs_regions_temp = []
         segmentations_temp = []
@@ -411,22 +657,14 @@ def crop_regions_predict(
         sam_current_image = i
         sam_previous_image = None
 
-        for j, _ in enumerate(dna_image_region_props[f"Frame_{i}"]):  # for each cell
+        for j in range(num_cells):  # for each cell
 
-            y, x = frame_props[j].centroid
-            if isinstance(box_sizes, list):
-                box_sizes = box_sizes[j]
+            x, y = centroids_x[j], centroids_y[j]
+            coords_temp = frame_boxes[j].tolist()
 
-            x1, y1 = x - box_sizes, y + box_sizes  # top left
-            x2, y2 = x + box_sizes, y - box_sizes  # bottom right
-
-            coords_temp = [x1, y2, x2, y1]
-
-            dna_image = Image.fromarray(dna_image_stack[i, :, :])
-            dna_region = np.asarray(dna_image.crop((x1, y2, x2, y1)))
+            dna_region = np.asarray(dna_image.crop(tuple(coords_temp)))
             dna_regions_temp.append(dna_region)
-            phs_image = Image.fromarray(phase_image_stack[i, :, :])
-            phs_region = np.asarray(phs_image.crop((x1, y2, x2, y1)))
+            phs_region = np.asarray(phs_image.crop(tuple(coords_temp)))
             phs_regions_temp.append(phs_region)
 
             if to_segment == True:
@@ -449,9 +687,7 @@ def crop_regions_predict(
                     else:
                         discarded_box_counter[i] += 1
 
-                    if len(boxes) == batch_size or (j + 1) == len(
-                        dna_image_region_props[f"Frame_{i}"]
-                    ):
+                    if len(boxes) == batch_size or (j + 1) == num_cells:
                         masks = predict(
                             predictor,
                             phase_image_rgb,
@@ -473,10 +709,14 @@ def crop_regions_predict(
                     )
                     segmentations_temp.append(mask)
 
-        segmentations_temp, poped_indices = iou_with_list(
-            segmentations_temp, iou_thresh
+        poped_indices = overlapping_masks(
+            np.asarray(segmentations_temp, dtype="uint8"),
+            phase_image_stack.shape[1],
+            iou_thresh,
+        )
+        segmentations.append(
+            [seg for i, seg in enumerate(segmentations_temp) if i not in poped_indices]
         )
-        segmentations.append(segmentations_temp)
         dna_regions_temp = [
             roi for i, roi in enumerate(dna_regions_temp) if i not in poped_indices
         ]
@@ -487,9 +727,9 @@ def crop_regions_predict(
         dna_regions.append(dna_regions_temp)
         phs_regions.append(phs_regions_temp)
 
-    dna_regions = np.asarray(dna_regions, dtype=object)
-    phs_regions = np.asarray(phs_regions, dtype=object)
-    segmentations = np.asarray(segmentations, dtype=object)
+    dna_regions = ragged_array(dna_regions)
+    phs_regions = ragged_array(phs_regions)
+    segmentations = PackedMasks.from_frames(segmentations, phase_image_stack.shape[1:])
 
     return (
         dna_regions,
@@ -501,13 +741,13 @@ def crop_regions_predict(
 
 
 def counter(
-    image_region_props: skimage.measure.regionprops, discarded_box_counter: npt.NDArray
+    image_region_props: dict, discarded_box_counter: npt.NDArray
 ) -> tuple[float, npt.NDArray]:
     """
     Counts the number of cells per frame and number of frames processed through either crop_regions or crop_regions_predict
     ------------------------------------------------------------------------------------------------------------------------
     INPUTS:
-      image_region_props: skimage.measure.region_rops, initial region props dictionary generated within the crop_regions function
+      image_region_props: dict, per-frame property tables generated by preprocess_3d within the crop_regions function
       discarded_box_counter: vector of integers corresponding to the number of roi's that had to be discarded due to 'incomplete' bounding boxes
                              i.e. spilling out of the image. can be indexed as discarded_box_counter[mu] where mu is the frame number
 
@@ -518,7 +758,10 @@ def counter(
 
     frame_count = len(list(image_region_props))
     cell_count = [
-        int(len(image_region_props[f"Frame_{i}"]) - discarded_box_counter[i])
+        int(
+            len(prop_column(image_region_props[f"Frame_{i}"], "label"))
+            - discarded_box_counter[i]
+        )
         for i in range(frame_count)
     ]
 
@@ -526,6 +769,63 @@ def counter(
     return frame_count, cell_count
 
 
+def iter_chunks(func, items: list, num_workers: int = 1, chunk_size: int = 64, executor: Optional[Executor] = None):
+    "Yields func(chunk) for consecutive chunks of items, in order, across a process pool if num_workers > 1, see chunked_map()"
+
+    chunks = [items[k : k + chunk_size] for k in range(0, len(items), chunk_size)]
+    if executor != None and len(chunks) > 1:
+        yield from executor.map(func, chunks)
+    elif num_workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            yield from executor.map(func, chunks)
+    else:
+        for chunk in chunks:
+            yield func(chunk)
+
+
+def chunked_map(
+    func, items: list, num_workers: int = 1, chunk_size: int = 64, executor: Optional[Executor] = None
+) -> list:
+    """
+    Applies func to consecutive chunks of items, across a process pool if num_workers > 1, and returns the flattened results in order
+    -----------------------------------------------------------------------------------------------------------------------------------
+    INPUTS:
+        func: callable, takes a list of items and returns a list of results of the same length, must be picklable if num_workers > 1
+        items: list
+        num_workers: int, number of worker processes, 1 runs in the calling process
+        chunk_size: int, number of items sent to a worker at once
+        executor: Executor, existing pool to run on instead of starting one per call, num_workers is then ignored
+    OUTPUTS:
+        results: list, one result per item
+    """
+
+    return list(itertools.chain.from_iterable(iter_chunks(func, items, num_workers, chunk_size, executor)))
+
+
+def clean_chunk(
+    rois: list[npt.NDArray],
+    threshold_division: float,
+    sigma: float,
+    threshold_type: str = "single",
+    tophat_method: str = "separable",
+) -> list[tuple[npt.NDArray, npt.NDArray, npt.NDArray]]:
+    "Cleans a chunk of ROIs for clean_regions, returns (labeled region, intensity region, mask) per ROI"
+
+    cleaned = []
+    for roi in rois:
+        mask = preprocess_2d(
+            roi,
+            threshold_division,
+            sigma,
+            threshold_type,
+            tophat_method=tophat_method,
+        )[1]
+        cleaned_mask = clear_border(mask)
+        cleaned.append((label(cleaned_mask), np.multiply(roi, cleaned_mask), cleaned_mask))
+
+    return cleaned
+
+
 def clean_regions(
     regions: npt.NDArray,
     frame_count: float,
@@ -533,6 +833,10 @@ def clean_regions(
     threshold_division: float,
     sigma: float,
     threshold_type: str = "single",
+    tophat_method: str = "separable",
+    num_workers: int = 1,
+    chunk_size: int = 64,
+    executor: Optional[Executor] = None,
 ) -> tuple[npt.NDArray, npt.NDArray, npt.NDArray]:
     """
     INPUTS:
@@ -542,6 +846,10 @@ def clean_regions(
                                  is only used in this function for the purposes of indexing
           threshold_division: float or int
           sigma: float or int
+          tophat_method: str, backend passed to fast_tophat
+          num_workers: int, number of worker processes ROIs are cleaned across
+          chunk_size: int, number of ROIs sent to a worker at once
+          executor: Executor, existing pool to clean across instead of starting one per call
 
     OUTPUTS:
            cleaned_regions: list, rank 4 tensor containing cleaned, binary DNA image ROIs, can be indexed as cleaned_regions[mu][nu] where mu represents the frame and nu represents the cell
@@ -552,33 +860,128 @@ def clean_regions(
     cleaned_regions = []
     cleaned_intensity_regions = []
 
+    rois = [regions[i][j] for i in range(frame_count) for j in range(int(cell_count[i]))]
+    cleaned = iter(
+        chunked_map(
+            partial(
+                clean_chunk,
+                threshold_division=threshold_division,
+                sigma=sigma,
+                threshold_type=threshold_type,
+                tophat_method=tophat_method,
+            ),
+            rois,
+            num_workers,
+            chunk_size,
+            executor,
+        )
+    )
+
     for i in range(frame_count):
         masks_temp = []
         cleaned_regions_temp = []
         cleaned_intensity_regions_temp = []
 
-        for j in range(int(cell_count[i])):
-            mask = preprocess_2d(
-                regions[i][j], threshold_division, sigma, threshold_type
-            )[1]
-            cleaned_mask = clear_border(mask)
-            cleaned_intensity_regions_temp.append(
-                np.multiply(regions[i][j], cleaned_mask)
-            )
-            cleaned_regions_temp.append(label(cleaned_mask))
+        for _ in range(int(cell_count[i])):
+            cleaned_region, cleaned_intensity_region, cleaned_mask = next(cleaned)
+            cleaned_intensity_regions_temp.append(cleaned_intensity_region)
+            cleaned_regions_temp.append(cleaned_region)
             masks_temp.append(cleaned_mask)
 
         masks.append(masks_temp)
         cleaned_regions.append(cleaned_regions_temp)
         cleaned_intensity_regions.append(cleaned_intensity_regions_temp)
 
-    masks = np.asarray(masks, dtype="object")
-    cleaned_regions = np.asarray(cleaned_regions, dtype="object")
-    cleaned_intensity_regions = np.asarray(cleaned_intensity_regions, dtype="object")
+    masks = ragged_array(masks)
+    cleaned_regions = ragged_array(cleaned_regions)
+    cleaned_intensity_regions = ragged_array(cleaned_intensity_regions)
 
     return cleaned_regions, cleaned_intensity_regions, masks
 
 
+def features_chunk(
+    rois: list[tuple[npt.NDArray, npt.NDArray]],
+    propslist: list[str],
+    extra_props: Optional[tuple] = None,
+) -> list[Optional[npt.NDArray]]:
+    "Computes the regionprops_table row of the first region in each (binary, intensity) ROI pair of a chunk, None for empty ROIs"
+
+    rows = []
+    for binary_roi, intensity_roi in rois:
+        if binary_roi.any() != 0:
+            props = regionprops_table(
+                binary_roi.astype("uint8"),
+                intensity_image=intensity_roi,
+                properties=propslist,
+                extra_properties=extra_props,
+            )
+            rows.append(np.asarray(list(props.values())).T[0])
+        else:
+            rows.append(None)
+
+    return rows
+
+
+def extract_features(
+    binary_regions: npt.NDArray,
+    intensity_regions: npt.NDArray,
+    frame_count: int,
+    cell_count: npt.NDArray,
+    propslist: list[str],
+    extra_props: Optional[tuple] = None,
+    num_workers: int = 1,
+    chunk_size: int = 64,
+    executor: Optional[Executor] = None,
+) -> tuple[npt.NDArray, npt.NDArray]:
+    """
+    Computes one row of region properties per cleaned ROI, in chunks across a worker pool, into a preallocated data frame
+    --------------------------------------------------------------------------------------------------------------------
+    INPUTS:
+        binary_regions: n-darray, cleaned binary ROIs as returned by clean_regions, indexed as binary_regions[mu][nu]
+        intensity_regions: n-darray, cleaned scalar ROIs as returned by clean_regions, indexed in the same manner
+        frame_count: int
+        cell_count: n-darray, number of ROIs in each frame
+        propslist: list, skimage properties to compute
+        extra_props: tuple, extra property functions passed to regionprops_table, must be picklable if num_workers > 1
+        num_workers: int, number of worker processes
+        chunk_size: int, number of ROIs sent to a worker at once
+        executor: Executor, existing pool to compute across instead of starting one per call
+    OUTPUTS:
+        data_frame: n-darray, one row per non-empty ROI, the last two coloumns are the [frame, cell] tracker
+        empty_counter: n-darray, number of empty ROIs skipped in each frame
+    """
+
+    trackers = [(i, j) for i in range(frame_count) for j in range(int(cell_count[i]))]
+    chunks = iter_chunks(
+        partial(features_chunk, propslist=propslist, extra_props=extra_props),
+        [(binary_regions[i][j], intensity_regions[i][j]) for i, j in trackers],
+        num_workers,
+        chunk_size,
+        executor,
+    )
+
+    # rows are written into the frame as each chunk arrives, the frame is allocated once the first row gives its width
+    empty_counter = np.zeros(frame_count, dtype=int)
+    data_frame = None
+    k, num_rows = 0, 0
+    for rows in chunks:
+        for row in rows:
+            if row is None:
+                empty_counter[trackers[k][0]] += 1
+            else:
+                if data_frame is None:
+                    data_frame = np.empty((len(trackers), row.shape[0] + 2))
+                data_frame[num_rows, :-2] = row
+                data_frame[num_rows, -2:] = trackers[k]
+                num_rows += 1
+            k += 1
+
+    if data_frame is None:
+        return np.asarray([]), empty_counter
+
+    return data_frame[:num_rows], empty_counter
+
+
 def add_labels(data_frame: npt.NDArray, labels: npt.NDArray) -> npt.NDArray:
     """
     Adds labels to a dataframe in the labels and dataframe are of the same dimension and have the same number of rows
@@ -603,43 +1006,14 @@ def add_labels(data_frame: npt.NDArray, labels: npt.NDArray) -> npt.NDArray:
 def binImage(img: npt.NDArray, new_shape: tuple, method: str = "mean") -> npt.NDArray:
     """
     img = Original asarray to be binned
-    new_shape = final desired shape of the asarray
+    new_shape = final desired shape of the asarray, need not divide the shape of img
     method = 'min' - minimum binned
              'max' - max. binned
              'mean' - mean binned; default
+             'area' - cv2 INTER_AREA, keeps the dtype of img
+    See resample.resample()
     """
-    if len(img.shape) == 3:
-        shape = (
-            new_shape[0],
-            img.shape[0] // new_shape[0],
-            new_shape[1],
-            img.shape[1] // new_shape[1],
-            3,
-        )
-        index0 = -2
-        index1 = 1
-    elif len(img.shape) == 2:
-        shape = (
-            new_shape[0],
-            img.shape[0] // new_shape[0],
-            new_shape[1],
-            img.shape[1] // new_shape[1],
-        )
-        index0 = -1
-        index1 = 1
-    else:
-        print(
-            "Input image must be either RGB like, (3 dimensional) or black and white (2 dimensional)"
-        )
-        return
-    img = img.reshape(shape)
-    if method == "min":
-        out = img.min(index0).min(index1)
-    elif method == "max":
-        out = img.max(index0).max(index1)
-    elif method == "mean":
-        out = img.mean(index0).mean(index1)
-    return out
+    return resample(img, new_shape, method)
 
 
 def write_clusters(
@@ -675,24 +1049,14 @@ def write_clusters(
 
 def square_reshape(img: npt.NDArray, desired_shape: tuple) -> npt.NDArray:
     """ "
-    Reshapes a square image
-    -----------------------
+    Reshapes an image of any shape to desired_shape, larger images are mean binned to fit and the remainder is padded with the image mean
+    ---------------------------------------------------------------------------------------------------------------------------------------
     INPUTS:
         image: npt.NDArray
         desired_shape: tuple
     OUTPUTS:
         image: npt.NDArray
+    Use resample.fit_to_shape() to also get the transform mapping coordinates back to img
     """
-
-    if img.shape[0] < desired_shape[0]:
-        qdiff = (2048 - img.shape[0]) // 4
-        img = np.pad(
-            img,
-            [(qdiff, qdiff), (qdiff, qdiff), (0, 0)],
-            mode="constant",
-            constant_values=img.mean(),
-        )
-    elif img.shape[0] > desired_shape[0]:
-        img = binImage(img, desired_shape)
-
+    img, _ = fit_to_shape(img, desired_shape[:2], method="mean")
     return img
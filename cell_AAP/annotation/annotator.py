@@ -1,12 +1,70 @@
+import os
 import re
 import numpy as np
 import tifffile as tiff
+from concurrent.futures import ProcessPoolExecutor
 from skimage.measure import regionprops_table
 from annotation_utils import *
 from typing import Optional
 from cell_AAP import configs #type: ignore
 
 
+def iter_frames(image_list: list[str], frame_step: int = 1):
+    """
+    Lazily yields the frames of every file in image_list, one 2D array at a time
+    -----------------------------------------------------------------------------
+    INPUTS:
+        image_list: list[str], paths to tiff movies or single images
+        frame_step: int, only every frame_step-th page of each tiff movie is read from disk
+    """
+
+    for image_path in image_list:
+        if (re.search(r"^.+\.(?:(?:[tT][iI][fF][fF]?)|(?:[tT][iI][fF]))$", str(image_path))== None):
+            yield cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
+            continue
+
+        with tiff.TiffFile(image_path) as tif:
+            series = tif.series[0]
+            if len(series.pages) > 1:
+                for page in series.pages[0::frame_step]:
+                    yield page.asarray()
+            else:
+                frames = series.asarray()
+                if frames.ndim == 2:
+                    yield frames
+                else:
+                    yield from frames[0::frame_step]
+
+
+def read_store_features(store_dir: str) -> np.ndarray:
+    """
+    Concatenates the feature rows of every frame written by Annotator.stream(), the last two coloumns are the [frame, cell] tracker
+    --------------------------------------------------------------------------------------------------------------------------------
+    """
+
+    frame_files = sorted(
+        (f for f in os.listdir(store_dir) if re.search(r"^frame_\d+\.npz$", f) != None),
+        key=lambda f: int(re.search(r"\d+", f).group()),
+    )
+    features = []
+    for frame_file in frame_files:
+        with np.load(os.path.join(store_dir, frame_file)) as frame_store:
+            if frame_store["features"].shape[0] != 0:
+                features.append(frame_store["features"])
+
+    return np.concatenate(features, axis=0) if features else np.zeros((0, 0))
+
+
+def read_store_frame(store_dir: str, frame: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the feature rows and bit-packed segmentations (indexed as segmentations[cell]) of one frame written by Annotator.stream()
+    ---------------------------------------------------------------------------------------------------------------------------------
+    """
+
+    with np.load(os.path.join(store_dir, f"frame_{frame}.npz")) as frame_store:
+        return frame_store["features"], frame_store["segmentations"]
+
+
 class Annotator:
     def __init__(
         self,
@@ -85,6 +143,25 @@ class Annotator:
             configs,
         )
 
+    @classmethod
+    def get_streaming(cls, configs:configs.Cfg, dna_image_list:list[str], phase_image_list:list[str]):
+        "Instantiates an Annotator that reads frames lazily in stream(), no image stacks are loaded"
+
+        try:
+            assert len(dna_image_list) == len(phase_image_list)
+        except Exception as error:
+            raise AssertionError(
+                "dna_image_list and phase_image_list must be of the same length (number of files)"
+            ) from error
+
+        return cls(
+            dna_image_list,
+            None,
+            phase_image_list,
+            None,
+            configs,
+        )
+
     @property
     def dna_image_list(self):
         return self._dna_image_list
@@ -103,7 +180,7 @@ class Annotator:
 
     def crop(self, predictor=None):
         if predictor == None:
-            self.to_segment == False
+            self.to_segment = False
         (
             self.roi,
             self.discarded_box_counter,
@@ -123,18 +200,99 @@ class Annotator:
             self.configs.box_prompts,
             self.to_segment,
             self.configs.threshold_type,
-            self.configs.iou_thresh
+            self.configs.iou_thresh,
+            self.configs.tophat_method,
         )
 
         self.frame_count, self.cell_count = counter(
             region_props_stack, self.discarded_box_counter
         )
         self.cleaned_binary_roi, self.cleaned_scalar_roi, self.masks = clean_regions(
-            self.roi, self.frame_count, self.cell_count, self.configs.threshold_division, self.configs.gaussian_sigma, self.configs.threshold_type
+            self.roi, self.frame_count, self.cell_count, self.configs.threshold_division, self.configs.gaussian_sigma, self.configs.threshold_type, self.configs.tophat_method, self.configs.num_workers
         )
         self.cropped = True
         return self
 
+    def stream(self, store_dir: str, predictor=None, extra_props=None):
+        """
+        Streaming alternative to crop() followed by gen_df(), memory stays bounded by one frame regardless of the number of movies
+        ----------------------------------------------------------------------------------------------------------------------------
+        INPUTS:
+            store_dir: str, directory that one 'frame_{i}.npz' file per frame is written to, containing
+                       features: the gen_df() rows of the frame, the last two coloumns are the [frame, cell] tracker
+                       segmentations: bit-packed SAM masks of the frame, indexed as segmentations[cell] (empty if predictor is None)
+            predictor: SAM, predicitive algorithm for segmenting cells
+            extra_props: tuple, extra property functions passed to regionprops_table
+
+        Frames are read lazily from dna_image_list and phase_image_list with frame_step applied at read time, frame numbers are
+        global across movies as in get(). Use read_store_features() and read_store_frame() to read the store back, frame files
+        already in store_dir are removed first.
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        # frames left by an earlier, longer run would otherwise be read back with this one
+        for f in os.listdir(store_dir):
+            if re.search(r"^frame_\d+\.npz$", f) != None:
+                os.remove(os.path.join(store_dir, f))
+
+        to_segment = predictor != None
+        cell_count = []
+
+        frames = zip(
+            iter_frames(self.dna_image_list, self.configs.frame_step),
+            iter_frames(self.phase_image_list, self.configs.frame_step),
+        )
+        # one pool serves every frame, starting one per clean_regions / extract_features call would cost more than it saves
+        executor = ProcessPoolExecutor(max_workers=self.configs.num_workers) if self.configs.num_workers > 1 else None
+        try:
+            for frame, (dna_frame, phase_frame) in enumerate(frames):
+                roi, discarded_box_counter, region_props, segmentations, _ = crop_regions_predict(
+                    dna_frame[np.newaxis],
+                    phase_frame[np.newaxis],
+                    predictor,
+                    self.configs.threshold_division,
+                    self.configs.gaussian_sigma,
+                    self.configs.erosionstruct,
+                    self.configs.tophatstruct,
+                    self.configs.box_size,
+                    self.configs.point_prompts,
+                    self.configs.box_prompts,
+                    to_segment,
+                    self.configs.threshold_type,
+                    self.configs.iou_thresh,
+                    self.configs.tophat_method,
+                )
+                _, frame_cell_count = counter(region_props, discarded_box_counter)
+                cleaned_binary_roi, cleaned_scalar_roi, _ = clean_regions(
+                    roi, 1, frame_cell_count, self.configs.threshold_division, self.configs.gaussian_sigma, self.configs.threshold_type, self.configs.tophat_method, executor=executor
+                )
+                features, empty_counter = extract_features(
+                    cleaned_binary_roi,
+                    cleaned_scalar_roi,
+                    1,
+                    frame_cell_count,
+                    self.configs.propslist,
+                    extra_props,
+                    executor=executor,
+                )
+                if features.shape[0] != 0:
+                    features[:, -2] = frame
+
+                np.savez(
+                    os.path.join(store_dir, f"frame_{frame}.npz"),
+                    features=features,
+                    segmentations=segmentations[0],
+                )
+                cell_count.append(int(frame_cell_count[0] - empty_counter[0]))
+        finally:
+            if executor != None:
+                executor.shutdown()
+
+        self.frame_count = len(cell_count)
+        self.cell_count = np.asarray(cell_count)
+        self.store_dir = store_dir
+        self.cropped = self.df_generated = True
+        return self
+
 
     def gen_df(self, extra_props):
         """
@@ -149,7 +307,8 @@ class Annotator:
             cleaned_intensity_regions: list, rank 4 tensor containing cleaned, sclar valued DNA image ROIs, can be indexed in the same manner as cleaned_regions
 
         OUTPUTS:
-            main_df: a vectorized dataframe containing the values for each property for each cell in 'cleaned_regions'. The dataframe stores no knowledge of the frame from which a cell came.
+            main_df: a vectorized dataframe containing the values for each property for each cell in 'cleaned_regions', the last two coloumns are the [frame, cell] tracker.
+                     Rows are computed in chunks across self.configs.num_workers processes, extra_props must then be picklable (module level functions).
         """
         try:
             assert self.cropped == True
@@ -168,25 +327,15 @@ class Annotator:
                 "cell_count must contain the same number of frames as specified by frame_count"
             ) from error
 
-        main_df = []
-
-        for i in range(self.frame_count):
-            for j in range(self.cell_count[i]):
-                if self.cleaned_binary_roi[i][j].any() != 0:
-                    props = regionprops_table(
-                        self.cleaned_binary_roi[i][j].astype("uint8"),
-                        intensity_image=self.cleaned_scalar_roi[i][j],
-                        properties=self.configs.propslist,
-                        extra_properties=extra_props,
-                    )
-
-                    df = np.asarray(list(props.values())).T[0]
-                    tracker = [i, j]
-                    df = np.append(df, tracker)
-                    main_df.append(df)
-
-                else:
-                    self.cell_count[i] -= 1
-                    pass
+        main_df, empty_counter = extract_features(
+            self.cleaned_binary_roi,
+            self.cleaned_scalar_roi,
+            self.frame_count,
+            self.cell_count,
+            self.configs.propslist,
+            extra_props,
+            self.configs.num_workers,
+        )
+        self.cell_count -= empty_counter
 
-        return np.asarray(main_df)
+        return main_df
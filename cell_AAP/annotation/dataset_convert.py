@@ -1,8 +1,11 @@
+import argparse
 import datetime
 import json
 import os
 import re
 import fnmatch
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
 from PIL import Image
 import numpy as np
 from pycococreator.pycococreatortools import pycococreatortools
@@ -60,7 +63,67 @@ def filter_for_annotations(root, files, image_filename):
 
     return files
 
-def main():
+def index_annotations(annotation_dir):
+    """
+    Walks annotation_dir once and indexes every png annotation under each of its underscore delimited prefixes,
+    i.e. '12_mitotic_frame12cell3.png' is indexed under '12' and '12_mitotic'. index[image basename without extension]
+    then holds exactly the files filter_for_annotations would have matched for that image.
+    """
+    file_types = r'|'.join([fnmatch.translate(x) for x in ['*.png']])
+    index = {}
+    for root, _, files in os.walk(annotation_dir):
+        for f in sorted(files):
+            annotation_filename = os.path.join(root, f)
+            if not re.match(file_types, annotation_filename):
+                continue
+            parts = os.path.splitext(f)[0].split('_')
+            for i in range(1, len(parts)):
+                index.setdefault('_'.join(parts[:i]), []).append(annotation_filename)
+
+    return index
+
+def convert_image(job):
+    """
+    Builds the image info and annotation infos of one image, ids are placeholders that are reassigned when results are merged.
+    Returns (image_info, annotation_infos) where annotation_infos holds None for masks pycococreator could not convert.
+    """
+    image_filename, annotation_files = job
+    image = Image.open(image_filename)
+    image_info = pycococreatortools.create_image_info(
+        0, os.path.basename(image_filename), image.size)
+
+    annotation_infos = []
+    for annotation_filename in annotation_files:
+        class_id = [x['id'] for x in CATEGORIES if x['name'] in annotation_filename][0]
+        category_info = {'id': class_id, 'is_crowd': 'crowd' in image_filename}
+        binary_mask = np.asarray(Image.open(annotation_filename)
+            .convert('1')).astype(np.uint8)
+        annotation_infos.append(pycococreatortools.create_annotation_info(
+            0, 0, category_info, binary_mask,
+            image.size, tolerance=2))
+
+    return image_info, annotation_infos
+
+def main(
+    root_dir: str = ROOT_DIR,
+    image_dir: Optional[str] = None,
+    annotation_dir: Optional[str] = None,
+    output_path: Optional[str] = None,
+    num_workers: int = 1,
+):
+    """
+    Converts a directory of jpg images and png annotations written by dataset_write into a COCO json
+    ------------------------------------------------------------------------------------------------
+    INPUTS:
+        root_dir: str, dataset split directory
+        image_dir: str, defaults to root_dir/imagesbinned
+        annotation_dir: str, defaults to root_dir/annotationsbinned
+        output_path: str, defaults to root_dir/instances_cellseg_1.8_bin_val.json
+        num_workers: int, number of worker processes images are converted across
+    """
+    image_dir = image_dir or os.path.join(root_dir, 'imagesbinned')
+    annotation_dir = annotation_dir or os.path.join(root_dir, 'annotationsbinned')
+    output_path = output_path or os.path.join(root_dir, 'instances_cellseg_1.8_bin_val.json')
 
     coco_output = {
         "info": INFO,
@@ -70,50 +133,51 @@ def main():
         "annotations": []
     }
 
+    # filter for jpeg images, and index the png annotations once
+    image_files = []
+    for root, _, files in os.walk(image_dir):
+        image_files += filter_for_jpeg(root, sorted(files))
+    annotation_index = index_annotations(annotation_dir)
+    jobs = [
+        (image_filename, annotation_index.get(os.path.splitext(os.path.basename(image_filename))[0], []))
+        for image_filename in image_files
+    ]
+
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = executor.map(convert_image, jobs, chunksize=max(1, len(jobs) // (4 * num_workers)))
+            results = list(results)
+    else:
+        results = [convert_image(job) for job in jobs]
+
+    # merge per-image results, ids are assigned in image order so they do not depend on num_workers
     image_id = 1
     segmentation_id = 1
-    
-    # filter for jpeg images
-    for root, _, files in os.walk(IMAGE_DIR):
-        image_files = filter_for_jpeg(root, files)
-
-        # go through each image
-        for image_filename in image_files:
-            image = Image.open(image_filename)
-            image_info = pycococreatortools.create_image_info(
-                image_id, os.path.basename(image_filename), image.size)
-            coco_output["images"].append(image_info)
-
-            # filter for associated png annotations
-            for root, _, files in os.walk(ANNOTATION_DIR):
-                annotation_files = filter_for_annotations(root, files, image_filename)
-                # go through each associated annotation
-                i = 0
-                for annotation_filename in annotation_files:
-
-                    class_id = [x['id'] for x in CATEGORIES if x['name'] in annotation_filename][0]
-
-                    category_info = {'id': class_id, 'is_crowd': 'crowd' in image_filename}
-                    binary_mask = np.asarray(Image.open(annotation_filename)
-                        .convert('1')).astype(np.uint8) #debug
-    
-                    print(annotation_filename)
-                    annotation_info = pycococreatortools.create_annotation_info(
-                        segmentation_id, image_id, category_info, binary_mask,
-                        image.size, tolerance=2)
-
-                    if annotation_info is not None:
-                        coco_output["annotations"].append(annotation_info)
-                    else:
-                        i += 1
-
-                    segmentation_id = segmentation_id + 1
-                print(i)
-            image_id = image_id + 1
-
-    with open('{}/instances_cellseg_1.8_bin_val.json'.format(ROOT_DIR), 'w') as output_json_file:
+    for (image_filename, _), (image_info, annotation_infos) in zip(jobs, results):
+        image_info["id"] = image_id
+        coco_output["images"].append(image_info)
+        i = 0
+        for annotation_info in annotation_infos:
+            if annotation_info is not None:
+                annotation_info["id"] = segmentation_id
+                annotation_info["image_id"] = image_id
+                coco_output["annotations"].append(annotation_info)
+            else:
+                i += 1
+            segmentation_id = segmentation_id + 1
+        print(image_filename, i)
+        image_id = image_id + 1
+
+    with open(output_path, 'w') as output_json_file:
         json.dump(coco_output, output_json_file)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Converts jpg images and png annotations into a COCO json")
+    parser.add_argument("root_dir", nargs="?", default=ROOT_DIR)
+    parser.add_argument("--image-dir", default=None)
+    parser.add_argument("--annotation-dir", default=None)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--num-workers", type=int, default=1)
+    args = parser.parse_args()
+    main(args.root_dir, args.image_dir, args.annotation_dir, args.output, args.num_workers)
@@ -0,0 +1,196 @@
+import io
+import os
+import json
+import tarfile
+import numpy as np
+import numpy.typing as npt
+import torch
+from PIL import Image
+from typing import Optional
+from cell_AAP.annotation import annotation_utils  # type:ignore
+from cell_AAP.annotation.packed_masks import resolve_mask_height  # type:ignore
+
+
+def encode_array(array: npt.NDArray) -> bytes:
+    "Serializes an array in .npy format"
+
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def add_member(tar: tarfile.TarFile, name: str, data: bytes):
+    "Appends one in-memory file to an open tar archive"
+
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_dataset_shards(
+    parent_dir: str,
+    phase_image_stack,
+    segmentations,
+    labeled_data_frame,
+    name: str,
+    label_to_class: dict,
+    bin_size: tuple = (1024, 1024),
+    bin_method: str = "max",
+    train_cutoff: Optional[int] = None,
+    shard_size: int = 64,
+    mask_height: Optional[int] = None,
+) -> dict[str, list[str]]:
+    """
+    Packs binned images, masks and labels into a few large tar shards that can be read sequentially, one sample per frame
+    ----------------------------------------------------------------------------------------------------------------------
+    INPUTS:
+            parent_dir: string, directory which the dataset folder is to be created within
+            phase_image_stack: n-darray, array containing phase images from which annotions come from
+            segmentations: n-darray, rank 4 tensor indexed as segmentations[mu][nu] where mu references a frame and nu a cell:
+                          contains bit-packed masks (np.packbits(mask, axis = 0)) with each mask corresponding to an annotation, a PackedMasks store or nested lists
+            labeled_data_frame: n-darray, dataframe containing region props and classifications for each cell, the last three coloumns are [frame, cell, label]
+            name: string, name of dataset to be created
+            label_to_class: dict, dictionary containing int to string key value pairs, rows whose label is not a key are skipped
+            train_cutoff: int, frames >= train_cutoff go to the train split, the rest to the test split, as in dataset_write.write_dataset_percent
+            shard_size: int, number of frames per shard
+            mask_height: int, number of rows of the unpacked masks, only used for nested segmentations lists (defaults to 2048), PackedMasks carry their own
+    OUTPUTS:
+            shard_paths: dict, list of shard paths for each split
+
+    Each sample is stored as four members sharing the key '{frame:06d}':
+        .jpg: the binned phase image, byte for byte what dataset_write writes as '{frame}.jpg'
+        .masks.npy: binned masks (n, h, w), bit-packed along axis 1 as binImage(mask) > 0, so with bin_method 'max' (or 'min') they
+                    unpack * 255 to the pngs dataset_write writes, while with 'mean' the pngs keep fractional edge bins and here every
+                    bin the mask touches is set
+        .labels.npy: label of each mask
+        .cells.npy: cell index of each mask, as in segmentations[frame][cell]
+    """
+    mask_height = resolve_mask_height(segmentations, mask_height)
+    if train_cutoff == None:
+        train_cutoff = labeled_data_frame[-int(labeled_data_frame.shape[0] // (10 / 7)), -3]
+
+    main_path = os.path.join(parent_dir, f"{name}")
+    os.mkdir(main_path)
+    with open(os.path.join(main_path, "classes.json"), "w") as classes_file:
+        json.dump({str(key): value for key, value in label_to_class.items()}, classes_file)
+
+    labels = labeled_data_frame[:, -1].astype(int)
+    rows = np.flatnonzero(np.isin(labels, list(label_to_class.keys())))
+    rows = rows[np.argsort(labeled_data_frame[rows, -3], kind="stable")]
+    frames = labeled_data_frame[rows, -3].astype(int)
+    frame_starts = np.searchsorted(frames, np.arange(int(labeled_data_frame[:, -3].max()) + 2))
+
+    shard_paths = {"train": [], "test": []}
+    open_shards = {}
+    shard_counts = {"train": 0, "test": 0}
+    try:
+        for k in range(frame_starts.shape[0] - 1):
+            split = "train" if k >= train_cutoff else "test"
+            if shard_counts[split] % shard_size == 0:
+                if split in open_shards:
+                    open_shards[split].close()
+                shard_path = os.path.join(
+                    main_path, f"{split}-{shard_counts[split] // shard_size:05d}.tar"
+                )
+                open_shards[split] = tarfile.open(shard_path, "w")
+                shard_paths[split].append(shard_path)
+            shard_counts[split] += 1
+
+            image = annotation_utils.binImage(
+                annotation_utils.bw_to_rgb(phase_image_stack[k]), bin_size, bin_method
+            )
+            image_buffer = io.BytesIO()
+            Image.fromarray(image).save(image_buffer, format="JPEG")
+
+            frame_rows = rows[frame_starts[k] : frame_starts[k + 1]]
+            cells = labeled_data_frame[frame_rows, -2].astype(int)
+            masks = [
+                annotation_utils.binImage(
+                    np.unpackbits(segmentations[k][cell], axis=0, count=mask_height) * 255,
+                    bin_size,
+                    bin_method,
+                )
+                for cell in cells
+            ]
+            # bits hold > 0, fractional 'mean' bins are set rather than kept as in the pngs
+            masks = (
+                np.packbits(np.asarray(masks) > 0, axis=1)
+                if masks
+                else np.zeros((0, -(-bin_size[0] // 8), bin_size[1]), dtype="uint8")
+            )
+
+            tar = open_shards[split]
+            add_member(tar, f"{k:06d}.jpg", image_buffer.getvalue())
+            add_member(tar, f"{k:06d}.masks.npy", encode_array(masks))
+            add_member(tar, f"{k:06d}.labels.npy", encode_array(labels[frame_rows]))
+            add_member(tar, f"{k:06d}.cells.npy", encode_array(cells))
+    finally:
+        for tar in open_shards.values():
+            tar.close()
+
+    return shard_paths
+
+
+def unpack_masks(packed: npt.NDArray, height: int) -> npt.NDArray:
+    "Unpacks shard masks back to (n, h, w) uint8 arrays with values 0 and 255"
+
+    return np.unpackbits(packed, axis=1, count=height) * np.uint8(255)
+
+
+def decode_sample(frame: int, fields: dict[str, bytes], decode: bool = True) -> dict:
+    "Builds one sample from the raw members of a shard sharing the key '{frame:06d}'"
+
+    image = Image.open(io.BytesIO(fields["jpg"]))
+    return {
+        "frame": frame,
+        "image": np.asarray(image) if decode else fields["jpg"],
+        "masks": unpack_masks(np.load(io.BytesIO(fields["masks.npy"])), image.size[1]),
+        "labels": np.load(io.BytesIO(fields["labels.npy"])),
+        "cells": np.load(io.BytesIO(fields["cells.npy"])),
+    }
+
+
+def iter_shards(shard_paths: list[str], decode: bool = True):
+    """
+    Sequentially reads samples written by write_dataset_shards
+    -----------------------------------------------------------
+    INPUTS:
+            shard_paths: list[str], shards to read, in order
+            decode: bool, if False the jpg is yielded as raw bytes
+    OUTPUTS:
+            yields dicts with keys
+                frame: int
+                image: n-darray (h, w, 3) uint8 or bytes
+                masks: n-darray (n, h, w) uint8 with values 0 and 255
+                labels: n-darray (n,)
+                cells: n-darray (n,)
+    """
+    for shard_path in shard_paths:
+        frame, fields = None, {}
+        with tarfile.open(shard_path, "r|") as tar:
+            for member in tar:
+                key, field = member.name.split(".", 1)
+                if frame != None and int(key) != frame:
+                    yield decode_sample(frame, fields, decode)
+                    fields = {}
+                frame = int(key)
+                fields[field] = tar.extractfile(member).read()
+        if fields:
+            yield decode_sample(frame, fields, decode)
+
+
+class ShardDataset(torch.utils.data.IterableDataset):
+    "Iterable training dataset over shards written by write_dataset_shards, shards are divided between DataLoader workers"
+
+    def __init__(self, shard_paths: list[str], decode: bool = True):
+        super().__init__()
+        self.shard_paths = sorted(shard_paths)
+        self.decode = decode
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        shard_paths = self.shard_paths
+        if worker_info is not None:
+            shard_paths = shard_paths[worker_info.id :: worker_info.num_workers]
+
+        return iter_shards(shard_paths, self.decode)
@@ -1,11 +1,70 @@
 import os
 import cv2
+import json
+import datetime
 from PIL import Image
 import numpy as np
+import numpy.typing as npt
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
 # TODO
 # cannot import this module without installing cell-AAP, this should not be the case, throws "no module 'cell-AAP' error"
 from cell_AAP.annotation import annotation_utils  # type:ignore
+from cell_AAP.annotation.packed_masks import mask_to_rle, resolve_mask_height  # type:ignore
+
+
+def write_mask(
+    packed_mask: npt.NDArray,
+    path: str,
+    bin_size: tuple = (1024, 1024),
+    bin_method: str = "max",
+    mask_height: int = 2048,
+):
+    "Unpacks, bins and writes one annotation mask as a png"
+
+    mask = np.unpackbits(packed_mask, axis=0, count=mask_height)
+    mask = mask * 255
+    mask = annotation_utils.binImage(mask, bin_size, bin_method)
+    cv2.imwrite(path, mask)
+
+
+def write_image(
+    image: npt.NDArray,
+    path: str,
+    bin_size: tuple = (1024, 1024),
+    bin_method: str = "max",
+):
+    "Converts, bins and writes one phase image as a jpg"
+
+    image = annotation_utils.binImage(
+        annotation_utils.bw_to_rgb(image), bin_size, bin_method
+    )
+    Image.fromarray(image).save(path)
+
+
+def run_jobs(jobs: list[tuple], num_workers: Optional[int] = None):
+    """
+    Runs (func, *args) jobs across a thread pool, decoding, binning and encoding all release the GIL
+    ------------------------------------------------------------------------------------------------
+    INPUTS:
+            jobs: list of tuples, (func, *args)
+            num_workers: int, number of threads, defaults to ThreadPoolExecutor's default, 1 runs in the calling thread
+    """
+    if num_workers == 1:
+        for func, *args in jobs:
+            func(*args)
+        return
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(func, *args) for func, *args in jobs]
+        for future in futures:
+            future.result()
+
+
+def annotation_name(frame: int, cell: int, class_name: str) -> str:
+    "Standard annotation file name, '{frame}_{class_name}_frame{frame}cell{cell}.png'"
+
+    return f"{frame}_{class_name}_frame{frame}cell{cell}.png"
 
 
 def write_dataset_percent(
@@ -17,7 +76,9 @@ def write_dataset_percent(
     label_to_class: dict,
     bin_size: tuple = (1024, 1024),
     bin_method: str = "max",
-    train_cutoff: Optional[int] = None
+    train_cutoff: Optional[int] = None,
+    num_workers: Optional[int] = None,
+    mask_height: Optional[int] = None,
 ):
     """
     Saves annotations(masks) and images in a manner that can be converted to COCO format using common tools
@@ -26,13 +87,16 @@ def write_dataset_percent(
             parent_dir: string, directory which folders are to be created within
             phase_image_stack: n-darray, array containing phase images from which annotions come from
             segmentations: n-darray, rank 4 tensor indexed as segmentations[mu][nu] where mu references a frame and nu a cell:
-                          contains masks with each mask corresponding to an annotation. (Must be unpacked from bitmap repr)
+                          contains bit-packed masks with each mask corresponding to an annotation, a PackedMasks store or nested lists
             labeled_data_frame: n-darray, dataframe containing region props and classifications for each cell
             name: string, name of dataset to be created
             label_to_class: dict, dictionary containing int to string key value pairs, specifying what number classification corresponds to
                                   what verbal classification, i.e 0-> mitotic
+            num_workers: int, number of threads masks and images are decoded, binned and written across
+            mask_height: int, number of rows of the unpacked masks, only used for nested segmentations lists (defaults to 2048), PackedMasks carry their own
 
     """
+    mask_height = resolve_mask_height(segmentations, mask_height)
     if train_cutoff == None:
         train_cutoff = labeled_data_frame[-int(labeled_data_frame.shape[0] // (10 / 7)), -3]
     else:
@@ -40,57 +104,49 @@ def write_dataset_percent(
 
     main_path = os.path.join(parent_dir, f"{name}")
     os.mkdir(main_path)
-    os.chdir(main_path)
     train_path = os.path.join(main_path, "train")
     test_path = os.path.join(main_path, "test")
 
     for i in [train_path, test_path]:
         os.mkdir(i)
-        os.chdir(i)
-        image_path = os.path.join(i, "images")
-        os.mkdir(image_path)
-        annotation_path = os.path.join(i, "annotations")
-        os.mkdir(annotation_path)
+        os.mkdir(os.path.join(i, "images"))
+        os.mkdir(os.path.join(i, "annotations"))
 
+    jobs = []
     for j in range(labeled_data_frame.shape[0]):
-        if labeled_data_frame[j, -3] >= train_cutoff:
-            os.chdir(os.path.join(train_path, "annotations"))
-        else:
-            os.chdir(os.path.join(test_path, "annotations"))
-
-        mask = np.unpackbits(
-            segmentations[int(labeled_data_frame[j, -3])][
-                int(labeled_data_frame[j, -2])
-            ],
-            axis=0,
-            count=2048,
-        )
-        mask = mask * 255
-        mask = annotation_utils.binImage(mask, bin_size, bin_method)
+        frame, cell = int(labeled_data_frame[j, -3]), int(labeled_data_frame[j, -2])
         if labeled_data_frame[j, -1] == 0:
-            cv2.imwrite(
-                f"{int(labeled_data_frame[j, -3])}_{label_to_class[0]}_frame{int(labeled_data_frame[j, -3])}cell{int(labeled_data_frame[j, -2])}.png",
-                mask,
-            )
+            class_name = label_to_class[0]
         elif labeled_data_frame[j, -1] in [1, 2]:
-            cv2.imwrite(
-                f"{int(labeled_data_frame[j, -3])}_{label_to_class[1]}_frame{int(labeled_data_frame[j, -3])}cell{int(labeled_data_frame[j, -2])}.png",
-                mask,
-            )
-
-    for k in range(int(max(labeled_data_frame[:, -3]))):
-        if k >= train_cutoff:
-            os.chdir(os.path.join(train_path, "images"))
+            class_name = label_to_class[1]
         else:
-            os.chdir(os.path.join(test_path, "images"))
+            continue
 
-        image = annotation_utils.binImage(
-            annotation_utils.bw_to_rgb(phase_image_stack[k]), bin_size, bin_method
+        split_path = train_path if labeled_data_frame[j, -3] >= train_cutoff else test_path
+        jobs.append(
+            (
+                write_mask,
+                segmentations[frame][cell],
+                os.path.join(split_path, "annotations", annotation_name(frame, cell, class_name)),
+                bin_size,
+                bin_method,
+                mask_height,
+            )
         )
-        image = Image.fromarray(image)
-        image.save(f"{k}.jpg")
 
+    for k in range(int(max(labeled_data_frame[:, -3])) + 1):
+        split_path = train_path if k >= train_cutoff else test_path
+        jobs.append(
+            (
+                write_image,
+                phase_image_stack[k],
+                os.path.join(split_path, "images", f"{k}.jpg"),
+                bin_size,
+                bin_method,
+            )
+        )
 
+    run_jobs(jobs, num_workers)
 
 
 def write_dataset_ranges(
@@ -103,6 +159,8 @@ def write_dataset_ranges(
     label_to_class: dict,
     bin_size: tuple = (1024, 1024),
     bin_method: str = "max",
+    num_workers: Optional[int] = None,
+    mask_height: Optional[int] = None,
 ):
     """
     Saves annotations(masks) and images in a manner that can be converted to COCO format using common tools
@@ -111,88 +169,175 @@ def write_dataset_ranges(
             parent_dir: string, directory which folders are to be created within
             phase_image_stack: n-darray, array containing phase images from which annotions come from
             segmentations: n-darray, rank 4 tensor indexed as segmentations[mu][nu] where mu references a frame and nu a cell:
-                          contains masks with each mask corresponding to an annotation. (Must be unpacked from bitmap repr)
+                          contains bit-packed masks with each mask corresponding to an annotation, a PackedMasks store or nested lists
             labeled_data_frame: n-darray, dataframe containing region props and classifications for each cell
             splits: list of tuples with each tuple corresponding to the range of images to be contained in one split of the dataset i.e. train or test split
             name: string, name of dataset to be created
             label_to_class: dict, dictionary containing int to string key value pairs, specifying what number classification corresponds to
                                   what verbal classification, i.e 0-> mitotic
+            num_workers: int, number of threads masks and images are decoded, binned and written across
+            mask_height: int, number of rows of the unpacked masks, only used for nested segmentations lists (defaults to 2048), PackedMasks carry their own
 
+    Every frame is written once into each split whose (inclusive) range contains it, frames outside of all ranges are not written.
     """
+    mask_height = resolve_mask_height(segmentations, mask_height)
 
     main_path = os.path.join(parent_dir, f"{name}")
     os.mkdir(main_path)
-    os.chdir(main_path)
 
     for i, _ in enumerate(splits):  # for each specified range
         path = os.path.join(main_path, f"{i}")
         os.mkdir(path)
-        os.chdir(path)
-        image_path = os.path.join(path, "images")
-        os.mkdir(image_path)
-        annotation_path = os.path.join(path, "annotations")
-        os.mkdir(annotation_path)
-        
-        
-    for l in range(int(max(labeled_data_frame[:, -3]))):
-        for m, _ in enumerate(splits):
-            if splits[m][0] <= l <= splits[m][1]:
-                os.chdir(
-                    os.path.join(
-                        os.path.join(
-                            main_path,
-                            f"{m}"
-                        ),
-                        "images"
-                    )
+        os.mkdir(os.path.join(path, "images"))
+        os.mkdir(os.path.join(path, "annotations"))
+
+    def matching_splits(frame):
+        return [
+            os.path.join(main_path, f"{m}")
+            for m, _ in enumerate(splits)
+            if splits[m][0] <= frame <= splits[m][1]
+        ]
+
+    jobs = []
+    for l in range(int(max(labeled_data_frame[:, -3])) + 1):
+        for split_path in matching_splits(l):
+            jobs.append(
+                (
+                    write_image,
+                    phase_image_stack[l],
+                    os.path.join(split_path, "images", f"{l}.jpg"),
+                    bin_size,
+                    bin_method,
                 )
-                
-            image = annotation_utils.binImage(
-            annotation_utils.bw_to_rgb(phase_image_stack[l]), bin_size, bin_method
             )
-            image = Image.fromarray(image)
-            image.save(f"{l}.jpg")
-
-                     
 
     for j in range(labeled_data_frame.shape[0]):
-        correct_dir = False
-        for k, _ in enumerate(splits): #for each specified range
-        
-            if splits[k][0] <= labeled_data_frame[j, -3] <= splits[k][1]: #check if the frame is within the correct range
-                os.chdir(
-                    os.path.join(
-                        os.path.join(main_path, f"{k}"), 
-                        "annotations"
-                        )
-                    )
-                correct_dir = True
-
-            if correct_dir == True:
-                mask = np.unpackbits(
-                    segmentations[int(labeled_data_frame[j, -3])][
-                        int(labeled_data_frame[j, -2])
-                    ],
-                    axis=0,
-                    count=2048,
+        frame, cell = int(labeled_data_frame[j, -3]), int(labeled_data_frame[j, -2])
+        if labeled_data_frame[j, -1] not in [0, 1, 2]:
+            continue
+        class_name = label_to_class[int(labeled_data_frame[j, -1])]
+        for split_path in matching_splits(labeled_data_frame[j, -3]):
+            jobs.append(
+                (
+                    write_mask,
+                    segmentations[frame][cell],
+                    os.path.join(split_path, "annotations", annotation_name(frame, cell, class_name)),
+                    bin_size,
+                    bin_method,
+                    mask_height,
                 )
-                mask = mask * 255
-                mask = annotation_utils.binImage(mask, bin_size, bin_method)
-                if labeled_data_frame[j, -1] == 0:
-                    cv2.imwrite(
-                        f"{int(labeled_data_frame[j, -3])}_{label_to_class[0]}_frame{int(labeled_data_frame[j, -3])}cell{int(labeled_data_frame[j, -2])}.png",
-                        mask,
-                    )
-                elif labeled_data_frame[j, -1] == 1:
-                    cv2.imwrite(
-                        f"{int(labeled_data_frame[j, -3])}_{label_to_class[1]}_frame{int(labeled_data_frame[j, -3])}cell{int(labeled_data_frame[j, -2])}.png",
-                        mask,
-                    )
-
-                elif labeled_data_frame[j, -1] == 2:
-                    cv2.imwrite(
-                        f"{int(labeled_data_frame[j, -3])}_{label_to_class[2]}_frame{int(labeled_data_frame[j, -3])}cell{int(labeled_data_frame[j, -2])}.png",
-                        mask,
-                    )
+            )
+
+    run_jobs(jobs, num_workers)
+
+
+def write_dataset_coco(
+    parent_dir: str,
+    phase_image_stack,
+    segmentations,
+    labeled_data_frame,
+    name: str,
+    label_to_class: dict,
+    bin_size: tuple = (1024, 1024),
+    bin_method: str = "max",
+    train_cutoff: Optional[int] = None,
+    mask_height: Optional[int] = None,
+):
+    """
+    Writes a COCO dataset directly, images as jpg and annotations as RLE masks in one json file per split, no per-annotation png files are written
+    ---------------------------------------------------------------------------------------------------------------------------------------------------
+    INPUTS:
+            parent_dir: string, directory which folders are to be created within
+            phase_image_stack: n-darray, array containing phase images from which annotions come from
+            segmentations: n-darray, rank 4 tensor indexed as segmentations[mu][nu] where mu references a frame and nu a cell:
+                          contains bit-packed masks (np.packbits(mask, axis = 0)) with each mask corresponding to an annotation, a PackedMasks store or nested lists
+            labeled_data_frame: n-darray, dataframe containing region props and classifications for each cell, the last three coloumns are [frame, cell, label]
+            name: string, name of dataset to be created
+            label_to_class: dict, dictionary containing int to string key value pairs, specifying what number classification corresponds to
+                                  what verbal classification, i.e 0-> mitotic. Each distinct string becomes one COCO category, labels absent from the dict are skipped
+            train_cutoff: int, frames >= train_cutoff go to the train split, the rest to the test split, as in write_dataset_percent
+            mask_height: int, number of rows of the unpacked masks, only used for nested segmentations lists (defaults to 2048), PackedMasks carry their own
+    OUTPUTS:
+            json_paths: dict, path of the COCO json written for each split
+
+    RLE annotations require cfg.INPUT.MASK_FORMAT = "bitmask" when training with detectron2.
+    """
+    mask_height = resolve_mask_height(segmentations, mask_height)
+    if train_cutoff == None:
+        train_cutoff = labeled_data_frame[-int(labeled_data_frame.shape[0] // (10 / 7)), -3]
+
+    class_names = list(dict.fromkeys(label_to_class[key] for key in sorted(label_to_class)))
+    categories = [
+        {"id": i + 1, "name": class_name, "supercategory": "cell"}
+        for i, class_name in enumerate(class_names)
+    ]
+    category_ids = {
+        key: class_names.index(class_name) + 1 for key, class_name in label_to_class.items()
+    }
+
+    main_path = os.path.join(parent_dir, f"{name}")
+    os.mkdir(main_path)
+    coco_outputs = {}
+    for split in ["train", "test"]:
+        os.makedirs(os.path.join(main_path, split, "images"))
+        coco_outputs[split] = {
+            "info": {
+                "description": name,
+                "date_created": datetime.datetime.now().isoformat(" "),
+            },
+            "licenses": [],
+            "categories": categories,
+            "images": [],
+            "annotations": [],
+        }
+
+    frames = labeled_data_frame[:, -3].astype(int)
+    for k in range(int(frames.max()) + 1):
+        split = "train" if k >= train_cutoff else "test"
+        image = annotation_utils.binImage(
+            annotation_utils.bw_to_rgb(phase_image_stack[k]), bin_size, bin_method
+        )
+        Image.fromarray(image).save(os.path.join(main_path, split, "images", f"{k}.jpg"))
+        coco_outputs[split]["images"].append(
+            {
+                "id": k + 1,
+                "file_name": f"{k}.jpg",
+                "width": int(image.shape[1]),
+                "height": int(image.shape[0]),
+                "license": 1,
+            }
+        )
+
+    annotation_id = 1
+    for j in range(labeled_data_frame.shape[0]):
+        label = int(labeled_data_frame[j, -1])
+        if label not in category_ids:
+            continue
+        frame, cell = int(labeled_data_frame[j, -3]), int(labeled_data_frame[j, -2])
+        mask = np.unpackbits(segmentations[frame][cell], axis=0, count=mask_height)
+        mask = annotation_utils.binImage(mask, bin_size, bin_method)
+        rle, area, bbox = mask_to_rle(mask)
+        if area == 0:
+            continue
+
+        split = "train" if frame >= train_cutoff else "test"
+        coco_outputs[split]["annotations"].append(
+            {
+                "id": annotation_id,
+                "image_id": frame + 1,
+                "category_id": category_ids[label],
+                "iscrowd": 0,
+                "segmentation": rle,
+                "area": area,
+                "bbox": bbox,
+            }
+        )
+        annotation_id += 1
 
+    json_paths = {}
+    for split, coco_output in coco_outputs.items():
+        json_paths[split] = os.path.join(main_path, split, f"instances_{name}_{split}.json")
+        with open(json_paths[split], "w") as output_json_file:
+            json.dump(coco_output, output_json_file)
 
+    return json_paths
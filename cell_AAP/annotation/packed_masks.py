@@ -0,0 +1,281 @@
+import zipfile
+import numpy as np
+import numpy.typing as npt
+from typing import Optional
+
+# number of set bits in each possible byte, popcount() without numpy >= 2.0
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype="uint8")
+# packed bytes gathered at once by packed_iou(), bounds its memory for frames with many overlapping masks
+PAIR_BLOCK = 1 << 24
+
+
+def mask_to_rle(mask: npt.NDArray) -> tuple[dict, int, list[int]]:
+    """
+    Encodes a binary mask as uncompressed COCO RLE, computing area and bbox in the same pass
+    ----------------------------------------------------------------------------------------
+    INPUTS:
+            mask: n-darray, 2D binary mask
+    OUTPUTS:
+            rle: dict, {"counts": [...], "size": [height, width]}, runs alternate starting with background in column-major order
+            area: int, number of foreground pixels
+            bbox: list, [x, y, width, height] of the foreground
+    """
+    flat = np.asarray(mask, dtype=bool).ravel(order="F")
+    boundaries = np.concatenate(([0], np.flatnonzero(np.diff(flat)) + 1, [flat.size]))
+    counts = np.diff(boundaries)
+    if flat.size > 0 and flat[0]:
+        counts = np.concatenate(([0], counts))
+
+    rows = np.flatnonzero(np.asarray(mask).any(axis=1))
+    cols = np.flatnonzero(np.asarray(mask).any(axis=0))
+    if rows.size == 0:
+        bbox = [0, 0, 0, 0]
+    else:
+        bbox = [
+            int(cols[0]),
+            int(rows[0]),
+            int(cols[-1] - cols[0] + 1),
+            int(rows[-1] - rows[0] + 1),
+        ]
+
+    rle = {"counts": counts.tolist(), "size": [int(mask.shape[0]), int(mask.shape[1])]}
+    return rle, int(flat.sum()), bbox
+
+
+def popcount(bits: npt.NDArray) -> npt.NDArray:
+    "Set bits of each byte, elementwise"
+
+    return np.bitwise_count(bits) if hasattr(np, "bitwise_count") else POPCOUNT[bits]
+
+
+def packed_area(bits: npt.NDArray) -> npt.NDArray:
+    "Number of foreground pixels of each mask in a (n, ceil(h / 8), w) stack of bit-packed masks"
+
+    return popcount(bits).sum(axis=tuple(range(1, bits.ndim)), dtype="int64")
+
+
+def packed_bbox(bits: npt.NDArray, height: int) -> npt.NDArray:
+    """
+    Bounding boxes of a (n, ceil(h / 8), w) stack of bit-packed masks, computed without unpacking whole masks
+    ----------------------------------------------------------------------------------------------------------
+    OUTPUTS:
+            bboxes: n-darray, (n, 4) rows of [x, y, width, height] as in mask_to_rle, empty masks give [0, 0, 0, 0]
+    """
+    rows = np.unpackbits(np.bitwise_or.reduce(bits, axis=2), axis=1, count=height).astype(bool)
+    cols = bits.any(axis=1)
+    bboxes = np.zeros((bits.shape[0], 4), dtype="int64")
+    filled = rows.any(axis=1)
+    if filled.any():
+        y0 = rows[filled].argmax(axis=1)
+        y1 = height - rows[filled, ::-1].argmax(axis=1)
+        x0 = cols[filled].argmax(axis=1)
+        x1 = cols.shape[1] - cols[filled, ::-1].argmax(axis=1)
+        bboxes[filled] = np.stack([x0, y0, x1 - x0, y1 - y0], axis=1)
+
+    return bboxes
+
+
+def packed_iou(bits: npt.NDArray, height: int) -> npt.NDArray:
+    """
+    Pairwise IOU of a (n, ceil(h / 8), w) stack of bit-packed masks, intersections are only counted for masks whose bounding boxes overlap
+    ----------------------------------------------------------------------------------------------------------------------------------------
+    OUTPUTS:
+            iou: n-darray, symmetric (n, n) matrix of floats
+    """
+    n = bits.shape[0]
+    areas = packed_area(bits)
+    bboxes = packed_bbox(bits, height)
+    x0, y0 = bboxes[:, 0], bboxes[:, 1]
+    x1, y1 = x0 + bboxes[:, 2], y0 + bboxes[:, 3]
+    overlaps = (
+        (x0[:, None] < x1[None, :])
+        & (x0[None, :] < x1[:, None])
+        & (y0[:, None] < y1[None, :])
+        & (y0[None, :] < y1[:, None])
+    )
+
+    iou = np.zeros((n, n), dtype="float64")
+    i, j = np.nonzero(np.triu(overlaps, k=1))
+    if i.shape[0] > 0:
+        # only the packed rows and columns covered by both boxes can intersect, every pair's window is gathered at the size of the
+        # largest one and the cells past its own window are masked out
+        r0, r1 = np.maximum(y0[i], y0[j]) // 8, -(-np.minimum(y1[i], y1[j]) // 8)
+        c0, c1 = np.maximum(x0[i], x0[j]), np.minimum(x1[i], x1[j])
+        rows = r0[:, None] + np.arange((r1 - r0).max())
+        cols = c0[:, None] + np.arange((c1 - c0).max())
+
+        intersections = np.empty(i.shape[0], dtype="int64")
+        step = max(1, PAIR_BLOCK // (rows.shape[1] * cols.shape[1]))
+        for k in range(0, i.shape[0], step):
+            block = slice(k, k + step)
+            inside = (rows[block] < r1[block, None])[:, :, None] & (cols[block] < c1[block, None])[:, None, :]
+            block_rows = np.minimum(rows[block], bits.shape[1] - 1)[:, :, None]
+            block_cols = np.minimum(cols[block], bits.shape[2] - 1)[:, None, :]
+            both = bits[i[block, None, None], block_rows, block_cols] & bits[j[block, None, None], block_rows, block_cols]
+            intersections[block] = (popcount(both) * inside).sum(axis=(1, 2), dtype="int64")
+
+        iou[i, j] = iou[j, i] = intersections / (areas[i] + areas[j] - intersections)
+    np.fill_diagonal(iou, areas > 0)
+
+    return iou
+
+
+def overlapping_masks(bits: npt.NDArray, height: int, iou_thresh: float) -> list[int]:
+    """
+    Packed replacement for annotation_utils.iou_with_list, returns the indices of masks to drop: of every pair with iou >= iou_thresh
+    the smaller mask (the earlier one on ties) is dropped, so exactly one copy of duplicated masks is kept
+    """
+    n = bits.shape[0]
+    if n < 2:
+        return []
+    order = np.argsort(packed_area(bits), kind="stable")
+    rank = np.empty(n, dtype="int64")
+    rank[order] = np.arange(n)
+    iou = packed_iou(bits, height)
+    later = rank[None, :] > rank[:, None]
+
+    return np.flatnonzero(((iou >= iou_thresh) & later).any(axis=1)).tolist()
+
+
+class PackedMasks:
+    """
+    Bit-packed masks of every cell of every frame held in one contiguous (n, ceil(h / 8), w) uint8 array, masks are packed along
+    their rows as np.packbits(mask, axis = 0) which is what annotation_utils.predict() returns.
+    Frame mu holds masks offsets[mu]:offsets[mu + 1], store[mu] returns them so store[mu][nu] is the packed mask of cell nu as
+    with the nested segmentations lists this class replaces, store.mask(mu, nu) returns it unpacked.
+    """
+
+    def __init__(self, bits: npt.NDArray, offsets: npt.NDArray, mask_shape: tuple[int, int]):
+        self.bits = bits
+        self.offsets = np.asarray(offsets, dtype="int64")
+        self.mask_shape = (int(mask_shape[0]), int(mask_shape[1]))
+
+    def __str__(self):
+        return f"PackedMasks of {len(self)} frames, {self.bits.shape[0]} masks of shape {self.mask_shape}"
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            frame, cell = key
+            return self.bits[self.index(frame, cell)]
+        return self.bits[self.offsets[key] : self.offsets[key + 1]]
+
+    def __iter__(self):
+        for frame in range(len(self)):
+            yield self[frame]
+
+    @classmethod
+    def from_frames(cls, frames: list, mask_shape: tuple[int, int]):
+        """
+        Builds a store from per-frame lists of bit-packed masks, i.e. the nested segmentations[mu][nu] lists
+        ------------------------------------------------------------------------------------------------------
+        INPUTS:
+                frames: list, one list (or array) of packed masks per frame, frames may be empty
+                mask_shape: tuple, (h, w) of the unpacked masks
+        """
+        packed_shape = (-(-mask_shape[0] // 8), mask_shape[1])
+        counts = [len(frame) for frame in frames]
+        bits = np.empty((sum(counts),) + packed_shape, dtype="uint8")
+        i = 0
+        for frame in frames:
+            for mask in frame:
+                bits[i] = mask
+                i += 1
+
+        return cls(bits, np.concatenate(([0], np.cumsum(counts, dtype="int64"))), mask_shape)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True):
+        """
+        Loads a store written by save(), with mmap = True the masks are memory-mapped so that looking up one (frame, cell) only reads that mask
+        """
+        with np.load(path) as store:
+            offsets = store["offsets"]
+            mask_shape = tuple(store["mask_shape"])
+            if not mmap:
+                return cls(store["bits"], offsets, mask_shape)
+
+        with zipfile.ZipFile(path) as archive:
+            info = archive.getinfo("bits.npy")
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise ValueError("compressed stores cannot be memory-mapped, use mmap = False")
+
+        with open(path, "rb") as file:
+            # local file header: 30 fixed bytes followed by the file name and extra field
+            file.seek(info.header_offset + 26)
+            name_length, extra_length = np.frombuffer(file.read(4), dtype="<u2")
+            file.seek(info.header_offset + 30 + int(name_length) + int(extra_length))
+            if np.lib.format.read_magic(file) == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+            bits = np.memmap(
+                path,
+                dtype=dtype,
+                mode="r",
+                shape=shape,
+                order="F" if fortran_order else "C",
+                offset=file.tell(),
+            )
+
+        return cls(bits, offsets, mask_shape)
+
+    def save(self, path: str):
+        "Writes the store to one uncompressed .npz file which load() can memory-map"
+
+        np.savez(
+            path,
+            bits=np.ascontiguousarray(self.bits),
+            offsets=self.offsets,
+            mask_shape=np.asarray(self.mask_shape),
+        )
+
+    def index(self, frame: int, cell: int) -> int:
+        "Position of (frame, cell) in the flat mask array"
+
+        if not 0 <= cell < self.offsets[frame + 1] - self.offsets[frame]:
+            raise IndexError(f"frame {frame} has no cell {cell}")
+        return int(self.offsets[frame] + cell)
+
+    def frame_cells(self, frame: int) -> int:
+        "Number of masks in one frame"
+
+        return int(self.offsets[frame + 1] - self.offsets[frame])
+
+    def mask(self, frame: int, cell: int) -> npt.NDArray:
+        "Unpacked uint8 (h, w) mask of one cell"
+
+        return np.unpackbits(self[frame, cell], axis=0, count=self.mask_shape[0])
+
+    def area(self, frame: Optional[int] = None) -> npt.NDArray:
+        "Foreground pixel count of every mask, or of every mask of one frame"
+
+        bits = self.bits if frame == None else self[frame]
+        return packed_area(bits)
+
+    def bbox(self, frame: Optional[int] = None) -> npt.NDArray:
+        "(n, 4) [x, y, width, height] bounding boxes of every mask, or of every mask of one frame"
+
+        bits = self.bits if frame == None else self[frame]
+        return packed_bbox(bits, self.mask_shape[0])
+
+    def iou(self, frame: int) -> npt.NDArray:
+        "Pairwise (n, n) IOU matrix of the masks of one frame"
+
+        return packed_iou(self[frame], self.mask_shape[0])
+
+    def rle(self, frame: int, cell: int) -> dict:
+        "Uncompressed COCO RLE of one mask"
+
+        rle, _, _ = mask_to_rle(self.mask(frame, cell))
+        return rle
+
+
+def resolve_mask_height(segmentations, mask_height: Optional[int] = None) -> int:
+    "Row count to unpack segmentations with, PackedMasks carry their own, nested lists default to 2048"
+
+    if isinstance(segmentations, PackedMasks):
+        return segmentations.mask_shape[0]
+    return 2048 if mask_height == None else mask_height
@@ -0,0 +1,196 @@
+import cv2
+import numpy as np
+import numpy.typing as npt
+from typing import Optional
+
+# dtypes cv2.resize, cv2.dilate and cv2.erode accept
+CV2_DTYPES = (np.uint8, np.uint16, np.int16, np.float32, np.float64)
+
+
+class ResampleTransform:
+
+    "Maps coordinates between an original image and its resampled (and padded) version, coordinates are (row, coloumn) ordered"
+
+    def __init__(self, scale: tuple[float, float], offset: tuple[float, float] = (0, 0)):
+        self.scale = np.asarray(scale, dtype="float64")
+        self.offset = np.asarray(offset, dtype="float64")
+
+    def __str__(self):
+        return f"ResampleTransform(scale = {tuple(self.scale.tolist())}, offset = {tuple(self.offset.tolist())})"
+
+    def points_to_original(self, points: npt.NDArray) -> npt.NDArray:
+        "Maps pixel coordinates, i.e. centroids, of shape (..., 2) from the resampled image back to the original image"
+
+        return (np.asarray(points, dtype="float64") - self.offset + 0.5) / self.scale - 0.5
+
+    def points_to_resampled(self, points: npt.NDArray) -> npt.NDArray:
+        "Maps pixel coordinates of shape (..., 2) from the original image to the resampled image"
+
+        return (np.asarray(points, dtype="float64") + 0.5) * self.scale - 0.5 + self.offset
+
+    def boxes_to_original(self, boxes: npt.NDArray) -> npt.NDArray:
+        "Maps (..., 4) boxes given as [x1, y1, x2, y2] pixel edges from the resampled image back to the original image"
+
+        boxes = np.asarray(boxes, dtype="float64")
+        scale = np.tile(self.scale[::-1], 2)
+        offset = np.tile(self.offset[::-1], 2)
+        return (boxes - offset) / scale
+
+
+def bin_edges(old_size: int, new_size: int) -> npt.NDArray:
+    "Start index of each of new_size bins covering old_size pixels, bins repeat (nearest neighbour) when upsampling"
+
+    return (np.arange(new_size) * old_size) // new_size
+
+
+def reduce_bins(img: npt.NDArray, new_shape: tuple, method: str) -> npt.NDArray:
+    "Max or min bins with np.ufunc.reduceat over integer bin edges, works for any factor and dtype"
+
+    ufunc = np.maximum if method == "max" else np.minimum
+    row_edges = bin_edges(img.shape[0], new_shape[0])
+    col_edges = bin_edges(img.shape[1], new_shape[1])
+    return ufunc.reduceat(ufunc.reduceat(img, row_edges, axis=0), col_edges, axis=1)
+
+
+def strided_mean(img: npt.NDArray, factors: tuple[int, int]) -> npt.NDArray:
+    "Mean of each factors[0] x factors[1] block, summed over strided views in float64"
+
+    out = np.zeros(
+        (img.shape[0] // factors[0], img.shape[1] // factors[1]) + img.shape[2:],
+        dtype="float64",
+    )
+    for i in range(factors[0]):
+        for j in range(factors[1]):
+            out += img[i :: factors[0], j :: factors[1]]
+
+    return out / (factors[0] * factors[1])
+
+
+def broadcast_channel(img: npt.NDArray) -> Optional[npt.NDArray]:
+    "The single channel of an (h, w, c) image whose channels are a broadcast view, as returned by bw_to_rgb(), otherwise None"
+
+    if img.ndim == 3 and img.shape[2] > 1 and img.strides[2] == 0:
+        return img[:, :, 0]
+    return None
+
+
+def resample(img: npt.NDArray, new_shape: tuple, method: str = "area") -> npt.NDArray:
+    """
+    Resamples an image to any (rows, coloumns) shape, integer and non-integer factors, up or down
+    ---------------------------------------------------------------------------------------------
+    INPUTS:
+        img: n-darray, (h, w) or (h, w, c) image
+        new_shape: tuple, (rows, coloumns) of the output
+        method: str, one of
+                'area': cv2.resize(INTER_AREA), keeps the input dtype
+                'mean': block mean for integer factors, area-weighted average (INTER_AREA in float64) otherwise, float64 for integer
+                        images as with np.mean
+                'max' / 'min': maximum / minimum of each bin, for integer factors a cv2 dilation / erosion read at a stride
+    OUTPUTS:
+        img: n-darray, (new_shape[0], new_shape[1]) or (new_shape[0], new_shape[1], c), broadcast channel views are resampled
+             as one channel and returned as a broadcast view
+    """
+    if img.ndim not in (2, 3):
+        raise ValueError(
+            "Input image must be either RGB like, (3 dimensional) or black and white (2 dimensional)"
+        )
+    if method not in ("area", "mean", "max", "min"):
+        raise ValueError(f"method must be one of 'area', 'mean', 'max' or 'min', got {method}")
+
+    new_shape = (int(new_shape[0]), int(new_shape[1]))
+    channel = broadcast_channel(img)
+    if channel is not None:
+        out = resample(channel, new_shape, method)
+        return np.broadcast_to(out[:, :, np.newaxis], out.shape + img.shape[2:])
+
+    mean_dtype = img.dtype if img.dtype.kind == "f" else np.dtype("float64")
+    if img.shape[:2] == new_shape:
+        return img.astype(mean_dtype) if method == "mean" else img
+
+    dtype = img.dtype
+    if dtype == bool:
+        img = img.view("uint8")
+    cv2_ready = img.dtype.type in CV2_DTYPES and (img.ndim == 2 or img.shape[2] <= 4)
+
+    factors = (img.shape[0] // new_shape[0], img.shape[1] // new_shape[1])
+    integer_factors = (
+        min(factors) >= 1
+        and factors[0] * new_shape[0] == img.shape[0]
+        and factors[1] * new_shape[1] == img.shape[1]
+    )
+
+    if method == "mean" and integer_factors:
+        out = strided_mean(img, factors).astype(mean_dtype, copy=False)
+    elif method in ("area", "mean"):
+        work = img.astype("float64") if method == "mean" or not cv2_ready else img
+        out = cv2.resize(work, new_shape[::-1], interpolation=cv2.INTER_AREA)
+        if img.ndim == 3 and out.ndim == 2:
+            out = out[:, :, np.newaxis]
+        if method == "mean":
+            out = out.astype(mean_dtype, copy=False)
+        elif out.dtype != img.dtype:
+            out = out.round().astype(img.dtype) if img.dtype.kind in "iub" else out.astype(img.dtype)
+    elif integer_factors and cv2_ready:
+        kernel = np.ones(factors, dtype="uint8")
+        morph = cv2.dilate if method == "max" else cv2.erode
+        out = morph(img, kernel, anchor=(0, 0))[:: factors[0], :: factors[1]]
+        if img.ndim == 3 and out.ndim == 2:
+            out = out[:, :, np.newaxis]
+    else:
+        out = reduce_bins(img, new_shape, method)
+
+    return out.view(bool) if dtype == bool and out.dtype == np.uint8 else out
+
+
+def fit_to_shape(
+    img: npt.NDArray,
+    desired_shape: tuple,
+    method: str = "area",
+    pad_value: Optional[float] = None,
+) -> tuple[npt.NDArray, ResampleTransform]:
+    """
+    Fits an image of any (rows, coloumns) shape into desired_shape, preserving its aspect ratio
+    -------------------------------------------------------------------------------------------
+    INPUTS:
+        img: n-darray, (h, w) or (h, w, c) image
+        desired_shape: tuple, (rows, coloumns) of the output
+        method: str, resampling method passed to resample()
+        pad_value: float, value of the padding, defaults to the image mean
+    OUTPUTS:
+        img: n-darray, image of shape desired_shape, images larger than desired_shape along either axis are downsampled by one factor
+             so that they fit, the remainder is padded symmetrically
+        transform: ResampleTransform, maps centroids and boxes of the output back to the input
+    """
+    desired_shape = (int(desired_shape[0]), int(desired_shape[1]))
+    channel = broadcast_channel(img)
+    if channel is not None:
+        out, transform = fit_to_shape(channel, desired_shape, method, pad_value)
+        return np.broadcast_to(out[:, :, np.newaxis], out.shape + img.shape[2:]), transform
+
+    original_shape = img.shape[:2]
+    scale = min(1.0, desired_shape[0] / img.shape[0], desired_shape[1] / img.shape[1])
+    resampled_shape = (
+        min(desired_shape[0], round(img.shape[0] * scale)),
+        min(desired_shape[1], round(img.shape[1] * scale)),
+    )
+    if resampled_shape != img.shape[:2]:
+        img = resample(img, resampled_shape, method)
+
+    pad_rows = desired_shape[0] - img.shape[0]
+    pad_cols = desired_shape[1] - img.shape[1]
+    offset = (pad_rows // 2, pad_cols // 2)
+    if pad_rows or pad_cols:
+        padding = [(offset[0], pad_rows - offset[0]), (offset[1], pad_cols - offset[1])]
+        padding += [(0, 0)] * (img.ndim - 2)
+        img = np.pad(
+            img,
+            padding,
+            mode="constant",
+            constant_values=img.mean() if pad_value == None else pad_value,
+        )
+
+    transform = ResampleTransform(
+        (resampled_shape[0] / original_shape[0], resampled_shape[1] / original_shape[1]),
+        offset,
+    )
+    return img, transform
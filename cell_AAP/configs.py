@@ -21,6 +21,8 @@ class Cfg:
         box_size: tuple,
         bbox_func : tuple,
         iou_thresh: float,
+        tophat_method: str = "separable",
+        num_workers: int = 1,
     ):
         self.VERSION = version
         self.threshold_type = threshold_type
@@ -35,6 +37,8 @@ class Cfg:
         self.box_size = box_size
         self.bbox_func = bbox_func
         self.iou_thresh = iou_thresh
+        self.tophat_method = tophat_method
+        self.num_workers = num_workers
 
     @classmethod
     def get_config(cls, default: dict = defaults._HELA):
@@ -56,6 +60,8 @@ class Cfg:
                 box_size=default["BOX_SIZE"],
                 bbox_func = default['BBOX_FUNC'],
                 iou_thresh=default["IOU_THRESH"],
+                tophat_method=default.get("TOPHAT_METHOD", "separable"),
+                num_workers=default.get("NUM_WORKERS", 1),
             )
 
         except Exception as error:
@@ -8,6 +8,7 @@ _HELA["VERSION"] = 1
 _HELA["THRESHOLD_TYPE"] = "single"
 _HELA["THRESHOLD_DIVISION"] = 0.75
 _HELA["TOPHATSTRUCT"] = skimage.morphology.square(71)
+_HELA["TOPHAT_METHOD"] = "separable"  # one of 'naive', 'separable' (exact for squares), 'downsample' (approximate)
 _HELA["EROSIONSTRUCT"] = skimage.morphology.disk(8)
 _HELA["GAUSSIAN_SIGMA"] = 2
 _HELA["POINTPROMPTS"] = True
@@ -32,6 +33,7 @@ _HELA["FRAMESTEP"] = 1
 _HELA["BOX_SIZE"] = (au.get_box_size, (2.5,))
 _HELA["IOU_THRESH"] = 0.85
 _HELA["BBOX_FUNC"] = (au.square_box)
+_HELA["NUM_WORKERS"] = 1  # worker processes for ROI cleaning and feature extraction
 _DEFAULT = _HELA
 
 
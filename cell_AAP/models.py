@@ -0,0 +1,369 @@
+import os
+import copy
+import json
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Optional
+
+"Registry of cell-AAP models shared by the napari plugin and the inference scripts"
+
+_MODELS = {}
+_MODELS["HeLa"] = {
+    "url": "doi:10.5281/zenodo.14226948",
+    "weights": ("model_0043499.pth", "md5:ad056dc159ea8fd12f7d5d4562c368a9"),
+    "config": ("config.yaml", "md5:319ec68250d7ae499a274f7c4f151513"),
+    "config_type": "lazy",
+}
+_MODELS["U2OS"] = {
+    "url": "doi:10.5281/zenodo.14226985",
+    "weights": ("model_0030449.pth", "md5:4d65600b92560d7fcda6c6fd59fa0fe8"),
+    "config": ("config.yaml", "md5:ad80d579860c53a84ab076c4db2604fd"),
+    "config_type": "lazy",
+}
+_MODELS["HeLa_O"] = {
+    "url": "doi:10.5281/zenodo.14502793",
+    "weights": ("model_final.pth", "md5:d7201b05ad8881c8b496930306ea6071"),
+    "config": ("config.yaml", "md5:6f0264cf8aba3703a3cc0c51dbc20111"),
+    "config_type": "lazy",
+}
+
+# names older versions of the scripts used
+_ALIASES = {"HeLa_o": "HeLa_O"}
+
+_VERIFIED_FILE = "verified.json"
+_lock = threading.Lock()
+_configs = {}
+
+
+def cache_dir() -> str:
+    "Where model files are downloaded to, the CELL_AAP_CACHE environment variable overrides pooch's os cache"
+
+    path = os.environ.get("CELL_AAP_CACHE")
+    if path == None:
+        import pooch
+
+        path = str(pooch.os_cache("cell_aap"))
+    return path
+
+
+def model_names() -> list[str]:
+    return list(_MODELS.keys())
+
+
+def resolve(model_name: str) -> str:
+    "Registry name of model_name, raises for unknown models"
+
+    model_name = _ALIASES.get(model_name, model_name)
+    try:
+        assert model_name in _MODELS
+    except AssertionError:
+        raise Exception(f"Invalid model name selected, model must be one of {model_names()}")
+    return model_name
+
+
+def register(
+    model_name: str,
+    config_type: str = "lazy",
+    weights: Optional[str] = None,
+    config: Optional[str] = None,
+    url: Optional[str] = None,
+    weights_hash: Optional[str] = None,
+    config_hash: Optional[str] = None,
+):
+    """
+    Adds or overrides a model entry
+    -------------------------------
+    INPUTS:
+        model_name: str
+        config_type: str, 'lazy' or 'yacs'
+        weights, config: str, local file paths, entries with local paths are used as they are, offline and without hashing,
+                         or file names within url if url is given
+        url: str, pooch base url (i.e. a zenodo doi) the files are downloaded from
+        weights_hash, config_hash: str, pooch hashes of the remote files, i.e. 'md5:...'
+    """
+    _configs.pop(model_name, None)
+    if url == None:
+        try:
+            assert os.path.isfile(weights) and os.path.isfile(config)
+        except (AssertionError, TypeError):
+            raise Exception(f"Local model files for {model_name} were not found: {weights}, {config}")
+        _MODELS[model_name] = {
+            "local": True,
+            "weights": (os.path.abspath(weights), None),
+            "config": (os.path.abspath(config), None),
+            "config_type": config_type,
+        }
+    else:
+        _MODELS[model_name] = {
+            "url": url,
+            "weights": (weights, weights_hash),
+            "config": (config, config_hash),
+            "config_type": config_type,
+        }
+
+
+def load_manifest(path: str):
+    """
+    Registers every entry of a json manifest, {"name": {"config_type": ..., "weights": ..., "config": ..., "url": ...}, ...} with the
+    keyword arguments of register()
+    """
+    with open(path) as manifest_file:
+        manifest = json.load(manifest_file)
+    for model_name, entry in manifest.items():
+        register(model_name, **entry)
+
+
+def _verified_path(model_dir: str) -> str:
+    return os.path.join(model_dir, _VERIFIED_FILE)
+
+
+def _read_verified(model_dir: str) -> dict:
+    try:
+        with open(_verified_path(model_dir)) as verified_file:
+            return json.load(verified_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _is_verified(path: str, known_hash: str, verified: dict) -> bool:
+    "A file hashed before is trusted again while its size and mtime are unchanged"
+
+    record = verified.get(os.path.basename(path))
+    if record == None or not os.path.exists(path):
+        return False
+    stat = os.stat(path)
+    return record == {"hash": known_hash, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def fetch(model_name: str, kind: str) -> str:
+    """
+    Local path of a model's 'weights' or 'config' file, downloading and verifying it the first time, afterwards files whose size and
+    mtime match their last verification are returned without being hashed again
+    """
+    model_name = resolve(model_name)
+    entry = _MODELS[model_name]
+    file_name, known_hash = entry[kind]
+    if entry.get("local", False):
+        return file_name
+
+    model_dir = os.path.join(cache_dir(), model_name)
+    path = os.path.join(model_dir, file_name)
+    with _lock:
+        verified = _read_verified(model_dir)
+        if _is_verified(path, known_hash, verified):
+            return path
+
+        import pooch
+
+        downloader = pooch.create(
+            path=model_dir, base_url=entry["url"], registry={file_name: known_hash}
+        )
+        path = downloader.fetch(file_name)
+        stat = os.stat(path)
+        verified[file_name] = {"hash": known_hash, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        with open(_verified_path(model_dir), "w") as verified_file:
+            json.dump(verified, verified_file)
+
+    return path
+
+
+def config_type(model_name: str) -> str:
+    return _MODELS[resolve(model_name)]["config_type"]
+
+
+def load_config(model_name: str):
+    """
+    Parsed detectron2 config of a model with cfg.train.init_checkpoint (lazy) or cfg.MODEL.WEIGHTS (yacs) set, configs are parsed once
+    per process and a copy is returned on every call so callers may modify it
+    """
+    model_name = resolve(model_name)
+    if model_name not in _configs:
+        # detectron2 is only imported once a model is actually configured
+        from detectron2.config import LazyConfig, get_cfg
+
+        config_path = fetch(model_name, "config")
+        weights_path = fetch(model_name, "weights")
+        if config_type(model_name) == "yacs":
+            cfg = get_cfg()
+            cfg.merge_from_file(config_path)
+            cfg.MODEL.WEIGHTS = weights_path
+        else:
+            cfg = LazyConfig.load(config_path)
+            cfg.train.init_checkpoint = weights_path
+        _configs[model_name] = cfg
+
+    return copy.deepcopy(_configs[model_name])
+
+
+def preload(names: Optional[list[str]] = None):
+    "Fetches, verifies and parses the configs of several models ahead of time, i.e. when the plugin opens"
+
+    for model_name in model_names() if names == None else names:
+        load_config(model_name)
+
+
+def _unwrap(predictor):
+    "The GeneralizedRCNN inside a DefaultPredictor (yacs) or a (possibly DDP wrapped) lazy model"
+
+    model = getattr(predictor, "model", predictor)
+    return getattr(model, "module", model)
+
+
+def _box_predictors(model) -> list:
+    "Box predictors of the ROI heads, cascade heads hold one per stage"
+
+    box_predictor = model.roi_heads.box_predictor
+    return list(box_predictor) if hasattr(box_predictor, "__iter__") else [box_predictor]
+
+
+def _predictor_bytes(predictor) -> int:
+    model = _unwrap(predictor)
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class PredictorPool:
+    """
+    Keeps loaded predictors keyed by (model_name, device) and applies test-time parameters to them without reloading, predictors are
+    evicted least recently used first once there are more than max_models or their parameters exceed memory_budget bytes
+
+        predictor = models.POOL.get("HeLa", "cuda", confluency_est = 1500, conf_threshold = 0.25)
+
+    Eviction only drops the pool's reference, a predictor's memory is freed once callers holding it (i.e. configure() containers or
+    the inference server's models) drop it too. apply() keeps working on evicted predictors that are still held.
+    """
+
+    def __init__(self, max_models: int = 2, memory_budget: Optional[int] = None):
+        self.max_models = max_models
+        self.memory_budget = memory_budget
+        self.entries = OrderedDict()
+        # config defaults and model type of every predictor built, kept without holding the predictor so they outlive eviction
+        self.settings = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key: tuple[str, str]) -> bool:
+        return key in self.entries
+
+    def build(self, model_name: str, device: str):
+        "Instantiates a predictor and loads its weights, what configure() used to do on every call"
+
+        from detectron2.engine import DefaultPredictor
+        from detectron2.engine.defaults import create_ddp_model
+        from detectron2.checkpoint import DetectionCheckpointer
+        from detectron2.config import instantiate
+
+        cfg = load_config(model_name)
+        if config_type(model_name) == "yacs":
+            cfg.MODEL.DEVICE = device
+            predictor = DefaultPredictor(cfg)
+        else:
+            cfg.train.device = device
+            predictor = instantiate(cfg.model)
+            predictor.to(cfg.train.device)
+            predictor = create_ddp_model(predictor)
+            DetectionCheckpointer(predictor).load(cfg.train.init_checkpoint)
+            predictor.eval()
+
+        return predictor, cfg
+
+    def defaults(self, predictor, model_type: str) -> dict:
+        "Test-time parameters the config set, restored whenever apply() is given None"
+
+        model = _unwrap(predictor)
+        box_predictor = _box_predictors(model)[0]
+        if model_type == "yacs":
+            detections = box_predictor.test_topk_per_image
+        else:
+            detections = model.proposal_generator.post_nms_topk[False]
+        return {"confluency_est": detections, "conf_threshold": box_predictor.test_score_thresh}
+
+    def evict(self, incoming_bytes: int = 0):
+        "Drops least recently used predictors until there is room for one more of incoming_bytes"
+
+        def over_budget() -> bool:
+            if len(self.entries) >= self.max_models:
+                return True
+            if self.memory_budget == None:
+                return False
+            return sum(entry["bytes"] for entry in self.entries.values()) + incoming_bytes > self.memory_budget
+
+        while self.entries and over_budget():
+            _, evicted = self.entries.popitem(last=False)
+            if str(evicted.pop("device")).startswith("cuda"):
+                import torch
+
+                evicted.clear()
+                torch.cuda.empty_cache()
+
+    def get(
+        self,
+        model_name: str,
+        device: str,
+        confluency_est: Optional[int] = None,
+        conf_threshold: Optional[float] = None,
+    ):
+        """
+        Loaded predictor of model_name on device with the test-time parameters applied, built only if it is not pooled
+        ---------------------------------------------------------------------------------------------------------------
+        INPUTS:
+            model_name: str, any registry name or alias
+            device: str, 'cuda' or 'cpu'
+            confluency_est: int, proposals kept after NMS (lazy) or detections per image (yacs), None keeps the config's
+            conf_threshold: float, score threshold, None keeps the config's
+        """
+        key = (resolve(model_name), device)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            else:
+                # size is only known after loading, so evict to the count limit first and to the byte budget once it is known
+                self.evict()
+                predictor, cfg = self.build(key[0], device)
+                size = _predictor_bytes(predictor)
+                self.evict(size)
+                self.entries[key] = {
+                    "predictor": predictor,
+                    "cfg": cfg,
+                    "device": device,
+                    "bytes": size,
+                }
+                self.settings[predictor] = {
+                    "model_type": config_type(key[0]),
+                    "defaults": self.defaults(predictor, config_type(key[0])),
+                }
+            entry = self.entries[key]
+
+        self.apply(entry["predictor"], confluency_est, conf_threshold)
+        return entry["predictor"]
+
+    def entry(self, predictor) -> Optional[dict]:
+        for entry in self.entries.values():
+            if entry["predictor"] is predictor:
+                return entry
+        return None
+
+    def apply(self, predictor, confluency_est: Optional[int] = None, conf_threshold: Optional[float] = None):
+        """
+        Sets the test-time parameters of a predictor built by the pool in place, evicted or not, None restores the config's value,
+        predictors the pool did not build are left as they are
+        """
+        settings = self.settings.get(predictor)
+        if settings == None:
+            return
+        if confluency_est == None:
+            confluency_est = settings["defaults"]["confluency_est"]
+        if conf_threshold == None:
+            conf_threshold = settings["defaults"]["conf_threshold"]
+
+        model = _unwrap(predictor)
+        for box_predictor in _box_predictors(model):
+            box_predictor.test_score_thresh = conf_threshold
+            if settings["model_type"] == "yacs":
+                box_predictor.test_topk_per_image = confluency_est
+        if settings["model_type"] != "yacs":
+            model.proposal_generator.post_nms_topk[False] = confluency_est
+
+
+# shared by every configure() of this process
+POOL = PredictorPool()
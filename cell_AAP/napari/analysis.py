@@ -1,47 +1,70 @@
 import numpy as np
 import numpy.typing as npt
 import os
-import skimage
-import scipy
 from skimage import segmentation
 import btrack  # type: ignore
 from btrack import datasets  # type:ignore
 import pandas as pd
-from typing import Optional
+from typing import Optional, Union
 import tifffile as tiff
 import cell_AAP.napari.ui as ui
 import cell_AAP.napari.fileio as fileio
 import cell_AAP.annotation.annotation_utils as au
+import cell_AAP.napari.tracking as tracking
+import cell_AAP.napari.flatfield as flatfield
+from cell_AAP.napari.projections import stream_projection
 
 
-def projection(im_array: np.ndarray, projection_type: str):
+def projection(
+    im_array,
+    projection_type: Union[str, tuple[str, ...]],
+    chunk_frames: int = 16,
+    num_workers: int = 1,
+):
+    """
+    Projects the middle half of a stack, reducing chunk_frames frames at a time so the stack never has to be resident
+    ------------------------------------------------------------------------------------------------------------------
+    INPUTS:
+        im_array: n-darray, np.memmap, tiff.memmap, tiff.TiffFile or path to a tiff file, (t, y, x)
+        projection_type: str, one of 'max', 'min', 'average', or a tuple of them to compute several projections in one pass
+        chunk_frames: int, number of frames read at once
+        num_workers: int, number of threads chunks are reduced across
+    OUTPUTS:
+        projected_image: n-darray, or a dict of projections keyed by type if projection_type is a tuple
+    """
+    projection_types = (projection_type,) if isinstance(projection_type, str) else tuple(projection_type)
+    projections = stream_projection(
+        im_array, projection_types, chunk_frames=chunk_frames, num_workers=num_workers
+    )
 
-    if im_array.shape[0] % 2 == 0:
-        center_index = im_array.shape[0] // 2 - 1
-    else:
-        center_index = im_array.shape[0] // 2
+    return projections[projection_type] if isinstance(projection_type, str) else projections
 
-    range = center_index // 2
 
-    try:
-        assert projection_type in ["max", "min", "average"]
-    except AssertionError:
-        print("Projection type was not valid, valid types include: max, min, mean")
+def filter_objects(
+    objects: list, min_area: float = 500, min_solidity: float = 0.90
+) -> list:
+    """
+    Maps the class_id of btrack objects to 0: non-mitotic, 1: mitotic and drops objects that are too small or not solid enough
+    --------------------------------------------------------------------------------------------------------------------------
+    INPUTS:
+        objects: list[btrack.btypes.PyTrackObject], as returned by btrack.utils.segmentation_to_objects
+        min_area: float, objects with area < min_area are dropped
+        min_solidity: float, objects with solidity < min_solidity are dropped
+    OUTPUTS:
+        objects: list[btrack.btypes.PyTrackObject]
+    """
+    if len(objects) == 0:
+        return []
 
-    if projection_type == "max":
-        projected_image = np.max(
-            im_array[center_index - range : center_index + range], axis=0
-        )
-    elif projection_type == "average":
-        projected_image = np.mean(
-            im_array[center_index - range : center_index + range], axis=0
-        )
-    elif projection_type == "min":
-        projected_image = np.min(
-            im_array[center_index - range : center_index + range], axis=0
-        )
+    class_ids = np.fromiter((obj.properties["class_id"] for obj in objects), dtype=int)
+    areas = np.fromiter((obj.properties["area"] for obj in objects), dtype=float)
+    solidities = np.fromiter((obj.properties["solidity"] for obj in objects), dtype=float)
+    keep = (areas >= min_area) & (solidities >= min_solidity)
+
+    for obj, class_id in zip(objects, class_ids % 2):
+        obj.properties["class_id"] = int(class_id)
 
-    return np.array(projected_image)
+    return [obj for obj, kept in zip(objects, keep) if kept]
 
 
 def track(
@@ -49,6 +72,12 @@ def track(
     intensity_movie: npt.NDArray,
     config_file: Optional[str] = datasets.cell_config(),
     features: Optional[list[str]] = None,
+    num_workers: int = 1,
+    min_area: float = 500,
+    min_solidity: float = 0.90,
+    engine: str = "btrack",
+    tracker_args: Optional[dict] = None,
+    intensity_map: Optional[npt.NDArray] = None,
 ):
     """
     Utilizes btrack to track cells through time, assigns class_id labels to each track, 0: non-mitotic, 1: mitotic
@@ -58,7 +87,21 @@ def track(
         intensity_movie: npt.NDArray,
         config_file: str,
         features: list
+        num_workers: int, number of processes frames are split across when extracting objects
+        min_area: float, objects with area < min_area are not tracked
+        min_solidity: float, objects with solidity < min_solidity are not tracked
+        engine: str, 'btrack' for btrack's BayesianTracker or 'lap' for tracking.LinearAssignmentTracker, a frame-to-frame
+                linear assignment tracker with gap closing and division detection that is much lighter on dense fields
+        tracker_args: dict, keyword arguments of tracking.LinearAssignmentTracker when engine = 'lap'
+        intensity_map: npt.NDArray, flat field of the intensity movie's frames, i.e. from flatfield.FlatFieldCache, if given
+                       intensities are measured on frames corrected as they are read
+    OUTPUTS:
+        tracks, data, properties, graph, cfg: tracks, the napari (data, properties, graph) triple and the tracker configuration
     """
+    try:
+        assert engine in ["btrack", "lap"]
+    except AssertionError as error:
+        raise AssertionError("engine must be one of 'btrack', 'lap'") from error
 
     if features == None:
         features = [
@@ -71,6 +114,9 @@ def track(
             "intensity_mean",
         ]
 
+    if intensity_map is not None:
+        intensity_movie = flatfield.FlatFieldCorrected(intensity_movie, intensity_map)
+
     if intensity_movie.shape[1] != instance_movie.shape[1]:
         intensity_movie_binned = [
             au.square_reshape(
@@ -81,23 +127,25 @@ def track(
 
         intensity_movie = np.asarray(intensity_movie_binned)
 
+    if engine == "lap":
+        return tracking.lap_track(
+            instance_movie,
+            intensity_movie,
+            tuple(features),
+            min_area,
+            min_solidity,
+            num_workers,
+            **({} if tracker_args == None else tracker_args),
+        )
+
     objects = btrack.utils.segmentation_to_objects(
         instance_movie,
-        intensity_image=intensity_movie,
-        properties=tuple(features),
+        intensity_image=np.asarray(intensity_movie),
+        properties=tuple(dict.fromkeys(list(features) + ["area", "solidity"])),
         assign_class_ID=True,
-        num_workers=1,
+        num_workers=num_workers,
     )
-
-    for i, object in enumerate(objects):
-        if object.properties["class_id"] % 2 == 0:
-            object.properties["class_id"] = 0
-        else:
-            object.properties["class_id"] = 1
-        if object.properties['area'] < 500:
-                objects.pop(i)
-        if object.properties['solidity'] < 0.90:
-            objects.pop(i)
+    objects = filter_objects(objects, min_area, min_solidity)
 
     with btrack.BayesianTracker() as tracker:
 
@@ -118,6 +166,75 @@ def track(
         return tracks, data, properties, graph, cfg
 
 
+def fill_nan_rows(matrix: npt.NDArray, lengths: npt.NDArray) -> npt.NDArray:
+    """
+    Linearly interpolates NaN entries of each row from the valid entries of the same row, in place, only the first lengths[i] entries of
+    row i belong to the track, NaN entries before the first or after the last valid entry take the nearest valid value, rows without any
+    valid entry are set to 0
+    """
+    n, time_points = matrix.shape
+    columns = np.arange(time_points)
+    inside = columns[np.newaxis, :] < np.asarray(lengths)[:, np.newaxis]
+    valid = inside & ~np.isnan(matrix)
+    missing = inside & ~valid
+    if not missing.any():
+        return matrix
+
+    previous = np.maximum.accumulate(np.where(valid, columns, -1), axis=1)
+    following = np.minimum.accumulate(np.where(valid, columns, time_points)[:, ::-1], axis=1)[:, ::-1]
+    rows, cols = np.nonzero(missing)
+    before, after = previous[rows, cols], following[rows, cols]
+    has_before, has_after = before >= 0, after < time_points
+    value_before = matrix[rows, np.clip(before, 0, time_points - 1)]
+    value_after = matrix[rows, np.clip(after, 0, time_points - 1)]
+
+    weight = np.where(has_before & has_after, (cols - before) / np.maximum(after - before, 1), 0)
+    filled = np.where(has_before, value_before, value_after)
+    filled = np.where(has_before & has_after, value_before + weight * (value_after - value_before), filled)
+    matrix[rows, cols] = np.where(has_before | has_after, filled, 0)
+
+    return matrix
+
+
+def track_matrices(
+    tracks, time_points: int, keys: tuple = ("class_id",), dtype: str = "float64", fill_nan: bool = True
+) -> dict[str, npt.NDArray]:
+    """
+    Builds one dense (n_tracks, time_points) matrix per key from ragged per-track values, row i holds track i starting at coloumn 0
+    -------------------------------------------------------------------------------------------------------------------------------
+    INPUTS:
+        tracks: btrack tracks object or list of tracking.Track
+        time_points: int, number of coloumns, values beyond it are dropped
+        keys: tuple, 'x', 'y', 't' or names of track properties
+        dtype: str, dtype of the matrices, 'float32' halves memory on large experiments
+        fill_nan: bool, if True NaN values (dummy observations) are interpolated within each track with fill_nan_rows()
+    OUTPUTS:
+        matrices: dict, one matrix per key, entries past the end of a track are 0
+    """
+    tracks = list(tracks)
+    lengths = np.fromiter((len(cell.x) for cell in tracks), dtype=int, count=len(tracks))
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    rows = np.repeat(np.arange(len(tracks)), lengths)
+    cols = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+    kept = cols < time_points
+
+    matrices = {}
+    for key in keys:
+        if key in ("x", "y", "t"):
+            values = [np.asarray(getattr(cell, key), dtype=dtype) for cell in tracks]
+        else:
+            values = [np.asarray(cell.properties[key], dtype=dtype) for cell in tracks]
+        values = np.concatenate(values) if values else np.zeros(0, dtype=dtype)
+
+        matrix = np.zeros((len(tracks), time_points), dtype=dtype)
+        matrix[rows[kept], cols[kept]] = values[kept]
+        if fill_nan:
+            fill_nan_rows(matrix, np.minimum(lengths, time_points))
+        matrices[key] = matrix
+
+    return matrices
+
+
 def time_in_mitosis(
     state_matrix : npt.NDArray, interframe_duration: float
 ) -> tuple[ npt.NDArray, npt.NDArray, int]:
@@ -133,17 +250,8 @@ def time_in_mitosis(
         avg_time_in_mitosis: int
     """
 
-    last_frame_mitotic = [
-        row_index
-        for row_index in range(state_matrix.shape[0])
-        if state_matrix[row_index, -1] == 1
-    ]
-
     state_matrix_cleaned = state_matrix
-    for row_index in last_frame_mitotic:
-        state_matrix_cleaned[row_index, :] = [
-            0 for state in state_matrix_cleaned[row_index, :]
-        ]
+    state_matrix_cleaned[state_matrix_cleaned[:, -1] == 1, :] = 0
 
     state_duration_vec = np.sum(state_matrix_cleaned, axis=1) * interframe_duration
     total_time = np.sum(state_duration_vec)
@@ -155,32 +263,19 @@ def time_in_mitosis(
     return state_matrix_cleaned, state_duration_vec, avg_time_in_mitosis
 
 
-def cell_intensity(tracks, time_points: int) -> tuple[npt.NDArray, npt.NDArray]:
+def cell_intensity(tracks, time_points: int, dtype: str = "float64") -> tuple[npt.NDArray, npt.NDArray]:
     """
     Takes in a tracks object from btrack and an interframe duration, returns a matrix containing the average intensity of each cell at each timepoint
     ---------------------------------------------------------------------------------------------------------------------------------------------------
     INPUTS:
         tracks: btrack tracks object
         time_points: int
+        dtype: str, dtype of the output matrix
     OUTPUTS:
         intensity_matric: npt.NDArray, indexed like "intensity_matrix[cell, timepoint]"
         avg_intensity_vec: npt.NDArray
     """
-    intensity_matrix = []
-    for cell in tracks:
-        intensity_matrix_row = np.zeros(shape=(time_points,))
-        intensity_matrix_row[0 : len(cell.properties["intensity_mean"])] = (
-            cell.properties["intensity_mean"]
-        )
-        intensity_matrix.append(intensity_matrix_row)
-
-    intensity_matrix = np.asarray(intensity_matrix)
-
-    mask = np.isnan(intensity_matrix)  # may not be the optimal way to handle NaN values
-    intensity_matrix[mask] = np.interp(
-        np.flatnonzero(mask), np.flatnonzero(~mask), intensity_matrix[~mask]
-    )
-
+    intensity_matrix = track_matrices(tracks, time_points, ("intensity_mean",), dtype)["intensity_mean"]
     avg_intensity_vec = np.sum(intensity_matrix, axis=1) / time_points
 
     return intensity_matrix, avg_intensity_vec
@@ -223,6 +318,51 @@ def mitotic_intensity(
     return mitotic_intensity_vec
 
 
+def normalize_intensity(
+    intensity_matrix: npt.NDArray,
+    x_coords: npt.NDArray,
+    y_coords: npt.NDArray,
+    intensity_map: npt.NDArray,
+    background_movie: npt.NDArray,
+) -> npt.NDArray:
+    """
+    Divides each (track, frame) intensity by the intensity map and subtracts the background movie at the track's position, with one gather for all entries
+    ---------------------------------------------------------------------------------------------------------------------------------------------------------
+    INPUTS:
+        intensity_matrix: npt.NDArray, (n_tracks, time_points) as returned by analyze_raw()
+        x_coords, y_coords: npt.NDArray, matrices of the same shape, floored and used as intensity_map[x, y] and background_movie[frame, x, y]
+        intensity_map: npt.NDArray, 2D flat field
+        background_movie: npt.NDArray, (time_points, ...) background per frame, may be a np.memmap (i.e. tiff.memmap), only the gathered pixels are read
+    OUTPUTS:
+        normalized: npt.NDArray, float64, entries whose coordinates are NaN or fall outside the maps are NaN
+    """
+    try:
+        assert intensity_matrix.shape == x_coords.shape == y_coords.shape
+    except AssertionError:
+        raise AssertionError("The intensity matrix and coordinate matrices must be of the same shape")
+
+    frames = np.broadcast_to(np.arange(intensity_matrix.shape[1]), intensity_matrix.shape)
+    with np.errstate(invalid="ignore"):
+        x = np.floor(x_coords)
+        y = np.floor(y_coords)
+    valid = (
+        ~np.isnan(x)
+        & ~np.isnan(y)
+        & (x >= 0)
+        & (y >= 0)
+        & (x < min(intensity_map.shape[0], background_movie.shape[1]))
+        & (y < min(intensity_map.shape[1], background_movie.shape[2]))
+        & (frames < background_movie.shape[0])
+    )
+    x = x[valid].astype("int64")
+    y = y[valid].astype("int64")
+
+    normalized = np.full(intensity_matrix.shape, np.nan, dtype="float64")
+    normalized[valid] = intensity_matrix[valid] / intensity_map[x, y] - background_movie[frames[valid], x, y]
+
+    return normalized
+
+
 def write_output(
     data: list[npt.NDArray],
     directory: str,
@@ -297,91 +437,118 @@ def timepoints_in_mitosis(state_matrix: npt.NDArray):
         index_vec: list[list], vector of strings, each string specifies the timepoints at which the track was mitotic, i.e -14-15-16-17 corresponds to the track being mitotic from the 14-17th frames
     """
 
-    index_vec = []
-    for row in range(state_matrix.shape[0]):
-        mitotic_index_str = ""
-        mitotic_index_vec = [
-            index for index, value in enumerate(state_matrix[row]) if value > 0
-        ]
-        for index in mitotic_index_vec:
-            mitotic_index_str += f"-{index}"
-        if mitotic_index_str == "":
-            mitotic_index_str = "None"
-        index_vec.append([mitotic_index_str])
-
-    return index_vec
-
-
-def analyze_raw(
-    tracks, instance_movie
-) -> tuple[npt.NDArray, npt.NDArray, npt.NDArray, npt.NDArray]:
-
-    state_matrix = []
-    intensity_matrix = []
-    x_coords = []
-    y_coords = []
-    time_points = instance_movie.shape[0]
-    for cell in tracks:
-        state_matrix_row = np.zeros(shape=(time_points,))
-        state_matrix_row[0 : len(cell.properties["class_id"])] = cell.properties[
-            "class_id"
-        ]
-        state_matrix.append(state_matrix_row)
-
-        intensity_matrix_row = np.zeros(shape=(time_points,))
-        intensity_matrix_row[0 : len(cell.properties["intensity_mean"])] = (
-            cell.properties["intensity_mean"]
-        )
-        intensity_matrix.append(intensity_matrix_row)
+    if state_matrix.shape[0] == 0:
+        return []
 
-        x_coords_row = np.zeros(shape=(time_points,))
-        x_coords_row[0 : len(cell.x)] = cell.x
-        x_coords.append(x_coords_row)
+    rows, cols = np.nonzero(state_matrix > 0)
+    splits = np.searchsorted(rows, np.arange(1, state_matrix.shape[0]))
+    index_vec = [
+        ["".join(f"-{index}" for index in row_cols.tolist()) or "None"]
+        for row_cols in np.split(cols, splits)
+    ]
 
-        y_coords_row = np.zeros(shape=(time_points,))
-        y_coords_row[0 : len(cell.y)] = cell.y
-        y_coords.append(y_coords_row)
+    return index_vec
 
-    state_matrix = np.asarray(state_matrix)
-    mask = np.isnan(state_matrix)  # may not be the optimal way to handle NaN values
-    state_matrix[mask] = np.interp(
-        np.flatnonzero(mask), np.flatnonzero(~mask), state_matrix[~mask]
-    )
 
-    intensity_matrix = np.asarray(intensity_matrix)
-    mask = np.isnan(intensity_matrix)  # may not be the optimal way to handle NaN values
-    intensity_matrix[mask] = np.interp(
-        np.flatnonzero(mask), np.flatnonzero(~mask), intensity_matrix[~mask]
-    )
+def mitotic_episodes(
+    state_matrix: npt.NDArray,
+    intensity_matrix: Optional[npt.NDArray] = None,
+    interframe_duration: float = 1,
+    threshold: float = 0.5,
+    lengths: Optional[npt.NDArray] = None,
+) -> pd.DataFrame:
+    """
+    Run-length encodes the mitotic intervals of every track at once, one row per uninterrupted mitotic episode
+    ----------------------------------------------------------------------------------------------------------
+    INPUTS:
+        state_matrix: npt.NDArray, (n_tracks, time_points) matrix as returned by analyze_raw(), entries >= threshold are mitotic
+        intensity_matrix: npt.NDArray, matrix of the same shape, if given the mean intensity of each episode is returned, NaN values are skipped
+        interframe_duration: float
+        threshold: float, state values >= threshold count as mitotic, as in mitotic_intensity()
+        lengths: npt.NDArray, number of observations of each track, episodes reaching it are right censored, defaults to time_points
+    OUTPUTS:
+        episodes: pd.DataFrame, coloumns
+            track: row of the track in state_matrix
+            episode: index of the episode within its track
+            start, end: first and last mitotic coloumn (inclusive)
+            frames: number of mitotic frames, duration: frames * interframe_duration
+            left_censored: the episode starts at the first observation of the track
+            right_censored: the episode lasts until the last observation of the track
+            mean_intensity: only if intensity_matrix is given
+    """
+    n, time_points = state_matrix.shape
+    if lengths is None:
+        lengths = np.full(n, time_points)
+    lengths = np.minimum(np.asarray(lengths, dtype="int64"), time_points)
+
+    mitotic = np.zeros((n, time_points + 2), dtype="int8")
+    mitotic[:, 1:-1] = state_matrix >= threshold
+    mitotic[:, 1:-1] &= np.arange(time_points)[np.newaxis, :] < lengths[:, np.newaxis]
+    edges = np.diff(mitotic, axis=1)
+    tracks, starts = np.nonzero(edges == 1)
+    _, stops = np.nonzero(edges == -1)  # exclusive, nonzero is row major so starts and stops pair up
+
+    first_episode = np.searchsorted(tracks, tracks, side="left")
+    frames = stops - starts
+    episodes = {
+        "track": tracks,
+        "episode": np.arange(tracks.shape[0]) - first_episode,
+        "start": starts,
+        "end": stops - 1,
+        "frames": frames,
+        "duration": frames * interframe_duration,
+        "left_censored": starts == 0,
+        "right_censored": stops == lengths[tracks],
+    }
+
+    if intensity_matrix is not None:
+        try:
+            assert intensity_matrix.shape == state_matrix.shape
+        except AssertionError:
+            raise AssertionError("The state matrix and intensity matrix must be of the same shape")
+        valid = ~np.isnan(intensity_matrix)
+        padded_sum = np.zeros((n, time_points + 1), dtype="float64")
+        padded_count = np.zeros((n, time_points + 1), dtype="int64")
+        np.cumsum(np.where(valid, intensity_matrix, 0), axis=1, out=padded_sum[:, 1:])
+        np.cumsum(valid, axis=1, out=padded_count[:, 1:])
+        total = padded_sum[tracks, stops] - padded_sum[tracks, starts]
+        count = padded_count[tracks, stops] - padded_count[tracks, starts]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            episodes["mean_intensity"] = np.where(count > 0, total / count, np.nan)
+
+    return pd.DataFrame(episodes)
 
-    x_coords = np.asarray(x_coords)
-    mask = np.isnan(x_coords)  # may not be the optimal way to handle NaN values
-    x_coords[mask] = np.interp(
-        np.flatnonzero(mask), np.flatnonzero(~mask), x_coords[~mask]
-    )
 
-    y_coords = np.asarray(y_coords)
-    mask = np.isnan(y_coords)  # may not be the optimal way to handle NaN values
-    y_coords[mask] = np.interp(
-        np.flatnonzero(mask), np.flatnonzero(~mask), y_coords[~mask]
+def analyze_raw(
+    tracks, instance_movie, dtype: str = "float64"
+) -> tuple[npt.NDArray, npt.NDArray, npt.NDArray, npt.NDArray]:
+    """
+    Builds (n_tracks, time_points) state, intensity, x and y matrices from tracks, NaN values are interpolated within each track
+    -----------------------------------------------------------------------------------------------------------------------------
+    INPUTS:
+        tracks: btrack tracks object or list of tracking.Track
+        instance_movie: npt.NDArray, its first dimension gives the number of time points
+        dtype: str, dtype of the matrices, 'float32' halves memory on large experiments
+    OUTPUTS:
+        state_matrix, intensity_matrix, x_coords, y_coords: npt.NDArray
+    """
+    matrices = track_matrices(
+        tracks, instance_movie.shape[0], ("class_id", "intensity_mean", "x", "y"), dtype
     )
 
-    return state_matrix, intensity_matrix, x_coords, y_coords
+    return matrices["class_id"], matrices["intensity_mean"], matrices["x"], matrices["y"]
 
 
-def gen_intensitymap(image: npt.NDArray) -> npt.NDArray:
+def gen_intensitymap(image: npt.NDArray, downsample: int = 1) -> npt.NDArray:
     """
     Computes the intensity map for flouresence microscopy intensity normalization if the input is a blank with flourescent media
     ----------------------------------------------------------------------------------------------------------------------------
     INPUTS:
-        image: npt.NDArray
+        image: npt.NDArray, (t, y, x) blank stack, may be memory-mapped
+        downsample: int, the median and gaussian smoothing run at 1 / downsample resolution, 1 (the default) smooths at full resolution
+                    as before, 8 is about 100 times faster for large fields
     OUTPUTPS:
         intensity_map: npt.NDArray
     """
 
-    mean_plane = projection(image, "average")
-    med_filtered_mean_plane = scipy.ndimage.median_filter(mean_plane, 9)
-    smoothed_mean_plane = skimage.filters.gaussian(med_filtered_mean_plane, 45)
-    intensity_map = smoothed_mean_plane / (np.max(smoothed_mean_plane))
-
-    return intensity_map
+    return flatfield.intensity_map(image, downsample=downsample)
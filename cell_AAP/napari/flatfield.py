@@ -0,0 +1,157 @@
+import os
+import json
+import hashlib
+import cv2
+import scipy
+import numpy as np
+import numpy.typing as npt
+from typing import Optional
+from cell_AAP.annotation.resample import resample  # type:ignore
+from cell_AAP.napari.projections import stream_projection  # type:ignore
+
+
+def mean_projection(stack, chunk_frames: int = 16, num_workers: int = 1) -> npt.NDArray:
+    "Average projection over the middle half of the stack, streamed as in analysis.projection(stack, 'average')"
+
+    return stream_projection(stack, ("average",), chunk_frames=chunk_frames, num_workers=num_workers)["average"]
+
+
+def intensity_map(
+    blank_stack,
+    downsample: int = 8,
+    median_size: int = 9,
+    sigma: float = 45,
+    chunk_frames: int = 16,
+) -> npt.NDArray:
+    """
+    Computes the intensity map for flouresence intensity normalization from a blank with flourescent media
+    ------------------------------------------------------------------------------------------------------
+    INPUTS:
+        blank_stack: n-darray, (t, y, x) stack, may be memory-mapped, it is streamed through mean_projection()
+        downsample: int, factor the projection is reduced by before smoothing, 1 reproduces analysis.gen_intensitymap() exactly
+        median_size: int, size of the median filter at full resolution
+        sigma: float, sigma of the gaussian at full resolution
+        chunk_frames: int, number of frames read at once
+    OUTPUTS:
+        intensity_map: n-darray, float32 map of the projection's shape normalized to a maximum of 1, the median and gaussian are
+                       applied at 1 / downsample resolution with their sizes scaled to match, then the plane is upsampled bilinearly
+    """
+    mean_plane = mean_projection(blank_stack, chunk_frames)
+    full_shape = mean_plane.shape
+    if downsample > 1:
+        small_shape = (max(1, full_shape[0] // downsample), max(1, full_shape[1] // downsample))
+        mean_plane = resample(mean_plane, small_shape, method="mean")
+
+    scale = mean_plane.shape[0] / full_shape[0]
+    median_plane = scipy.ndimage.median_filter(mean_plane, max(1, round(median_size * scale)))
+    smoothed_plane = scipy.ndimage.gaussian_filter(median_plane, sigma * scale, mode="nearest", truncate=4.0)
+    if smoothed_plane.shape != full_shape:
+        smoothed_plane = cv2.resize(smoothed_plane, full_shape[::-1], interpolation=cv2.INTER_LINEAR)
+
+    return (smoothed_plane / np.max(smoothed_plane)).astype("float32")
+
+
+def correct_frame(
+    frame: npt.NDArray,
+    intensity_map: npt.NDArray,
+    background: Optional[npt.NDArray] = None,
+) -> npt.NDArray:
+    "Flat-field corrects one frame as frame / intensity_map - background, in float32"
+
+    corrected = np.divide(frame, intensity_map, dtype="float32")
+    if background is not None:
+        corrected -= background
+    return corrected
+
+
+class FlatFieldCorrected:
+    """
+    Read-only (t, y, x) view of a movie that is flat-field corrected frame by frame as it is indexed, so corrected movies are never
+    held in memory, movie[t] returns correct_frame(movie[t], intensity_map, background[t]) and np.asarray(movie) corrects every frame
+    """
+
+    def __init__(self, movie, intensity_map: npt.NDArray, background_movie=None):
+        try:
+            assert tuple(movie.shape[1:]) == intensity_map.shape
+        except AssertionError:
+            raise AssertionError(
+                f"The intensity map {intensity_map.shape} and movie frames {tuple(movie.shape[1:])} must be of the same shape"
+            )
+        self.movie = movie
+        self.intensity_map = intensity_map
+        self.background_movie = background_movie
+
+    @property
+    def shape(self) -> tuple:
+        return tuple(self.movie.shape)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, t: int) -> npt.NDArray:
+        background = None if self.background_movie is None else np.asarray(self.background_movie[t])
+        return correct_frame(np.asarray(self.movie[t]), self.intensity_map, background)
+
+    def __iter__(self):
+        for t in range(len(self)):
+            yield self[t]
+
+    def __array__(self, dtype=None):
+        corrected = np.empty(self.shape, dtype="float32")
+        for t in range(len(self)):
+            corrected[t] = self[t]
+        return corrected if dtype == None else corrected.astype(dtype)
+
+
+def acquisition_key(settings: dict) -> str:
+    "Stable short hash of a json-serializable dict of acquisition settings, i.e. {'channel': 'GFP', 'exposure': 200, 'binning': 2}"
+
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+class FlatFieldCache:
+    """
+    Directory of intensity maps keyed by acquisition setting, '{key}.npy' holds the map and '{key}.json' the settings and parameters
+    it was computed with, maps are computed from a blank once and then loaded
+
+        cache = FlatFieldCache(cache_dir)
+        intensity_map = cache.get({"channel": "GFP", "exposure": 200}, blank_stack = tiff.memmap(blank_path))
+    """
+
+    def __init__(self, cache_dir: str, downsample: int = 8, median_size: int = 9, sigma: float = 45):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.parameters = {"downsample": downsample, "median_size": median_size, "sigma": sigma}
+        self.maps = {}
+
+    def path(self, settings: dict) -> str:
+        return os.path.join(self.cache_dir, f"{acquisition_key(dict(settings, **self.parameters))}.npy")
+
+    def __contains__(self, settings: dict) -> bool:
+        return os.path.exists(self.path(settings))
+
+    def get(self, settings: dict, blank_stack=None) -> npt.NDArray:
+        """
+        Intensity map for settings, from memory, then from disk, otherwise computed from blank_stack and cached
+        """
+        path = self.path(settings)
+        if path in self.maps:
+            return self.maps[path]
+
+        if os.path.exists(path):
+            self.maps[path] = np.load(path)
+            return self.maps[path]
+
+        if blank_stack is None:
+            raise ValueError(f"No intensity map is cached for {settings}, a blank_stack is needed to compute it")
+
+        self.maps[path] = intensity_map(blank_stack, **self.parameters)
+        np.save(path, self.maps[path])
+        with open(path[: -len(".npy")] + ".json", "w") as settings_file:
+            json.dump({"settings": settings, "parameters": self.parameters}, settings_file, default=str)
+
+        return self.maps[path]
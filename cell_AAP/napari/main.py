@@ -7,6 +7,8 @@ import cell_AAP.napari.ui as ui  # type:ignore
 import cell_AAP.annotation.annotation_utils as au  # type:ignore
 import cell_AAP.napari.fileio as fileio  # type: ignore
 import cell_AAP.napari.analysis as analysis  # type: ignore
+import cell_AAP.models as models  # type: ignore
+from cell_AAP.scripts.inference_server import InferenceClient, parse_address  # type: ignore
 
 import numpy as np
 import cv2
@@ -17,14 +19,8 @@ import torch
 import skimage.measure
 from skimage.filters import gaussian
 from skimage.morphology import binary_erosion, disk
-import pooch
 
 from detectron2.utils.logger import setup_logger
-from detectron2.engine import DefaultPredictor
-from detectron2.engine.defaults import create_ddp_model
-from detectron2.config import get_cfg
-from detectron2.checkpoint import DetectionCheckpointer
-from detectron2.config import LazyConfig, instantiate
 from qtpy import QtWidgets, _warn_old_minor_version
 import timm
 from typing import Optional
@@ -121,6 +117,12 @@ def inference(
         cellaap_widget: instance of ui.cellAAPWidget()
     """
 
+    if getattr(cellaap_widget, "inference_client", None) != None:
+        return list(
+            cellaap_widget.inference_client.infer(cellaap_widget.model_key, [img], [frame_num])
+        )[0]
+
+    models.POOL.apply(cellaap_widget.predictor, *cellaap_widget.test_params)
     if cellaap_widget.model_type == "yacs":
         if img.shape != (2048, 2048):
             img = au.square_reshape(img, (2048, 2048))
@@ -129,11 +131,9 @@ def inference(
     else:
         if img.shape != (1024, 1024):
             img = au.square_reshape(img, (1024, 1024))
-        img_perm = np.moveaxis(img, -1, 0)
-
         with torch.inference_mode():
             output = cellaap_widget.predictor(
-                [{"image": torch.from_numpy(img_perm).type(torch.float32)}]
+                [{"image": au.rgb_tensor(img)}]
             )[0]
 
     segmentations = output["instances"].pred_masks.to("cpu")
@@ -298,126 +298,42 @@ def configure(cellaap_widget: ui.cellAAPWidget):
     ------------------------------------------------
     INPUTS:
         cellaap_widget: instance of ui.cellAAPWidget()
-    """
 
-    model, model_type, weights_name, config_name = get_model(cellaap_widget)
-    if model_type == "yacs":
-        cellaap_widget.model_type = "yacs"
-        cellaap_widget.cfg = get_cfg()
-        cellaap_widget.cfg.merge_from_file(model.fetch(f"{config_name}"))
-        cellaap_widget.cfg.MODEL.WEIGHTS = model.fetch(f"{weights_name}")
-
-        if torch.cuda.is_available():
-            cellaap_widget.cfg.MODEL.DEVICE = "cuda"
-        else:
-            cellaap_widget.cfg.MODEL.DEVICE = "cpu"
-
-        if cellaap_widget.confluency_est.value():
-            cellaap_widget.cfg.TEST.DETECTIONS_PER_IMAGE = (
-                cellaap_widget.confluency_est.value()
-            )
-        if cellaap_widget.thresholder.value():
-            cellaap_widget.cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = (
-                cellaap_widget.thresholder.value()
-            )
-        predictor = DefaultPredictor(cellaap_widget.cfg)
-
-    else:
-        cellaap_widget.model_type = "lazy"
-        cellaap_widget.cfg = LazyConfig.load(model.fetch(f"{config_name}"))
-        cellaap_widget.cfg.train.init_checkpoint = model.fetch(f"{weights_name}")
-
-        if torch.cuda.is_available():
-            cellaap_widget.cfg.train.device = "cuda"
-        else:
-            cellaap_widget.cfg.train.device = "cpu"
-
-        if cellaap_widget.confluency_est.value():
-            cellaap_widget.cfg.model.proposal_generator.post_nms_topk[1] = (
-                cellaap_widget.confluency_est.value()
-            )
+    If the environment variable CELL_AAP_INFERENCE_SERVER holds the address of a running inference_server, the model is warmed
+    there and inference() sends frames to it instead of loading the model in napari
+    """
 
-        if cellaap_widget.thresholder.value():
-            cellaap_widget.cfg.model.roi_heads.box_predictor.test_score_thresh = (
-                cellaap_widget.thresholder.value()
-            )
+    server_address = os.environ.get("CELL_AAP_INFERENCE_SERVER")
+    if server_address != None:
+        if getattr(cellaap_widget, "inference_client", None) == None:
+            cellaap_widget.inference_client = InferenceClient(parse_address(server_address))
+        cellaap_widget.model_key, cellaap_widget.model_type = cellaap_widget.inference_client.configure(
+            cellaap_widget.model_selector.currentText(),
+            cellaap_widget.confluency_est.value(),
+            cellaap_widget.thresholder.value(),
+        )
+        napari.utils.notifications.show_info(f"Configurations successfully saved on {server_address}")
+        cellaap_widget.configured = True
+        return
 
-        predictor = instantiate(cellaap_widget.cfg.model)
-        predictor.to(cellaap_widget.cfg.train.device)
-        predictor = create_ddp_model(predictor)
-        DetectionCheckpointer(predictor).load(cellaap_widget.cfg.train.init_checkpoint)
-        predictor.eval()
+    cellaap_widget.inference_client = None
+    model_name = models.resolve(cellaap_widget.model_selector.currentText())
+    cellaap_widget.model_type = models.config_type(model_name)
+    # the network is only loaded the first time a model is selected, later calls only change its test-time parameters
+    cellaap_widget.test_params = (
+        cellaap_widget.confluency_est.value() or None,
+        cellaap_widget.thresholder.value() or None,
+    )
+    predictor = models.POOL.get(
+        model_name, "cuda" if torch.cuda.is_available() else "cpu", *cellaap_widget.test_params
+    )
+    cellaap_widget.cfg = models.POOL.entry(predictor)["cfg"]
 
     napari.utils.notifications.show_info(f"Configurations successfully saved")
     cellaap_widget.configured = True
     cellaap_widget.predictor = predictor
 
 
-def get_model(cellaap_widget):
-    """
-    Instaniates POOCH instance containing model files from the model_registry
-    --------------------------------------------------------------------------
-    INPUTS:
-        cellaap_widget: instance of ui.cellAAPWidget()I
-    """
-
-    model_name = cellaap_widget.model_selector.currentText()
-
-    url_registry = {
-        "HeLa": "doi:10.5281/zenodo.14226948",
-        "U2OS": "doi:10.5281/zenodo.14226985",
-        "HeLa_O": "doi:10.5281/zenodo.14502793"
-    }
-
-    weights_registry = {
-        "HeLa": (
-            "model_0043499.pth",
-            "md5:ad056dc159ea8fd12f7d5d4562c368a9",
-        ),
-        "U2OS": (
-            "model_0030449.pth",
-            "md5:4d65600b92560d7fcda6c6fd59fa0fe8"
-        ),
-        "HeLa_O": (
-            "model_final.pth",
-            "md5:d7201b05ad8881c8b496930306ea6071"
-        )
-    }
-
-    configs_registry = {
-        "HeLa": (
-            "config.yaml",
-            "md5:319ec68250d7ae499a274f7c4f151513",
-            "lazy",
-        ),
-        "U2OS" : (
-            "config.yaml",
-            "md5:ad80d579860c53a84ab076c4db2604fd",
-            "lazy"
-        ),
-        "HeLa_O": (
-            "config.yaml",
-            "md5:6f0264cf8aba3703a3cc0c51dbc20111",
-            "lazy"
-        )
-    }
-
-    model = pooch.create(
-        path=pooch.os_cache("cell_aap"),
-        base_url=url_registry[f"{model_name}"],
-        registry={
-            weights_registry[f"{model_name}"][0]: weights_registry[f"{model_name}"][1],
-            configs_registry[f"{model_name}"][0]: configs_registry[f"{model_name}"][1],
-        },
-    )
-
-    model_type = configs_registry[f"{model_name}"][2]
-    weights_name = weights_registry[f"{model_name}"][0]
-    config_name = configs_registry[f"{model_name}"][0]
-
-    return model, model_type, weights_name, config_name
-
-
 def color_masks(
     segmentations: np.ndarray,
     labels,
@@ -0,0 +1,145 @@
+import numpy as np
+import numpy.typing as npt
+import tifffile as tiff
+from typing import Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+
+PROJECTION_TYPES = ("max", "min", "average")
+
+
+def center_window(n_frames: int) -> tuple[int, int]:
+    "Frames [start, stop) projection() reduces over by default, the middle half of the stack"
+
+    if n_frames % 2 == 0:
+        center_index = n_frames // 2 - 1
+    else:
+        center_index = n_frames // 2
+    half_width = center_index // 2
+
+    return center_index - half_width, center_index + half_width
+
+
+class RunningProjection:
+    """
+    Running max / min / sum accumulators over chunks of frames, chunks may arrive in any order and accumulators of different
+    chunks can be merged, result() returns the projections
+    """
+
+    def __init__(self, projection_types: tuple[str, ...]):
+        self.projection_types = tuple(projection_types)
+        self.max = None
+        self.min = None
+        self.sum = None
+        self.count = 0
+
+    def update(self, chunk: npt.NDArray):
+        "Reduces a (t, y, x) chunk into the accumulators"
+
+        if chunk.shape[0] == 0:
+            return
+        if "max" in self.projection_types:
+            chunk_max = chunk.max(axis=0)
+            self.max = chunk_max if self.max is None else np.maximum(self.max, chunk_max, out=self.max)
+        if "min" in self.projection_types:
+            chunk_min = chunk.min(axis=0)
+            self.min = chunk_min if self.min is None else np.minimum(self.min, chunk_min, out=self.min)
+        if "average" in self.projection_types:
+            chunk_sum = chunk.sum(axis=0, dtype="float64")
+            self.sum = chunk_sum if self.sum is None else np.add(self.sum, chunk_sum, out=self.sum)
+        self.count += chunk.shape[0]
+
+    def merge(self, other: "RunningProjection"):
+        "Folds the accumulators of another RunningProjection over different frames into this one"
+
+        for name, ufunc in (("max", np.maximum), ("min", np.minimum), ("sum", np.add)):
+            theirs = getattr(other, name)
+            if theirs is not None:
+                ours = getattr(self, name)
+                setattr(self, name, theirs if ours is None else ufunc(ours, theirs, out=ours))
+        self.count += other.count
+
+    def result(self) -> dict[str, npt.NDArray]:
+        try:
+            assert self.count > 0
+        except AssertionError:
+            raise AssertionError("Cannot project an empty range of frames")
+
+        projections = {}
+        for projection_type in self.projection_types:
+            if projection_type == "average":
+                projections[projection_type] = self.sum / self.count
+            else:
+                projections[projection_type] = getattr(self, projection_type)
+        return projections
+
+
+def stream_projection(
+    source: Union[npt.NDArray, str],
+    projection_types: tuple[str, ...] = ("max",),
+    window: Optional[tuple[int, int]] = None,
+    chunk_frames: int = 16,
+    num_workers: int = 1,
+) -> dict[str, npt.NDArray]:
+    """
+    Projects a stack along its first axis chunk_frames frames at a time, computing several projections in a single pass
+    --------------------------------------------------------------------------------------------------------------------
+    INPUTS:
+        source: n-darray, np.memmap, tiff.memmap, tiff.TiffFile or path to a tiff file, only one chunk per worker is resident
+        projection_types: tuple, any of 'max', 'min', 'average'
+        window: tuple, frames [start, stop) to project, defaults to center_window()
+        chunk_frames: int, number of frames read and reduced at once
+        num_workers: int, number of threads chunks are reduced across, numpy releases the GIL while reducing and reading
+    OUTPUTS:
+        projections: dict, one (y, x) plane per projection type, max and min keep the source dtype, average is float64
+    """
+    try:
+        assert len(projection_types) > 0 and all(
+            projection_type in PROJECTION_TYPES for projection_type in projection_types
+        )
+    except AssertionError:
+        raise AssertionError(
+            f"Projection type(s) {projection_types} not valid, valid types include: {', '.join(PROJECTION_TYPES)}"
+        )
+
+    if isinstance(source, str):
+        try:
+            return stream_projection(
+                tiff.memmap(source, mode="r"), projection_types, window, chunk_frames, num_workers
+            )
+        except ValueError:  # compressed or tiled tiffs cannot be memory-mapped, read them page by page
+            with tiff.TiffFile(source) as tif:
+                return stream_projection(tif, projection_types, window, chunk_frames, num_workers)
+
+    if isinstance(source, tiff.TiffFile):
+        n_frames = len(source.pages)
+
+        def read(start: int, stop: int) -> npt.NDArray:
+            return source.asarray(key=range(start, stop)).reshape((stop - start,) + source.pages[0].shape)
+
+        # TiffFile reads through one file handle, threads would only contend for it
+        num_workers = 1
+    else:
+        n_frames = source.shape[0]
+
+        def read(start: int, stop: int) -> npt.NDArray:
+            return np.asarray(source[start:stop])
+
+    start, stop = center_window(n_frames) if window == None else window
+    chunks = [(k, min(k + chunk_frames, stop)) for k in range(start, stop, chunk_frames)]
+
+    def reduce_chunks(chunk_list: list[tuple[int, int]]) -> RunningProjection:
+        accumulator = RunningProjection(projection_types)
+        for chunk_start, chunk_stop in chunk_list:
+            accumulator.update(read(chunk_start, chunk_stop))
+        return accumulator
+
+    if num_workers > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            partials = list(executor.map(reduce_chunks, [chunks[i::num_workers] for i in range(num_workers)]))
+        accumulator = partials[0]
+        for other in partials[1:]:
+            accumulator.merge(other)
+    else:
+        accumulator = reduce_chunks(chunks)
+
+    return accumulator.result()
@@ -2,6 +2,7 @@ from __future__ import annotations
 from qtpy import QtWidgets
 from superqt import QLabeledRangeSlider
 from typing import Optional
+import cell_AAP.models as models  # type:ignore
 
 
 def create_file_selector_widgets() -> dict[str, QtWidgets.QWidget]:
@@ -75,9 +76,8 @@ def create_config_widgets() -> dict[str, tuple[str, QtWidgets.QWidget]]:
     """
 
     model_selector = QtWidgets.QComboBox()
-    model_selector.addItem("HeLa")
-    model_selector.addItem("U2OS")
-    model_selector.addItem("HeLa_O")
+    for model_name in models.model_names():
+        model_selector.addItem(model_name)
     widgets = {"model_selector": ("Select Model", model_selector)}
 
     thresholder = QtWidgets.QDoubleSpinBox()
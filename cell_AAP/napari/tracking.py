@@ -0,0 +1,629 @@
+import os
+import re
+import json
+import numpy as np
+import numpy.typing as npt
+from typing import Optional
+from functools import partial
+from scipy.spatial import cKDTree
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from skimage.measure import regionprops_table
+import cell_AAP.annotation.annotation_utils as au
+import cell_AAP.napari.flatfield as flatfield
+
+# stands in for infinite cost in the assignment matrices, linear_sum_assignment needs finite values
+BIG_COST = 1e12
+
+
+def frame_objects(
+    instance_frame: npt.NDArray,
+    intensity_frame: Optional[npt.NDArray] = None,
+    features: tuple = ("area", "solidity"),
+    min_area: float = 500,
+    min_solidity: float = 0.90,
+) -> dict[str, npt.NDArray]:
+    """
+    Measures the objects of one instance segmentation frame
+    -------------------------------------------------------
+    INPUTS:
+        instance_frame: n-darray, instance labels as written by color_masks(), even labels are non-mitotic and odd labels are mitotic
+        intensity_frame: n-darray, intensity image of the same shape
+        features: tuple, regionprops_table properties measured for each object
+        min_area: float, objects with area < min_area are dropped
+        min_solidity: float, objects with solidity < min_solidity are dropped
+    OUTPUTS:
+        objects: dict, 'y', 'x' centroids, 'class_id' (label % 2) and one array per feature, as in analysis.filter_objects
+    """
+    properties = tuple(dict.fromkeys(("label", "centroid", "area", "solidity") + tuple(features)))
+    if intensity_frame is None:
+        properties = tuple(prop for prop in properties if not prop.startswith("intensity"))
+    table = regionprops_table(
+        np.asarray(instance_frame).astype(int),
+        intensity_image=intensity_frame,
+        properties=properties,
+    )
+
+    keep = (table["area"] >= min_area) & (table["solidity"] >= min_solidity)
+    objects = {
+        "y": table["centroid-0"][keep],
+        "x": table["centroid-1"][keep],
+        "class_id": table["label"][keep] % 2,
+    }
+    for feature in features:
+        if feature in table:
+            objects[feature] = np.asarray(table[feature], dtype="float64")[keep]
+
+    return objects
+
+
+def objects_chunk(frames: list[tuple], features: tuple, min_area: float, min_solidity: float) -> list[dict]:
+    "Runs frame_objects on a chunk of (instance_frame, intensity_frame) pairs, module level so it can be sent to worker processes"
+
+    return [
+        frame_objects(instance_frame, intensity_frame, features, min_area, min_solidity)
+        for instance_frame, intensity_frame in frames
+    ]
+
+
+class Track:
+
+    "One track of LinearAssignmentTracker, exposes the x, y, t and properties attributes analysis reads from btrack tracks"
+
+    def __init__(self, ID: int, parent: Optional[int] = None, root: Optional[int] = None, generation: int = 0):
+        self.ID = ID
+        self.parent = ID if parent is None else parent
+        self.root = ID if root is None else root
+        self.generation = generation
+        self.children = []
+        self.t = []
+        self.x = []
+        self.y = []
+        self.dummy = []
+        self.properties = {}
+
+    def __len__(self):
+        return len(self.t)
+
+    def __repr__(self):
+        return f"Track(ID = {self.ID}, t = {self.start}-{self.stop}, parent = {self.parent})"
+
+    @property
+    def start(self) -> int:
+        return self.t[0]
+
+    @property
+    def stop(self) -> int:
+        return self.t[-1]
+
+    def append(self, t: int, x: float, y: float, properties: dict, dummy: bool = False):
+        "Adds one observation, properties missing from earlier observations are back-filled with NaN"
+
+        for key in properties:
+            if key not in self.properties:
+                self.properties[key] = [np.nan] * len(self.t)
+        for key, values in self.properties.items():
+            values.append(properties.get(key, np.nan))
+        self.t.append(t)
+        self.x.append(x)
+        self.y.append(y)
+        self.dummy.append(dummy)
+
+    def split(self, keep: int = 1):
+        "Moves all but the last keep observations into a new fragment with the same ID, which is returned"
+
+        fragment = Track(self.ID, self.parent, self.root, self.generation)
+        cut = len(self.t) - keep
+        fragment.t, self.t = self.t[:cut], self.t[cut:]
+        fragment.x, self.x = self.x[:cut], self.x[cut:]
+        fragment.y, self.y = self.y[:cut], self.y[cut:]
+        fragment.dummy, self.dummy = self.dummy[:cut], self.dummy[cut:]
+        for key, values in self.properties.items():
+            fragment.properties[key], self.properties[key] = values[:cut], values[cut:]
+
+        return fragment
+
+    def pop(self):
+        "Removes the last observation together with the dummy observations bridging to it"
+
+        for values in (self.t, self.x, self.y, self.dummy, *self.properties.values()):
+            values.pop()
+        while len(self.dummy) > 0 and self.dummy[-1]:
+            for values in (self.t, self.x, self.y, self.dummy, *self.properties.values()):
+                values.pop()
+
+    def previous_observation(self) -> Optional[int]:
+        "Index of the last real (non-dummy) observation before the latest one, None if there is none"
+
+        for k in range(len(self.t) - 2, -1, -1):
+            if not self.dummy[k]:
+                return k
+        return None
+
+    def fill_gap(self, t: int, x: float, y: float):
+        "Adds dummy observations with linearly interpolated positions and NaN properties for the frames between the last observation and t"
+
+        if len(self.t) == 0:
+            return
+        t0, x0, y0 = self.t[-1], self.x[-1], self.y[-1]
+        for gap_t in range(t0 + 1, t):
+            weight = (gap_t - t0) / (t - t0)
+            self.append(gap_t, x0 + weight * (x - x0), y0 + weight * (y - y0), {}, dummy=True)
+
+
+class LinearAssignmentTracker:
+    """
+    Frame-to-frame tracker solving one linear assignment problem per connected group of candidate links
+    -----------------------------------------------------------------------------------------------------
+    Each new frame is linked to the tracks seen in the last max_gap + 1 frames: candidates are found with a KD-tree on centroids
+    within max_search_radius, a link costs (distance / max_search_radius)^2 + area_weight * log(area ratio)^2 + class_weight if the
+    class changes + gap_weight per skipped frame, ending a track or starting a new one each cost alternative_cost so links costing
+    more than 2 * alternative_cost are never made.
+    Tracks that skipped frames are bridged with dummy observations (NaN properties) as btrack does.
+    A new object within division_radius of a mitotic (class_id 1) track that was linked in the same frame is treated as a division:
+    the mother track ends and both objects start daughter tracks whose parent is the mother.
+    """
+
+    def __init__(
+        self,
+        max_search_radius: float = 50,
+        max_gap: int = 2,
+        area_weight: float = 1.0,
+        class_weight: float = 0.5,
+        gap_weight: float = 0.5,
+        alternative_cost: float = 1.0,
+        division_radius: Optional[float] = None,
+        require_mitotic: bool = True,
+    ):
+        self.max_search_radius = max_search_radius
+        self.max_gap = max_gap
+        self.area_weight = area_weight
+        self.class_weight = class_weight
+        self.gap_weight = gap_weight
+        self.alternative_cost = alternative_cost
+        self.division_radius = max_search_radius if division_radius is None else division_radius
+        self.require_mitotic = require_mitotic
+        self.tracks = {}
+        self.active = []
+        self.next_ID = 1
+        self.frame = -1
+
+    @property
+    def configuration(self) -> dict:
+        return {
+            "engine": "lap",
+            "max_search_radius": self.max_search_radius,
+            "max_gap": self.max_gap,
+            "area_weight": self.area_weight,
+            "class_weight": self.class_weight,
+            "gap_weight": self.gap_weight,
+            "alternative_cost": self.alternative_cost,
+            "division_radius": self.division_radius,
+            "require_mitotic": self.require_mitotic,
+        }
+
+    def new_track(self, parent: Optional[Track] = None) -> Track:
+        if parent is None:
+            track = Track(self.next_ID)
+        else:
+            track = Track(self.next_ID, parent.ID, parent.root, parent.generation + 1)
+            parent.children.append(track.ID)
+        self.tracks[track.ID] = track
+        self.active.append(track)
+        self.next_ID += 1
+        return track
+
+    def link_costs(self, candidates: list[Track], objects: dict, frame: int) -> tuple[npt.NDArray, npt.NDArray, npt.NDArray]:
+        "Candidate (track, object) pairs within max_search_radius and their costs"
+
+        positions = np.column_stack([objects["x"], objects["y"]])
+        if len(candidates) == 0 or positions.shape[0] == 0:
+            empty = np.zeros(0, dtype=int)
+            return empty, empty, np.zeros(0)
+
+        last = np.asarray([[track.x[-1], track.y[-1]] for track in candidates])
+        neighbours = cKDTree(positions).query_ball_point(last, self.max_search_radius)
+        rows = np.repeat(np.arange(len(candidates)), [len(n) for n in neighbours])
+        cols = np.fromiter((j for n in neighbours for j in n), dtype=int, count=rows.shape[0])
+
+        distance = np.linalg.norm(last[rows] - positions[cols], axis=1)
+        costs = (distance / self.max_search_radius) ** 2
+        if "area" in objects:
+            last_area = np.asarray([track.properties["area"][-1] for track in candidates])
+            ratio = np.maximum(objects["area"][cols], 1) / np.maximum(last_area[rows], 1)
+            costs += self.area_weight * np.log(ratio) ** 2
+        last_class = np.asarray([track.properties["class_id"][-1] for track in candidates])
+        costs += self.class_weight * (last_class[rows] != objects["class_id"][cols])
+        gaps = frame - np.asarray([track.t[-1] for track in candidates]) - 1
+        costs += self.gap_weight * gaps[rows]
+
+        return rows, cols, costs
+
+    def assign(self, n_tracks: int, n_objects: int, rows, cols, costs) -> dict[int, int]:
+        """
+        Solves the augmented (tracks + objects) x (objects + tracks) assignment problem separately for every connected group of
+        candidate links, returns {track index: object index}
+        """
+        n = n_tracks + n_objects
+        graph = coo_matrix((np.ones(rows.shape[0]), (rows, n_tracks + cols)), shape=(n, n))
+        _, component = connected_components(graph, directed=False)
+
+        links = {}
+        if rows.shape[0] == 0:
+            return links
+        edge_component = component[rows]
+        order = np.argsort(edge_component, kind="stable")
+        for edges in np.split(order, np.flatnonzero(np.diff(edge_component[order])) + 1):
+            if edges.shape[0] == 1:
+                # a lone candidate link is made exactly when it is cheaper than ending one track and starting another
+                if costs[edges[0]] < 2 * self.alternative_cost:
+                    links[int(rows[edges[0]])] = int(cols[edges[0]])
+                continue
+
+            track_ids, track_index = np.unique(rows[edges], return_inverse=True)
+            object_ids, object_index = np.unique(cols[edges], return_inverse=True)
+            a, b = track_ids.shape[0], object_ids.shape[0]
+
+            link = np.full((a, b), BIG_COST)
+            link[track_index, object_index] = costs[edges]
+            matrix = np.full((a + b, b + a), BIG_COST)
+            matrix[:a, :b] = link
+            matrix[:a, b:][np.diag_indices(a)] = self.alternative_cost
+            matrix[a:, :b][np.diag_indices(b)] = self.alternative_cost
+            matrix[a:, b:] = np.where(link.T < BIG_COST, 0, BIG_COST)
+
+            row_ind, col_ind = linear_sum_assignment(matrix)
+            for i, j in zip(row_ind, col_ind):
+                if i < a and j < b and matrix[i, j] < BIG_COST:
+                    links[int(track_ids[i])] = int(object_ids[j])
+
+        return links
+
+    def update(self, objects: dict, frame: Optional[int] = None) -> list[Track]:
+        """
+        Links the objects of the next frame, as returned by frame_objects(), returns tracks that can no longer be extended
+        """
+        frame = self.frame + 1 if frame is None else frame
+        self.frame = frame
+        n_objects = objects["x"].shape[0]
+        per_object = [key for key in objects if key not in ("x", "y")]
+
+        candidates = [track for track in self.active if frame - track.stop - 1 <= self.max_gap]
+        rows, cols, costs = self.link_costs(candidates, objects, frame)
+        links = self.assign(len(candidates), n_objects, rows, cols, costs)
+
+        def observe(track: Track, j: int):
+            props = {key: float(objects[key][j]) for key in per_object}
+            track.fill_gap(frame, objects["x"][j], objects["y"][j])
+            track.append(frame, float(objects["x"][j]), float(objects["y"][j]), props)
+
+        linked = {}
+        for i, j in links.items():
+            observe(candidates[i], j)
+            linked[j] = candidates[i]
+
+        births = [j for j in range(n_objects) if j not in linked]
+        divided = set()
+        if births and linked:
+            linked_objects = np.asarray(list(linked.keys()))
+            tree = cKDTree(np.column_stack([objects["x"][linked_objects], objects["y"][linked_objects]]))
+            distances, nearest = tree.query(
+                np.column_stack([objects["x"][births], objects["y"][births]]),
+                distance_upper_bound=self.division_radius,
+            )
+            for j, distance, k in zip(list(births), distances, nearest):
+                if not np.isfinite(distance):
+                    continue
+                sibling = int(linked_objects[k])
+                mother = linked[sibling]
+                # the mother's state before this frame, gaps bridged by dummy observations are skipped
+                previous = mother.previous_observation()
+                if mother.ID in divided or previous is None:
+                    continue
+                if self.require_mitotic and mother.properties["class_id"][previous] != 1:
+                    continue
+
+                # the sibling observation moves from the mother to the first daughter
+                mother.pop()
+                for daughter_object in (sibling, j):
+                    observe(self.new_track(mother), daughter_object)
+                divided.add(mother.ID)
+                births.remove(j)
+
+        for j in births:
+            observe(self.new_track(), j)
+
+        finished = [
+            track
+            for track in self.active
+            if track.ID in divided or frame - track.stop > self.max_gap
+        ]
+        finished_IDs = {track.ID for track in finished}
+        self.active = [track for track in self.active if track.ID not in finished_IDs]
+
+        return finished
+
+    def finalize(self) -> list[Track]:
+        "Ends all active tracks and returns them"
+
+        finished, self.active = self.active, []
+        return finished
+
+    def to_napari(self, tracks: Optional[list[Track]] = None) -> tuple[npt.NDArray, dict, dict]:
+        """
+        Converts tracks to the (data, properties, graph) triple napari's add_tracks takes, as btrack's tracker.to_napari() does
+        ------------------------------------------------------------------------------------------------------------------------
+        OUTPUTS:
+            data: n-darray, (n, 4) rows of [ID, t, y, x]
+            properties: dict, t, generation, root, parent and every object property, one value per row
+            graph: dict, {daughter ID: [mother ID]}
+        """
+        tracks = sorted(self.tracks.values() if tracks is None else tracks, key=lambda track: track.ID)
+        return tracks_to_napari(tracks)
+
+
+def tracks_to_napari(tracks: list[Track]) -> tuple[npt.NDArray, dict, dict]:
+    "(data, properties, graph) of a list of Track, see LinearAssignmentTracker.to_napari()"
+
+    tracks = [track for track in tracks if len(track) > 0]
+    if len(tracks) == 0:
+        return np.zeros((0, 4)), {}, {}
+
+    data = np.concatenate(
+        [np.column_stack([np.full(len(track), track.ID), track.t, track.y, track.x]) for track in tracks]
+    )
+    keys = list(dict.fromkeys(key for track in tracks for key in track.properties))
+    properties = {
+        "t": data[:, 1].astype(int),
+        "generation": np.concatenate([np.full(len(track), track.generation) for track in tracks]),
+        "root": np.concatenate([np.full(len(track), track.root) for track in tracks]),
+        "parent": np.concatenate([np.full(len(track), track.parent) for track in tracks]),
+    }
+    for key in keys:
+        properties[key] = np.concatenate(
+            [np.asarray(track.properties.get(key, [np.nan] * len(track)), dtype="float64") for track in tracks]
+        )
+    graph = {track.ID: [track.parent] for track in tracks if track.parent != track.ID}
+
+    return data, properties, graph
+
+
+def movie_objects(
+    instance_movie: npt.NDArray,
+    intensity_movie: Optional[npt.NDArray] = None,
+    features: tuple = ("area", "solidity"),
+    min_area: float = 500,
+    min_solidity: float = 0.90,
+    num_workers: int = 1,
+) -> list[dict]:
+    "Runs frame_objects on every frame of a movie, frames are split across num_workers processes"
+
+    frames = [
+        (instance_movie[t], None if intensity_movie is None else intensity_movie[t])
+        for t in range(instance_movie.shape[0])
+    ]
+    return au.chunked_map(
+        partial(objects_chunk, features=tuple(features), min_area=min_area, min_solidity=min_solidity),
+        frames,
+        num_workers,
+        chunk_size=8,
+    )
+
+
+def lap_track(
+    instance_movie: npt.NDArray,
+    intensity_movie: Optional[npt.NDArray] = None,
+    features: tuple = ("area", "solidity"),
+    min_area: float = 500,
+    min_solidity: float = 0.90,
+    num_workers: int = 1,
+    **tracker_args,
+):
+    """
+    Tracks a whole movie with LinearAssignmentTracker
+    -------------------------------------------------
+    INPUTS:
+        instance_movie: npt.NDArray, (t, y, x) instance labels
+        intensity_movie: npt.NDArray, (t, y, x) intensity images of the same shape
+        features: tuple, regionprops_table properties stored for each observation
+        min_area, min_solidity: float, objects below either threshold are not tracked
+        num_workers: int, number of processes frames are measured across
+        tracker_args: keyword arguments of LinearAssignmentTracker
+    OUTPUTS:
+        tracks, data, properties, graph, cfg: as returned by analysis.track()
+    """
+    tracker = LinearAssignmentTracker(**tracker_args)
+    for t, objects in enumerate(
+        movie_objects(instance_movie, intensity_movie, features, min_area, min_solidity, num_workers)
+    ):
+        tracker.update(objects, t)
+    tracker.finalize()
+
+    tracks = sorted(tracker.tracks.values(), key=lambda track: track.ID)
+    data, properties, graph = tracks_to_napari(tracks)
+    return tracks, data, properties, graph, tracker.configuration
+
+
+def track_store_file(file_name: str) -> bool:
+    return re.search(r"^tracks_\d+\.npz$", file_name) != None
+
+
+class StreamingTracker:
+    """
+    Tracks a movie of any length one frame at a time, with memory bounded by the cells in the tracking window
+    ----------------------------------------------------------------------------------------------------------
+    Frames are linked by a LinearAssignmentTracker as they are pushed, e.g. as inference produces them. Tracks that can no longer be
+    extended (not seen for max_gap frames, or divided) and all but the last observation of tracks longer than history are written
+    to 'tracks_{k:05d}.npz' files in store_dir every flush_rows rows. Track IDs are global, so fragments written from different
+    windows are stitched back together by read_track_store(). Track files already in store_dir are removed when a tracker is created.
+
+        with StreamingTracker(store_dir) as tracker:
+            for instance_frame, intensity_frame in frames:
+                tracker.push(instance_frame, intensity_frame)
+        tracks, data, properties, graph = read_track_store(store_dir)
+    """
+
+    def __init__(
+        self,
+        store_dir: str,
+        features: tuple = ("area", "solidity"),
+        min_area: float = 500,
+        min_solidity: float = 0.90,
+        history: int = 64,
+        flush_rows: int = 100000,
+        intensity_map: Optional[npt.NDArray] = None,
+        **tracker_args,
+    ):
+        os.makedirs(store_dir, exist_ok=True)
+        # files of an earlier run would be stitched into this one by read_track_store(), with colliding IDs
+        for file_name in os.listdir(store_dir):
+            if track_store_file(file_name):
+                os.remove(os.path.join(store_dir, file_name))
+        self.store_dir = store_dir
+        self.features = tuple(features)
+        self.min_area = min_area
+        self.min_solidity = min_solidity
+        self.history = history
+        self.flush_rows = flush_rows
+        self.intensity_map = intensity_map
+        self.tracker = LinearAssignmentTracker(**tracker_args)
+        self.buffer = []
+        self.buffer_rows = 0
+        self.paths = []
+
+        with open(os.path.join(store_dir, "configuration.json"), "w") as config_file:
+            json.dump(
+                dict(
+                    self.tracker.configuration,
+                    features=list(self.features),
+                    min_area=min_area,
+                    min_solidity=min_solidity,
+                ),
+                config_file,
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def frame_count(self) -> int:
+        return self.tracker.frame + 1
+
+    def push(self, instance_frame: npt.NDArray, intensity_frame: Optional[npt.NDArray] = None):
+        """
+        Tracks the next frame, intensity frames are flat-field corrected with intensity_map if one was given, then fitted to the
+        instance frame with square_reshape() if their shapes differ
+        """
+        if intensity_frame is not None and self.intensity_map is not None:
+            intensity_frame = flatfield.correct_frame(intensity_frame, self.intensity_map)
+        if intensity_frame is not None and intensity_frame.shape != instance_frame.shape:
+            intensity_frame = au.square_reshape(np.asarray(intensity_frame), instance_frame.shape)
+
+        objects = frame_objects(
+            instance_frame, intensity_frame, self.features, self.min_area, self.min_solidity
+        )
+        finished = self.tracker.update(objects)
+        for track in finished:
+            del self.tracker.tracks[track.ID]
+        fragments = [track.split() for track in self.tracker.active if len(track) > self.history]
+        self.release(finished + fragments)
+
+    def release(self, tracks: list[Track]):
+        "Buffers tracks (or fragments of tracks) to be written, flushing once flush_rows rows are buffered"
+
+        self.buffer.extend(tracks)
+        self.buffer_rows += sum(len(track) for track in tracks)
+        if self.buffer_rows >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        "Writes the buffered tracks to the next 'tracks_{k:05d}.npz' file"
+
+        if self.buffer_rows == 0:
+            self.buffer = []
+            return
+
+        data, properties, graph = tracks_to_napari(self.buffer)
+        path = os.path.join(self.store_dir, f"tracks_{len(self.paths):05d}.npz")
+        np.savez(
+            path,
+            data=data,
+            graph=np.asarray([[child, parents[0]] for child, parents in graph.items()]).reshape(-1, 2),
+            **{f"property_{key}": values for key, values in properties.items()},
+        )
+        self.paths.append(path)
+        self.buffer = []
+        self.buffer_rows = 0
+
+    def close(self) -> list[str]:
+        "Ends all active tracks and writes everything left, returns the paths of the files written"
+
+        self.release(self.tracker.finalize())
+        self.flush()
+        self.tracker.tracks = {}
+        return self.paths
+
+
+def read_track_store(store_dir: str) -> tuple[list[Track], npt.NDArray, dict, dict]:
+    """
+    Reads and stitches the files written by StreamingTracker
+    --------------------------------------------------------
+    OUTPUTS:
+        tracks: list[Track], ordered by ID
+        data, properties, graph: napari's add_tracks triple, as returned by LinearAssignmentTracker.to_napari()
+    """
+    paths = sorted(
+        os.path.join(store_dir, file_name) for file_name in os.listdir(store_dir) if track_store_file(file_name)
+    )
+    data, properties, graph = [], [], {}
+    for path in paths:
+        with np.load(path) as chunk:
+            data.append(chunk["data"])
+            properties.append(
+                {key[len("property_") :]: chunk[key] for key in chunk.files if key.startswith("property_")}
+            )
+            graph.update({int(child): [int(parent)] for child, parent in chunk["graph"]})
+
+    if len(data) == 0:
+        return [], np.zeros((0, 4)), {}, {}
+
+    keys = list(dict.fromkeys(key for chunk in properties for key in chunk))
+    data_rows = [chunk.shape[0] for chunk in data]
+    data = np.concatenate(data)
+    properties = {
+        key: np.concatenate(
+            [chunk.get(key, np.full(rows, np.nan)) for chunk, rows in zip(properties, data_rows)]
+        )
+        for key in keys
+    }
+    order = np.lexsort((data[:, 1], data[:, 0]))
+    data = data[order]
+    properties = {key: values[order] for key, values in properties.items()}
+
+    tracks = []
+    object_keys = [key for key in keys if key not in ("t", "generation", "root", "parent")]
+    starts = np.flatnonzero(np.diff(data[:, 0], prepend=np.nan))
+    for start, stop in zip(starts, np.append(starts[1:], data.shape[0])):
+        track = Track(
+            int(data[start, 0]),
+            int(properties["parent"][start]),
+            int(properties["root"][start]),
+            int(properties["generation"][start]),
+        )
+        track.t = data[start:stop, 1].astype(int).tolist()
+        track.y = data[start:stop, 2].tolist()
+        track.x = data[start:stop, 3].tolist()
+        track.properties = {key: properties[key][start:stop].tolist() for key in object_keys}
+        track.dummy = np.isnan(properties["class_id"][start:stop]).tolist() if "class_id" in properties else [False] * len(track.t)
+        tracks.append(track)
+
+    tracks_by_ID = {track.ID: track for track in tracks}
+    for track in tracks:
+        if track.parent != track.ID and track.parent in tracks_by_ID:
+            tracks_by_ID[track.parent].children.append(track.ID)
+
+    return tracks, data, properties, graph
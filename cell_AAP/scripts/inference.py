@@ -1,88 +1,19 @@
-import pooch
 import numpy as np
 import re
-from detectron2.engine import DefaultPredictor
-from detectron2.engine.defaults import create_ddp_model
-from detectron2.config import get_cfg
-from detectron2.checkpoint import DetectionCheckpointer
-from detectron2.config import LazyConfig, instantiate
 from typing import Optional
 import torch
 import cell_AAP.annotation.annotation_utils as au  # type:ignore
+import cell_AAP.models as models  # type:ignore
+import cell_AAP.napari.flatfield as flatfield  # type:ignore
 from skimage.morphology import binary_erosion, disk
 import skimage.measure
 import tifffile as tiff
 import os
 import pandas as pd
+from cell_AAP.scripts.inference_server import InferenceClient  # type:ignore
 
 
 
-def get_model(model_name: str):
-    """
-    Instaniates POOCH instance containing model files from the model_registry
-    --------------------------------------------------------------------------
-    INPUTS:
-        cellaap_widget: instance of ui.cellAAPWidget()I
-    """
-
-    models = ['HeLa', 'U2OS', 'HeLa_o']
-    try:
-        assert model_name in models
-    except AssertionError:
-        raise Exception(f'Invalid model name selected, model must be one of {models}')
-
-    url_registry = {
-        "HeLa": "doi:10.5281/zenodo.14226948",
-        "U2OS": "doi:10.5281/zenodo.14226985",
-        "HeLa_o": "doi:10.5281/zenodo.12585190",
-    }
-
-    weights_registry = {
-        "HeLa": (
-            "model_0043499.pth",
-            "md5:ad056dc159ea8fd12f7d5d4562c368a9",
-        ),
-        "U2OS": (
-            "model_0030449.pth",
-            "md5:4d65600b92560d7fcda6c6fd59fa0fe8"
-        ),
-        "HeLa_o": (
-            
-        )
-    }
-
-    configs_registry = {
-        "HeLa": (
-            "config.yaml",
-            "md5:319ec68250d7ae499a274f7c4f151513",
-            "lazy",
-        ),
-        "U2OS" : (
-            "config.yaml",
-            "md5:ad80d579860c53a84ab076c4db2604fd",
-            "lazy"
-        ),
-        "HeLa_o": (
-
-        )
-    }
-
-    model = pooch.create(
-        path=pooch.os_cache("cell_aap"),
-        base_url=url_registry[f"{model_name}"],
-        registry={
-            weights_registry[f"{model_name}"][0]: weights_registry[f"{model_name}"][1],
-            configs_registry[f"{model_name}"][0]: configs_registry[f"{model_name}"][1],
-        },
-    )
-
-    model_type = configs_registry[f"{model_name}"][2]
-    weights_name = weights_registry[f"{model_name}"][0]
-    config_name = configs_registry[f"{model_name}"][0]
-
-    return model, model_type, weights_name, config_name
-
-
 def configure(
     model_name: str,
     confluency_est: int = 2000,
@@ -100,53 +31,14 @@ def configure(
         container: dict containing relevant variables for downstream inference
     """
     container = {}
-    model, model_type, weights_name, config_name = get_model(model_name)
-    if model_type == "yacs":
-        model_type = "yacs"
-        cfg = get_cfg()
-        cfg.merge_from_file(model.fetch(f"{config_name}"))
-        cfg.MODEL.WEIGHTS = model.fetch(f"{weights_name}")
-
-        if torch.cuda.is_available():
-            cfg.MODEL.DEVICE = "cuda"
-        else:
-            cfg.MODEL.DEVICE = "cpu"
-
-        if 0 < confluency_est <= 2000:
-            cfg.TEST.DETECTIONS_PER_IMAGE = (
-                confluency_est
-            )
-        if 0 < conf_threshold < 1:
-            cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = (
-                conf_threshold
-            )
-        predictor = DefaultPredictor(cfg)
-
-    else:
-        model_type = "lazy"
-        cfg = LazyConfig.load(model.fetch(f"{config_name}"))
-        cfg.train.init_checkpoint = model.fetch(f"{weights_name}")
-
-        if torch.cuda.is_available():
-            cfg.train.device = "cuda"
-        else:
-            cfg.train.device = "cpu"
-
-        if 0 < confluency_est <= 2000:
-            cfg.model.proposal_generator.post_nms_topk[1] = (
-               confluency_est
-            )
-
-        if 0 < conf_threshold < 1:
-            cfg.model.roi_heads.box_predictor.test_score_thresh = (
-                conf_threshold
-            )
-
-        predictor = instantiate(cfg.model)
-        predictor.to(cfg.train.device)
-        predictor = create_ddp_model(predictor)
-        DetectionCheckpointer(predictor).load(cfg.train.init_checkpoint)
-        predictor.eval()
+    model_name = models.resolve(model_name)
+    model_type = models.config_type(model_name)
+    predictor = models.POOL.get(
+        model_name,
+        "cuda" if torch.cuda.is_available() else "cpu",
+        confluency_est if 0 < confluency_est <= 2000 else None,
+        conf_threshold if 0 < conf_threshold < 1 else None,
+    )
 
     if save_dir == None:
         save_dir = os.getcwd()
@@ -169,6 +61,40 @@ def configure(
     return container
 
 
+def connect(
+    address,
+    model_name: str,
+    confluency_est: int = 2000,
+    conf_threshold: float = 0.3,
+    save_dir: Optional[bool] = None,
+    authkey: Optional[bytes] = None,
+) -> dict:
+    """
+    Thin client version of configure(): warms the model on a running inference_server and returns a container whose inference is
+    sent to it, so no model is loaded in this process
+    -------------------------------------------------------------------------------------------------------------------------------
+    INPUTS:
+        address: str or tuple, Unix socket path or (host, port) of the server
+        model_name, confluency_est, conf_threshold, save_dir: as in configure()
+        authkey: bytes, the server's authkey, read from its key file by default
+    OUTPUTS:
+        container: dict, usable wherever a configure() container is
+    """
+    client = InferenceClient(address, authkey)
+    key, model_type = client.configure(model_name, confluency_est, conf_threshold)
+
+    return {
+        "client": client,
+        "model_key": key,
+        "configured": True,
+        "model_type": model_type,
+        "model_name": model_name,
+        "confluency_est": confluency_est,
+        "conf_threshold": conf_threshold,
+        "save_dir": os.getcwd() if save_dir == None else save_dir,
+    }
+
+
 def color_masks(
     segmentations: np.ndarray,
     labels,
@@ -215,42 +141,35 @@ def color_masks(
     return seg_labeled
 
 
-def inference(
-    container: dict,
-    img: np.ndarray,
-    frame_num: Optional[int] = None,
-    analyze: Optional[bool] = False,
-) -> tuple[np.ndarray, np.ndarray, list, np.ndarray, np.ndarray]:
-    """
-    Runs the actual inference -> Detectron2 -> masks
-    ------------------------------------------------
-    INPUTS:
-        container: dict, surogate object for cell_aap_widget,
-        img: np.ndarray, image to run inference on,
-        frame_num: int, frame number to keep track of cenroids,
-        analyze, bool, whether or not to analyze results
-    OUTPUTS:
-        seg_fordisp: np.ndarray, semantic segmentation,
-        sef_fortracking: np.ndarray, instance segmentation
-        centroids: np.ndarray,
-        img: list[np.ndarray], original image,
-        confidence: np.ndarray
-    """
+def preprocess(container: dict, img: np.ndarray) -> np.ndarray:
+    "Fits an image to the input shape of the configured model, 2048 x 2048 for yacs models, 1024 x 1024 for lazy models"
+
+    shape = (2048, 2048) if container['model_type'] == "yacs" else (1024, 1024)
+    if img.shape != shape:
+        img = au.square_reshape(img, shape)
+    return img
 
+
+def predict_batch(container: dict, imgs: list[np.ndarray]) -> list[dict]:
+    "Runs the predictor on preprocessed images, lazy models take the whole batch in one forward pass"
+
+    # pooled predictors are shared between containers, so each container's test-time parameters are set before every call
+    models.POOL.apply(
+        container['predictor'],
+        container['confluency_est'] if 0 < container['confluency_est'] <= 2000 else None,
+        container['conf_threshold'] if 0 < container['conf_threshold'] < 1 else None,
+    )
     if container['model_type'] == "yacs":
-        if img.shape != (2048, 2048):
-            img = au.square_reshape(img, (2048, 2048))
-        output = container['predictor'](img.astype("float32"))
+        return [container['predictor'](img.astype("float32")) for img in imgs]
 
-    else:
-        if img.shape != (1024, 1024):
-            img = au.square_reshape(img, (1024, 1024))
-        img_perm = np.moveaxis(img, -1, 0)
+    with torch.inference_mode():
+        return container['predictor']([{"image": au.rgb_tensor(img)} for img in imgs])
 
-        with torch.inference_mode():
-            output = container['predictor'](
-                [{"image": torch.from_numpy(img_perm).type(torch.float32)}]
-            )[0]
+
+def postprocess(
+    output: dict, frame_num: Optional[int] = None, analyze: Optional[bool] = False
+) -> tuple[np.ndarray, np.ndarray, list, np.ndarray, np.ndarray]:
+    "Turns one Detectron2 output into (seg_fordisp, seg_fortracking, centroids, scores, classes), see inference()"
 
     segmentations = output["instances"].pred_masks.to("cpu")
     labels = output["instances"].pred_classes.to("cpu")
@@ -275,10 +194,70 @@ def inference(
 
         centroids.append(centroid)
 
-    return seg_fordisp, seg_fortracking, centroids, img, scores, classes
+    return seg_fordisp, seg_fortracking, centroids, scores, classes
 
 
-def run_inference(container: dict, movie_file: str, interval: list[int]):
+def inference_batch(
+    container: dict,
+    imgs: list[np.ndarray],
+    frame_nums: Optional[list[int]] = None,
+    analyze: Optional[bool] = False,
+) -> list[tuple[np.ndarray, np.ndarray, list, np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Runs inference() on several images with one predictor call, containers returned by connect() send the images to an inference server
+    ---------------------------------------------------------------------------------------------------------------------------------------
+    OUTPUTS:
+        results: list, one inference() tuple per image
+    """
+    if frame_nums == None:
+        frame_nums = [None] * len(imgs)
+
+    if "client" in container:
+        return list(container['client'].infer(container['model_key'], imgs, frame_nums, analyze))
+
+    imgs = [preprocess(container, img) for img in imgs]
+    outputs = predict_batch(container, imgs)
+    results = []
+    for img, output, frame_num in zip(imgs, outputs, frame_nums):
+        seg_fordisp, seg_fortracking, centroids, scores, classes = postprocess(output, frame_num, analyze)
+        results.append((seg_fordisp, seg_fortracking, centroids, img, scores, classes))
+
+    return results
+
+
+def inference(
+    container: dict,
+    img: np.ndarray,
+    frame_num: Optional[int] = None,
+    analyze: Optional[bool] = False,
+) -> tuple[np.ndarray, np.ndarray, list, np.ndarray, np.ndarray]:
+    """
+    Runs the actual inference -> Detectron2 -> masks
+    ------------------------------------------------
+    INPUTS:
+        container: dict, surogate object for cell_aap_widget, as returned by configure() or connect()
+        img: np.ndarray, image to run inference on,
+        frame_num: int, frame number to keep track of cenroids,
+        analyze, bool, whether or not to analyze results
+    OUTPUTS:
+        seg_fordisp: np.ndarray, semantic segmentation,
+        sef_fortracking: np.ndarray, instance segmentation
+        centroids: np.ndarray,
+        img: list[np.ndarray], original image,
+        confidence: np.ndarray
+    """
+
+    return inference_batch(container, [img], [frame_num], analyze)[0]
+
+
+def run_inference(
+    container: dict,
+    movie_file: str,
+    interval: list[int],
+    tracker=None,
+    batch_size: int = 1,
+    intensity_map: Optional[np.ndarray] = None,
+):
     """
     Runs inference on image returned by self.image_select(), saves inference result if save selector has been checked
     ----------------------------------------------------------------------------------------------------------------
@@ -286,6 +265,12 @@ def run_inference(container: dict, movie_file: str, interval: list[int]):
         container: dict, surrogate object for cell_aap_widget,
         movie_file: str, path to movie to run inference on,
         interval: list[int], range of images within movie to run inference on, for example, if the movie contains 89 images [0, 88] is the largest possible interval.
+        tracker: tracking.StreamingTracker, if given every instance segmentation is tracked as soon as it is inferred, close the tracker and
+                 read the tracks back with tracking.read_track_store()
+        batch_size: int, number of frames per inference_batch() call, lazy models and inference servers run a batch in one pass
+        intensity_map: np.ndarray, flat field of the movie's acquisition settings, i.e. flatfield.FlatFieldCache(cache_dir).get(settings),
+                       if given frames are corrected with flatfield.correct_frame() as they are read, before bw_to_rgb(), and the tracker
+                       receives the corrected frames so it should not be given a map of its own
     OUTPUTS:
         result: dict containing relevant inference outputs
     """
@@ -299,6 +284,11 @@ def run_inference(container: dict, movie_file: str, interval: list[int]):
 
     name, im_array = str(movie_file), tiff.imread(movie_file)
     name = name.replace(".", "/").split("/")[-2]
+    if intensity_map is not None:
+        if im_array.ndim == 3:
+            im_array = flatfield.FlatFieldCorrected(im_array, intensity_map)
+        else:
+            im_array = flatfield.correct_frame(im_array, intensity_map)
 
     try:
         assert container['configured'] == True
@@ -318,24 +308,25 @@ def run_inference(container: dict, movie_file: str, interval: list[int]):
 
     if len(im_array.shape) == 3:
         movie = []
-        for frame in range(
-            interval[1]
-            - interval[0]
-            + 1
-        ):
-            prog_count += 1
-            frame += interval[0]
-            img = au.bw_to_rgb(im_array[frame])
-            semantic_seg, instance_seg, centroids, img, scores, classes= inference(
-                container, img, frame - interval[0]
+        frames = [frame + interval[0] for frame in range(interval[1] - interval[0] + 1)]
+        for k in range(0, len(frames), batch_size):
+            batch = frames[k : k + batch_size]
+            results = inference_batch(
+                container,
+                [au.bw_to_rgb(im_array[frame]) for frame in batch],
+                [frame - interval[0] for frame in batch],
             )
-            movie.append(img)
-            semantic_movie.append(semantic_seg.astype("uint16"))
-            instance_movie.append(instance_seg.astype("uint16"))
-            scores_list.append(scores)
-            classes_list.append(classes)
-            if len(centroids) != 0:
-                points += (centroids,)
+            for frame, (semantic_seg, instance_seg, centroids, img, scores, classes) in zip(batch, results):
+                prog_count += 1
+                movie.append(img)
+                semantic_movie.append(semantic_seg.astype("uint16"))
+                instance_movie.append(instance_seg.astype("uint16"))
+                if tracker != None:
+                    tracker.push(instance_movie[-1], im_array[frame])
+                scores_list.append(scores)
+                classes_list.append(classes)
+                if len(centroids) != 0:
+                    points += (centroids,)
 
     elif len(im_array.shape) == 2:
         prog_count += 1
@@ -343,6 +334,8 @@ def run_inference(container: dict, movie_file: str, interval: list[int]):
         semantic_seg, instance_seg, centroids, img, scores, classes= inference(container, img)
         semantic_movie.append(semantic_seg.astype("uint16"))
         instance_movie.append(instance_seg.astype("uint16"))
+        if tracker != None:
+            tracker.push(instance_movie[-1], im_array)
         scores_list.append(scores)
         classes_list.append(classes)
         if len(centroids) != 0:
@@ -370,6 +363,121 @@ def run_inference(container: dict, movie_file: str, interval: list[int]):
 
     return result
 
+def filter_instances(instances, conf_threshold: float, confluency_est: int):
+    """
+    Instances a run at conf_threshold and confluency_est would have returned, derived from a run at lower / larger settings: the
+    detections scoring > conf_threshold (as detectron2 keeps them), at most confluency_est of them in order of decreasing score
+    """
+    scores = instances.scores
+    keep = torch.nonzero(scores > conf_threshold).flatten()
+    keep = keep[torch.argsort(scores[keep], descending=True, stable=True)][:confluency_est]
+    return instances[torch.sort(keep).values]
+
+
+def sweep(
+    container: dict,
+    movie_file: str,
+    interval: list[int],
+    conf_thresholds: list[float],
+    confluency_ests: list[int],
+    batch_size: int = 1,
+    keep_results: bool = False,
+    analyze: Optional[bool] = False,
+) -> tuple[pd.DataFrame, dict]:
+    """
+    Runs every frame through the network once at the most permissive settings and derives the results of every (conf_threshold,
+    confluency_est) pair by filtering the raw instances
+    ---------------------------------------------------------------------------------------------------------------------------------
+    INPUTS:
+        container: dict, as returned by configure(), inference server containers are not supported
+        movie_file: str, path to the movie
+        interval: list[int], first and last frame, as in run_inference()
+        conf_thresholds: list[float], score thresholds in (0, 1)
+        confluency_ests: list[int], detection caps in (0, 2000]
+        batch_size: int, frames per forward pass
+        keep_results: bool, if True the run_inference() result of every setting is kept, two uint16 movies per setting, by default
+                      only the counts are computed, which also skips color_masks() for every setting
+        analyze: bool, as in inference()
+    OUTPUTS:
+        counts: pd.DataFrame, one row per (conf_threshold, confluency_est, frame) with the number of cells, of mitotic cells and the mean score
+        results: dict, (conf_threshold, confluency_est) -> dict with the keys of run_inference()'s result, empty if keep_results is False
+
+    Thresholds are exact: NMS only lets higher scoring boxes suppress lower scoring ones, so raising the threshold after the fact
+    removes the same boxes a run at that threshold would. For yacs models confluency_est caps the detections per image, which the
+    filter reproduces exactly. For lazy models it caps the proposals kept after NMS, and the sweep
+    approximates this with the same cap on final detections.
+    """
+    try:
+        assert "client" not in container
+    except AssertionError:
+        raise Exception("Sweeps need a local model, use configure() instead of connect()")
+    # predict_batch() falls back to the config's values outside these ranges, the permissive pass would then be filtered already
+    try:
+        assert len(conf_thresholds) > 0 and all(0 < t < 1 for t in conf_thresholds)
+    except AssertionError:
+        raise ValueError(f"conf_thresholds must be a non-empty list of values in (0, 1), got {conf_thresholds}")
+    try:
+        assert len(confluency_ests) > 0 and all(0 < c <= 2000 for c in confluency_ests)
+    except AssertionError:
+        raise ValueError(f"confluency_ests must be a non-empty list of values in (0, 2000], got {confluency_ests}")
+
+    settings = [(float(t), int(c)) for t in sorted(set(conf_thresholds)) for c in sorted(set(confluency_ests))]
+    permissive = dict(container, conf_threshold=min(t for t, _ in settings), confluency_est=max(c for _, c in settings))
+
+    im_array = tiff.imread(movie_file)
+    if im_array.ndim == 2:
+        im_array = im_array[np.newaxis]
+    interval = [max(interval[0], 0), min(interval[1], im_array.shape[0] - 1)]
+    name = str(movie_file).replace(".", "/").split("/")[-2]
+
+    rows = []
+    results = {
+        setting: {"semantic_movie": [], "instance_movie": [], "centroids": [], "scores": [], "classes": []}
+        for setting in settings
+    } if keep_results else {}
+    frames = list(range(interval[0], interval[1] + 1))
+    for k in range(0, len(frames), batch_size):
+        batch = frames[k : k + batch_size]
+        imgs = [preprocess(container, au.bw_to_rgb(im_array[frame])) for frame in batch]
+        outputs = predict_batch(permissive, imgs)
+        for frame, output in zip(batch, outputs):
+            instances = output["instances"].to("cpu")
+            for conf_threshold, confluency_est in settings:
+                filtered = filter_instances(instances, conf_threshold, confluency_est)
+                scores = filtered.scores.numpy()
+                classes = filtered.pred_classes.numpy()
+                rows.append(
+                    {
+                        "conf_threshold": conf_threshold,
+                        "confluency_est": confluency_est,
+                        "frame": frame,
+                        "cells": scores.shape[0],
+                        "mitotic_cells": int((classes == 1).sum()),
+                        "mean_score": float(scores.mean()) if scores.shape[0] else np.nan,
+                    }
+                )
+                if keep_results:
+                    seg_fordisp, seg_fortracking, centroids, scores, classes = postprocess(
+                        {"instances": filtered}, frame - interval[0], analyze
+                    )
+                    result = results[(conf_threshold, confluency_est)]
+                    result["semantic_movie"].append(seg_fordisp.astype("uint16"))
+                    result["instance_movie"].append(seg_fortracking.astype("uint16"))
+                    result["centroids"].extend(centroids)
+                    result["scores"].append(scores)
+                    result["classes"].append(classes)
+
+    for (conf_threshold, confluency_est), result in results.items():
+        result["name"] = f"{name}_{container['model_name']}_{confluency_est}_{round(conf_threshold, ndigits = 2)}"
+        result["semantic_movie"] = np.asarray(result["semantic_movie"])
+        result["instance_movie"] = np.asarray(result["instance_movie"])
+        result["centroids"] = np.asarray(result["centroids"]).reshape(-1, 3)
+        result["scores"] = np.concatenate(result["scores"], axis=0)
+        result["classes"] = np.concatenate(result["classes"], axis=0)
+
+    return pd.DataFrame(rows), results
+
+
 def save(container, result):
     """
     Saves and analyzes an inference result
@@ -0,0 +1,407 @@
+import os
+import time
+import queue
+import secrets
+import argparse
+import ipaddress
+import threading
+import numpy as np
+from typing import Optional, Union
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from cell_AAP.annotation.resample import broadcast_channel  # type:ignore
+
+"""
+Long running local inference server that keeps configured models warm.
+Clients connect over a Unix socket (address is a path) or localhost TCP (address is a (host, port) tuple), configure a model once and
+then send frames, frames from concurrent clients are micro-batched into shared forward passes and results are streamed back frame by frame.
+
+Messages are pickled, so being able to connect means being able to run code as the server's user. Each server therefore generates a
+random authkey and writes it to a file only its user can read, '{socket path}.key' or '~/.cell_aap/inference_{port}.key', which clients
+read (or take from the CELL_AAP_INFERENCE_AUTHKEY environment variable, in hex). Unix sockets are created with 0600 permissions and TCP
+servers only bind loopback addresses.
+
+    python -m cell_AAP.scripts.inference_server /tmp/cell_aap.sock
+
+    container = inference.connect("/tmp/cell_aap.sock", "HeLa")
+    result = inference.run_inference(container, movie_file, interval, batch_size = 8)
+"""
+
+AUTHKEY_ENV = "CELL_AAP_INFERENCE_AUTHKEY"
+
+
+def check_loopback(address: Union[str, tuple[str, int]]):
+    "Raises for TCP addresses that are not on the loopback interface"
+
+    if isinstance(address, str):
+        return
+    host = address[0]
+    try:
+        assert host == "localhost" or ipaddress.ip_address(host).is_loopback
+    except (AssertionError, ValueError):
+        raise ValueError(f"Inference servers only listen on loopback addresses, i.e. 127.0.0.1, not {host}")
+
+
+def authkey_path(address: Union[str, tuple[str, int]]) -> str:
+    "Default file the authkey of a server is written to, next to its socket or in ~/.cell_aap for TCP servers"
+
+    if isinstance(address, str):
+        return address + ".key"
+    return os.path.join(os.path.expanduser("~"), ".cell_aap", f"inference_{address[1]}.key")
+
+
+def write_authkey(path: str, authkey: bytes):
+    "Writes an authkey, in hex, to a file only the current user can read"
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)  # the mode of os.open only applies to new files
+    with os.fdopen(fd, "w") as key_file:
+        key_file.write(authkey.hex())
+
+
+def read_authkey(address: Union[str, tuple[str, int]], path: Optional[str] = None) -> bytes:
+    "Authkey of the server at address, from the CELL_AAP_INFERENCE_AUTHKEY environment variable or the server's key file"
+
+    if os.environ.get(AUTHKEY_ENV) != None:
+        return bytes.fromhex(os.environ[AUTHKEY_ENV])
+    path = authkey_path(address) if path == None else path
+    try:
+        with open(path) as key_file:
+            return bytes.fromhex(key_file.read().strip())
+    except OSError:
+        raise Exception(f"No authkey found for the inference server at {address}, {path} could not be read")
+
+
+def model_key(model_name: str, confluency_est: int, conf_threshold: float) -> str:
+    "Identifies one configured model, clients asking for the same settings share it"
+
+    return f"{model_name}_{confluency_est}_{round(conf_threshold, ndigits=4)}"
+
+
+def pack_image(img: np.ndarray):
+    "Broadcast RGB views, as returned by bw_to_rgb(), are sent as their single channel instead of being pickled at full size"
+
+    channel = broadcast_channel(img)
+    return img if channel is None else ("broadcast", np.ascontiguousarray(channel), img.shape)
+
+
+def unpack_image(packed) -> np.ndarray:
+    if isinstance(packed, tuple):
+        _, channel, shape = packed
+        return np.broadcast_to(channel[..., np.newaxis], shape)
+    return packed
+
+
+class Job:
+    "One frame waiting to be batched, the result or exception is put on reply"
+
+    def __init__(self, key: str, img: np.ndarray, frame_num: Optional[int], analyze: bool, reply: queue.Queue, index: int):
+        self.key = key
+        self.img = img
+        self.frame_num = frame_num
+        self.analyze = analyze
+        self.reply = reply
+        self.index = index
+
+
+class InferenceServer:
+    """
+    Serves inference.inference_batch() for warm models
+    ---------------------------------------------------
+    INPUTS:
+        address: str or tuple, Unix socket path or (host, port) on a loopback address
+        authkey: bytes, shared secret clients must present, a random one is generated by default
+        authkey_file: str, file the authkey is written to while serving, defaults to authkey_path(address)
+        max_batch: int, maximum number of frames per forward pass
+        batch_timeout: float, seconds the batcher waits for more frames after the first one of a batch arrives
+    """
+
+    def __init__(
+        self,
+        address: Union[str, tuple[str, int]],
+        authkey: Optional[bytes] = None,
+        authkey_file: Optional[str] = None,
+        max_batch: int = 8,
+        batch_timeout: float = 0.01,
+    ):
+        check_loopback(address)
+        self.address = address
+        self.authkey = secrets.token_bytes(32) if authkey == None else authkey
+        self.authkey_file = authkey_path(address) if authkey_file == None else authkey_file
+        self.max_batch = max_batch
+        self.batch_timeout = batch_timeout
+        self.models = {}
+        self.models_lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.running = False
+        self.listener = None
+
+    def configure(self, model_name: str, confluency_est: int = 2000, conf_threshold: float = 0.3) -> str:
+        "Configures a model unless one with the same settings is already warm, returns its key"
+
+        # detectron2 is only needed where models run, clients import this module without it
+        import cell_AAP.scripts.inference as inf  # type:ignore
+
+        key = model_key(model_name, confluency_est, conf_threshold)
+        with self.models_lock:
+            if key not in self.models:
+                self.models[key] = inf.configure(model_name, confluency_est, conf_threshold)
+        return key
+
+    def next_batch(self) -> list[Job]:
+        "Blocks for one job, then collects up to max_batch jobs that arrive within batch_timeout"
+
+        batch = [self.jobs.get()]
+        deadline = time.monotonic() + self.batch_timeout
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.jobs.get(timeout=max(remaining, 0)) if remaining > 0 else self.jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run_batch(self, batch: list[Job]):
+        "Runs a batch, grouped by model and analyze flag, one forward pass per group"
+
+        import cell_AAP.scripts.inference as inf  # type:ignore
+
+        groups = {}
+        for job in batch:
+            groups.setdefault((job.key, job.analyze), []).append(job)
+
+        for (key, analyze), jobs in groups.items():
+            try:
+                results = inf.inference_batch(
+                    self.models[key], [job.img for job in jobs], [job.frame_num for job in jobs], analyze
+                )
+            except Exception as error:
+                for job in jobs:
+                    job.reply.put((job.index, error))
+                continue
+            for job, result in zip(jobs, results):
+                job.reply.put((job.index, result))
+
+    def batch_loop(self):
+        while self.running:
+            batch = [job for job in self.next_batch() if job != None]
+            if batch:
+                self.run_batch(batch)
+
+    def handle(self, conn):
+        """
+        Serves one client, messages are tuples:
+            ("configure", model_name, confluency_est, conf_threshold) -> ("configured", key, model_type)
+            ("infer", key, imgs, frame_nums, analyze) -> one ("result", index, inference() tuple) per frame as it completes,
+                                                         then ("done", n), or ("error", message)
+            ("models",) -> ("models", keys)
+            ("shutdown",) -> stops the server
+        """
+        try:
+            while True:
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    return
+
+                if message[0] == "configure":
+                    try:
+                        key = self.configure(*message[1:])
+                        conn.send(("configured", key, self.models[key]["model_type"]))
+                    except Exception as error:
+                        conn.send(("error", f"{type(error).__name__}: {error}"))
+
+                elif message[0] == "infer":
+                    _, key, imgs, frame_nums, analyze = message
+                    if key not in self.models:
+                        conn.send(("error", f"Model {key} is not configured"))
+                        continue
+                    reply = queue.Queue()
+                    for index, (img, frame_num) in enumerate(zip(imgs, frame_nums)):
+                        self.jobs.put(Job(key, unpack_image(img), frame_num, analyze, reply, index))
+                    failed = None
+                    for _ in range(len(imgs)):
+                        index, result = reply.get()
+                        if isinstance(result, Exception):
+                            failed = failed or f"{type(result).__name__}: {result}"
+                        elif failed == None:
+                            result = result[:3] + (pack_image(result[3]),) + result[4:]
+                            conn.send(("result", index, result))
+                    conn.send(("error", failed) if failed != None else ("done", len(imgs)))
+
+                elif message[0] == "models":
+                    with self.models_lock:
+                        conn.send(("models", list(self.models.keys())))
+
+                elif message[0] == "shutdown":
+                    self.stop()
+                    return
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        "Accepts clients until stop() is called, each client is served by its own thread"
+
+        self.running = True
+        if isinstance(self.address, str):
+            # the socket file is created with 0600 permissions, so only this user can connect
+            umask = os.umask(0o177)
+            try:
+                self.listener = Listener(self.address, authkey=self.authkey)
+            finally:
+                os.umask(umask)
+        else:
+            self.listener = Listener(self.address, authkey=self.authkey)
+        write_authkey(self.authkey_file, self.authkey)
+        threading.Thread(target=self.batch_loop, daemon=True).start()
+        print(f"cell-AAP inference server listening on {self.listener.address}, authkey in {self.authkey_file}")
+        try:
+            while self.running:
+                try:
+                    conn = self.listener.accept()
+                except (AuthenticationError, EOFError, OSError):
+                    # accept() runs the authkey handshake, clients that fail it or hang up during it must not stop the server
+                    continue
+                if not self.running:
+                    conn.close()
+                    break
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            self.running = False
+            self.jobs.put(None)  # wakes the batcher
+            self.listener.close()
+            try:
+                os.remove(self.authkey_file)
+            except OSError:
+                pass
+
+    def stop(self):
+        "Stops serve_forever(), which blocks in accept() until one more client connects"
+
+        if not self.running:
+            return
+        self.running = False
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except OSError:
+            pass
+
+
+class InferenceClient:
+    """
+    Connection to an InferenceServer, requests on one client are sequential, use one client per thread.
+    The authkey is read with read_authkey() unless it is given.
+    """
+
+    def __init__(
+        self,
+        address: Union[str, tuple[str, int]],
+        authkey: Optional[bytes] = None,
+        authkey_file: Optional[str] = None,
+    ):
+        self.address = address
+        self.conn = Client(address, authkey=read_authkey(address, authkey_file) if authkey == None else authkey)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def request(self, *message):
+        self.conn.send(message)
+        response = self.conn.recv()
+        if response[0] == "error":
+            raise RuntimeError(f"Inference server error: {response[1]}")
+        return response
+
+    def configure(self, model_name: str, confluency_est: int = 2000, conf_threshold: float = 0.3) -> tuple[str, str]:
+        "Warms a model on the server, returns (model_key, model_type)"
+
+        _, key, model_type = self.request("configure", model_name, confluency_est, conf_threshold)
+        return key, model_type
+
+    def models(self) -> list[str]:
+        return self.request("models")[1]
+
+    def infer(
+        self,
+        key: str,
+        imgs: list[np.ndarray],
+        frame_nums: Optional[list] = None,
+        analyze: bool = False,
+    ):
+        """
+        Yields one inference() tuple per image, in order, as the server streams them back. The closing ("done", n) message is read
+        before the last result is yielded, so taking only the results needed (i.e. next() for a single image) leaves nothing unread,
+        a generator abandoned earlier leaves the connection unusable.
+        """
+        if frame_nums == None:
+            frame_nums = [None] * len(imgs)
+        self.conn.send(("infer", key, [pack_image(img) for img in imgs], list(frame_nums), analyze))
+
+        pending, next_index = {}, 0
+        if len(imgs) == 0:
+            self.finish()
+        while next_index < len(imgs):
+            response = self.conn.recv()
+            if response[0] == "error":
+                raise RuntimeError(f"Inference server error: {response[1]}")
+            _, index, result = response
+            pending[index] = result[:3] + (unpack_image(result[3]),) + result[4:]
+            while next_index in pending:
+                result = pending.pop(next_index)
+                next_index += 1
+                if next_index == len(imgs):
+                    self.finish()
+                yield result
+
+    def finish(self):
+        "Reads the ('done', n) message closing an infer request"
+
+        response = self.conn.recv()
+        if response[0] == "error":
+            raise RuntimeError(f"Inference server error: {response[1]}")
+
+    def shutdown(self):
+        self.conn.send(("shutdown",))
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+
+def parse_address(address: str) -> Union[str, tuple[str, int]]:
+    "'host:port' or ':port' becomes a TCP address on a loopback host, anything else is a Unix socket path"
+
+    host, _, port = address.rpartition(":")
+    if port.isdigit() and "/" not in address:
+        address = (host or "127.0.0.1", int(port))
+        check_loopback(address)
+    return address
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a cell-AAP inference server that keeps models warm")
+    parser.add_argument("address", help="Unix socket path, or host:port to listen on loopback TCP, i.e. 127.0.0.1:5000")
+    parser.add_argument("--authkey-file", default=None, help="file the generated authkey is written to, see authkey_path()")
+    parser.add_argument("--model", action="append", default=[], help="model to warm up at start, i.e. HeLa, may be repeated")
+    parser.add_argument("--max-batch", type=int, default=8)
+    parser.add_argument("--batch-timeout", type=float, default=0.01, help="seconds to wait for more frames per batch")
+    args = parser.parse_args()
+
+    server = InferenceServer(
+        parse_address(args.address),
+        authkey_file=args.authkey_file,
+        max_batch=args.max_batch,
+        batch_timeout=args.batch_timeout,
+    )
+    for model_name in args.model:
+        print(f"Warming up {server.configure(model_name)}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+import os
+import re
+import json
+import argparse
+import functools
+import importlib.util
+import numpy as np
+import pandas as pd
+import tifffile as tiff
+from typing import Optional
+import cell_AAP.napari.analysis as analysis  # type:ignore
+import cell_AAP.annotation.annotation_utils as au  # type:ignore
+
+"""
+Non-interactive, plate level version of time_in_mitosis.py.
+Positions are discovered once into a catalog, analysed in a process pool and their mitotic episodes are written to one table per plate.
+Episodes of each position are kept with the parameters they were computed with and only recomputed when their inputs or parameters change.
+The same assumptions as in time_in_mitosis.py are made about the root directory:
+    1) Inference folders end in "inference" and contain the well and position name, i.e. B10_s2 for well B10 and position 2
+    2) The analysis file is named "{prefix}_analysis.xlsx" and contains the sheets State Matrix and Intensity Matrix
+    3) Optionally the root directory contains one intensity_map.tif and one background_map.tif, in which case the analysis file must
+       also contain the sheets X Coordinates and Y Coordinates
+"""
+
+WELL_PATTERN = r"[A-H](1[0-2]|0[1-9]|[1-9])"
+POSITION_PATTERN = r"[s]\d"
+
+
+def find_map(root_dir: str, name: str) -> Optional[str]:
+    "Path of the single {name}.tif(f) within root_dir, None if there is not exactly one"
+
+    paths = [
+        f.path
+        for f in os.scandir(root_dir)
+        if re.search(name + r"\.ti(f|ff)", str(f.path)) != None
+    ]
+    return paths[0] if len(paths) == 1 else None
+
+
+def discover_positions(root_dir: str) -> pd.DataFrame:
+    """
+    Catalogs every inference directory of a plate
+    ---------------------------------------------
+    INPUTS:
+        root_dir: str, directory containing the *_inference folders
+    OUTPUTS:
+        catalog: pd.DataFrame, one row per position with coloumns well, position, prefix, home_dir, analysis_path, output_path and mtime,
+                 the modification time of the analysis file (NaN if it does not exist)
+    """
+    records = []
+    for f in sorted(os.scandir(root_dir), key=lambda entry: entry.name):
+        if not (f.is_dir() and str(f.path).split("_")[-1] == "inference"):
+            continue
+        well = re.search(WELL_PATTERN, f.name)
+        position = re.search(POSITION_PATTERN, f.name)
+        if well == None or position == None:
+            print(f"{f.path} does not contain a well and position name, skipping")
+            continue
+        prefix = str(f.name.split(position.group())[0] + position.group())
+        analysis_path = os.path.join(f.path, f"{prefix}_analysis.xlsx")
+        records.append(
+            {
+                "well": well.group(),
+                "position": position.group(),
+                "prefix": prefix,
+                "home_dir": f.path,
+                "analysis_path": analysis_path,
+                "output_path": os.path.join(f.path, f"{prefix}_episodes.csv"),
+                "mtime": (
+                    os.path.getmtime(analysis_path)
+                    if os.path.exists(analysis_path)
+                    else np.nan
+                ),
+            }
+        )
+
+    return pd.DataFrame(
+        records,
+        columns=["well", "position", "prefix", "home_dir", "analysis_path", "output_path", "mtime"],
+    )
+
+
+def run_parameters(
+    interframe_duration: float,
+    intensity_map_path: Optional[str] = None,
+    background_map_path: Optional[str] = None,
+) -> dict:
+    "Everything besides the analysis file that the episodes of a position depend on, stored next to each output"
+
+    return {
+        "interframe_duration": float(interframe_duration),
+        "intensity_map_path": intensity_map_path,
+        "intensity_map_mtime": os.path.getmtime(intensity_map_path) if intensity_map_path != None else None,
+        "background_map_path": background_map_path,
+        "background_map_mtime": os.path.getmtime(background_map_path) if background_map_path != None else None,
+    }
+
+
+def parameters_path(record: dict) -> str:
+    return os.path.splitext(record["output_path"])[0] + ".json"
+
+
+def is_stale(record: dict, parameters: dict) -> bool:
+    """
+    True if the episodes of a position are missing, older than its analysis file or were computed with other run_parameters(), i.e.
+    another interframe duration or with normalization maps added, removed or changed
+    """
+    if not os.path.exists(record["output_path"]) or not os.path.exists(parameters_path(record)):
+        return True
+    if os.path.getmtime(record["output_path"]) <= record["mtime"]:
+        return True
+    try:
+        with open(parameters_path(record)) as parameters_file:
+            return json.load(parameters_file) != parameters
+    except ValueError:
+        return True
+
+
+def analyze_position(
+    record: dict,
+    interframe_duration: float,
+    intensity_map_path: Optional[str] = None,
+    background_map_path: Optional[str] = None,
+) -> pd.DataFrame:
+    """
+    Mitotic episodes of one position, the state and intensity matrices are read from its analysis file and normalized as in
+    time_in_mitosis.py when both map paths are given
+    """
+    state_matrix = pd.read_excel(record["analysis_path"], "State Matrix").to_numpy(dtype="float")[:, 1:]
+    intensity_matrix = pd.read_excel(record["analysis_path"], "Intensity Matrix").to_numpy(dtype="float")[:, 1:]
+
+    if intensity_map_path != None and background_map_path != None:
+        try:
+            background_movie = tiff.memmap(background_map_path, mode="r")
+        except ValueError:  # compressed or tiled tiffs cannot be memory-mapped
+            background_movie = tiff.imread(background_map_path)
+        x_coords = pd.read_excel(record["analysis_path"], "X Coordinates").to_numpy(dtype="float")[:, 1:]
+        y_coords = pd.read_excel(record["analysis_path"], "Y Coordinates").to_numpy(dtype="float")[:, 1:]
+        intensity_matrix = analysis.normalize_intensity(
+            intensity_matrix, x_coords, y_coords, tiff.imread(intensity_map_path), background_movie
+        )
+
+    episodes = analysis.mitotic_episodes(state_matrix, intensity_matrix, interframe_duration)
+    episodes.insert(0, "position", record["position"])
+    episodes.insert(0, "well", record["well"])
+
+    return episodes
+
+
+def analyze_chunk(
+    records: list[dict],
+    interframe_duration: float,
+    intensity_map_path: Optional[str] = None,
+    background_map_path: Optional[str] = None,
+    force: bool = False,
+) -> list[bool]:
+    """
+    Writes the episodes of each stale position of a chunk to its output_path and the run_parameters() they were computed with next to
+    it, returns whether each position was (re)analysed
+    """
+
+    parameters = run_parameters(interframe_duration, intensity_map_path, background_map_path)
+
+    analysed = []
+    for record in records:
+        if not force and not is_stale(record, parameters):
+            analysed.append(False)
+            continue
+        episodes = analyze_position(record, interframe_duration, intensity_map_path, background_map_path)
+        episodes.to_csv(record["output_path"], index=False)
+        with open(parameters_path(record), "w") as parameters_file:
+            json.dump(parameters, parameters_file)
+        analysed.append(True)
+
+    return analysed
+
+
+def write_table(table: pd.DataFrame, path: str) -> str:
+    "Writes a table as parquet when pyarrow is available, as csv otherwise, returns the path written"
+
+    if importlib.util.find_spec("pyarrow") != None:
+        path = path + ".parquet"
+        table.to_parquet(path, index=False)
+    else:
+        path = path + ".csv"
+        table.to_csv(path, index=False)
+
+    return path
+
+
+def run_plate(
+    root_dir: str,
+    interframe_duration: float,
+    num_workers: int = 1,
+    force: bool = False,
+    name: str = "plate_episodes",
+) -> tuple[pd.DataFrame, str]:
+    """
+    Analyses every position of a plate and consolidates their mitotic episodes
+    --------------------------------------------------------------------------
+    INPUTS:
+        root_dir: str, directory containing the *_inference folders and optionally the normalization maps
+        interframe_duration: float, minutes between frames
+        num_workers: int, number of worker processes, positions are distributed one at a time
+        force: bool, if True positions are reanalysed even if their episodes are newer than their inputs
+        name: str, file name (without extension) of the plate table, written to root_dir
+    OUTPUTS:
+        table: pd.DataFrame, mitotic_episodes() of every position with leading well and position coloumns
+        table_path: str
+    """
+    catalog = discover_positions(root_dir)
+    catalog.to_csv(os.path.join(root_dir, "catalog.csv"), index=False)
+    missing = catalog["mtime"].isna()
+    for analysis_path in catalog.loc[missing, "analysis_path"]:
+        print(analysis_path + " could not be found")
+    catalog = catalog[~missing]
+
+    intensity_map_path = find_map(root_dir, "intensity_map")
+    background_map_path = find_map(root_dir, "background_map")
+    if intensity_map_path == None or background_map_path == None:
+        print("Normalization maps were not found")
+        intensity_map_path, background_map_path = None, None
+
+    records = catalog.to_dict("records")
+    analysed = au.chunked_map(
+        functools.partial(
+            analyze_chunk,
+            interframe_duration=interframe_duration,
+            intensity_map_path=intensity_map_path,
+            background_map_path=background_map_path,
+            force=force,
+        ),
+        records,
+        num_workers,
+        chunk_size=1,
+    )
+    print(f"{sum(analysed)} of {len(records)} positions analysed, {len(records) - sum(analysed)} up to date")
+
+    tables = [pd.read_csv(record["output_path"]) for record in records]
+    table = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+    table_path = write_table(table, os.path.join(root_dir, name))
+
+    return table, table_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Computes the mitotic episodes of every position of a plate and writes them to one table"
+    )
+    parser.add_argument("root_dir", help="directory where the *_inference folders are stored")
+    parser.add_argument("interframe_duration", type=float, help="duration between frames in minutes")
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--force", action="store_true", help="reanalyse positions whose outputs are up to date")
+    args = parser.parse_args()
+
+    _, table_path = run_plate(args.root_dir, args.interframe_duration, args.num_workers, args.force)
+    print(f"{table_path} written!")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,6 @@ import numpy as np
 import os
 import pandas as pd
 import re
-import math
 import tifffile as tiff
 import cell_AAP.napari.analysis as analysis #type:ignore
 import cell_AAP.annotation.annotation_utils as au #type:ignore
@@ -49,6 +48,7 @@ def main():
             state_matrix = pd.read_excel(
                 analysis_file_path, "State Matrix"
             ).to_numpy(dtype="float")[:, 1:]
+            raw_state_matrix = state_matrix.copy()
             state_matrix_cleaned, state_duration_vec, avg_time_in_mitosis = (
                 analysis.time_in_mitosis(state_matrix, interframe_duration)
             )
@@ -59,19 +59,22 @@ def main():
             if (len(intensity_map), len(background_map)) == (1, 1):
                 print("Normalization maps were found")
                 intensity_movie = tiff.imread(intensity_map[0])
-                background_movie = tiff.imread(background_map[0])
+                try:
+                    background_movie = tiff.memmap(background_map[0], mode="r")
+                except ValueError:  # compressed or tiled tiffs cannot be memory-mapped
+                    background_movie = tiff.imread(background_map[0])
                 x_coords = pd.read_excel(
                     analysis_file_path, "X Coordinates"
                 ).to_numpy(dtype="float")[:, 1:]
                 y_coords = pd.read_excel(
                     analysis_file_path, "Y Coordinates"
                 ).to_numpy(dtype="float")[:, 1:]
-                for i in range(intensity_matrix.shape[0]):  # tracks
-                    for j in range(intensity_matrix.shape[1]):  # frames
-                        x = math.floor(x_coords[i, j])
-                        y = math.floor(y_coords[i, j])
-                        intensity_matrix[i, j] /= intensity_movie[x, y]
-                        intensity_matrix[i, j] -= background_movie[j, x, y]
+                intensity_matrix = analysis.normalize_intensity(
+                    intensity_matrix, x_coords, y_coords, intensity_movie, background_movie
+                )
+                # entries without coordinates are NaN, outside of mitosis they are not part of the intensity sum and are zeroed,
+                # a NaN within mitosis still makes that track's intensity NaN
+                intensity_matrix[np.isnan(intensity_matrix) & ~(state_matrix_cleaned >= 0.5)] = 0
             else:
                 print("Normalization maps were not found")
             mitotic_intensity_vec = analysis.mitotic_intensity(
@@ -81,6 +84,9 @@ def main():
                 interframe_duration,  #
             )
             index_vec = analysis.timepoints_in_mitosis(state_matrix)
+            episodes = analysis.mitotic_episodes(
+                raw_state_matrix, intensity_matrix, interframe_duration
+            )
             mitotic_duration_vec = state_duration_vec[state_duration_vec > 0]
             mitotic_intensity_vec = mitotic_intensity_vec[state_duration_vec > 0]
             arr1 = np.asarray([mitotic_duration_vec, mitotic_intensity_vec]).T
@@ -107,6 +113,14 @@ def main():
                 startcol=5,
             )
             writer.close()
+            # the episodes sheet is rewritten as a whole, overlaying it would keep the rows of a longer earlier run
+            with pd.ExcelWriter(
+                path=analysis_file_path,
+                engine="openpyxl",
+                mode="a",
+                if_sheet_exists="replace",
+            ) as episodes_writer:
+                episodes.to_excel(episodes_writer, sheet_name="Mitotic Episodes", index=False)
         else:
             (
                 print(home_dir + " could not be found")
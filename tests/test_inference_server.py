@@ -0,0 +1,92 @@
+import os
+import sys
+import stat
+import socket
+import threading
+import types
+import numpy as np
+import pytest
+import cell_AAP.scripts
+from cell_AAP.scripts import inference_server
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    "Inference server on a Unix socket whose model is a stub echoing each frame's first channel"
+
+    stub = types.ModuleType("cell_AAP.scripts.inference")
+    stub.configure = lambda model_name, confluency_est, conf_threshold: {"model_type": "lazy"}
+    stub.inference_batch = lambda container, imgs, frame_nums, analyze: [
+        (img[..., 0].astype("uint16"), img[..., 0], [frame_num], img, np.array([0.9]), np.array([0]))
+        for img, frame_num in zip(imgs, frame_nums)
+    ]
+    monkeypatch.setitem(sys.modules, "cell_AAP.scripts.inference", stub)
+    monkeypatch.setattr(cell_AAP.scripts, "inference", stub, raising=False)
+    monkeypatch.delenv(inference_server.AUTHKEY_ENV, raising=False)
+
+    address = str(tmp_path / "server.sock")
+    instance = inference_server.InferenceServer(address)
+    thread = threading.Thread(target=instance.serve_forever, daemon=True)
+    thread.start()
+    while not os.path.exists(instance.authkey_file):
+        thread.join(0.01)
+    yield instance
+    instance.stop()
+    thread.join(5)
+
+
+def frame(value: int) -> np.ndarray:
+    return np.broadcast_to(np.full((8, 8), value, dtype="uint8")[..., np.newaxis], (8, 8, 3))
+
+
+def test_round_trip_one_frame_at_a_time(server):
+    "As napari's thin client does: one next() per frame, then more requests on the same connection"
+
+    with inference_server.InferenceClient(server.address) as client:
+        key, model_type = client.configure("HeLa")
+        assert model_type == "lazy"
+        for frame_num in range(3):
+            result = next(client.infer(key, [frame(frame_num)], [frame_num]))
+            assert result[2] == [frame_num]
+            assert result[0][0, 0] == frame_num
+        assert client.configure("HeLa") == (key, "lazy")
+        assert client.models() == [key]
+
+
+def test_round_trip_batch_in_order(server):
+    with inference_server.InferenceClient(server.address) as client:
+        key, _ = client.configure("HeLa")
+        results = list(client.infer(key, [frame(k) for k in range(5)], list(range(5))))
+        assert [result[2] for result in results] == [[k] for k in range(5)]
+        assert results[0][3].strides[2] == 0
+        assert list(client.infer(key, [])) == []
+        with pytest.raises(RuntimeError):
+            list(client.infer("missing", [frame(0)]))
+        assert client.models() == [key]
+
+
+def test_authkey_and_socket_are_private(server):
+    assert stat.S_IMODE(os.stat(server.authkey_file).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(server.address).st_mode) & 0o077 == 0
+    assert inference_server.read_authkey(server.address) == server.authkey
+    with pytest.raises(Exception):
+        inference_server.InferenceClient(server.address, authkey=b"wrong")
+
+
+def test_non_loopback_addresses_are_refused():
+    assert inference_server.parse_address("localhost:9000") == ("localhost", 9000)
+    assert inference_server.parse_address(":9000") == ("127.0.0.1", 9000)
+    with pytest.raises(ValueError):
+        inference_server.parse_address("0.0.0.0:9000")
+    with pytest.raises(ValueError):
+        inference_server.InferenceServer(("192.168.1.2", 9000))
+
+
+def test_clients_hanging_up_during_the_handshake_do_not_stop_the_server(server):
+    for _ in range(3):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        probe.connect(server.address)
+        probe.close()
+
+    with inference_server.InferenceClient(server.address) as client:
+        assert client.configure("HeLa")[1] == "lazy"